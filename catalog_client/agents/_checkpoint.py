@@ -0,0 +1,119 @@
+# Remember how far each log source has been read and reported.
+#
+# Positions (a journald cursor, a file's inode and offset, a Docker "since"
+# time) are set once the batch they describe has been dealt with and are
+# written to one small JSON file, replaced atomically.  Writes are batched: a
+# position set is written within ``write_interval`` seconds along with any
+# others set in the meantime.  A restarted agent resumes from what was last
+# written, so at worst it reports the last few seconds again.
+
+from os import fsync, rename
+import json
+
+from eliot import Message, write_traceback
+
+from pyrsistent import PClass, field
+
+from twisted.python.filepath import FilePath
+
+DEFAULT_CHECKPOINT_PATH = b"/var/lib/catalog-agents/checkpoints"
+DEFAULT_WRITE_INTERVAL = 5.0
+
+
+class CheckpointSettings(PClass):
+    """
+    :ivar path: The file to keep checkpoints in.
+    :ivar write_interval: The longest time, in seconds, a changed checkpoint
+        goes without being written.
+    """
+    path = field(type=FilePath, mandatory=True)
+    write_interval = field(
+        type=(int, float), mandatory=True, initial=DEFAULT_WRITE_INTERVAL,
+    )
+
+
+def checkpoint_settings_from_environment(environ):
+    settings = CheckpointSettings(
+        path=FilePath(
+            environ.get("CATALOG_CHECKPOINT_PATH", DEFAULT_CHECKPOINT_PATH),
+        ),
+    )
+    if "CATALOG_CHECKPOINT_WRITE_INTERVAL" in environ:
+        settings = settings.set(
+            write_interval=float(
+                environ["CATALOG_CHECKPOINT_WRITE_INTERVAL"]
+            ),
+        )
+    return settings
+
+
+class CheckpointStore(object):
+    """
+    Named, JSON-serializable positions kept in one file.
+    """
+    def __init__(self, path, write_interval, reactor):
+        self._path = path
+        self._write_interval = write_interval
+        self._reactor = reactor
+        self._write_call = None
+        self._positions = self._read()
+
+    @classmethod
+    def from_settings(cls, settings, reactor):
+        return cls(
+            path=settings.path,
+            write_interval=settings.write_interval,
+            reactor=reactor,
+        )
+
+    def _read(self):
+        if not self._path.exists():
+            return {}
+        try:
+            return json.loads(self._path.getContent())
+        except ValueError:
+            Message.new(
+                system="checkpoint:corrupt", path=self._path.path,
+            ).write()
+            return {}
+
+    def get(self, name):
+        """
+        :return: The last position set for ``name`` or ``None``.
+        """
+        return self._positions.get(name)
+
+    def set(self, name, position):
+        """
+        Remember ``position`` for ``name``.  It is written out within
+        ``write_interval`` seconds.
+        """
+        if self._positions.get(name) == position:
+            return
+        self._positions[name] = position
+        if self._write_call is None:
+            self._write_call = self._reactor.callLater(
+                self._write_interval, self.write,
+            )
+
+    def write(self):
+        """
+        Write any changed positions out now.
+        """
+        if self._write_call is not None:
+            if self._write_call.active():
+                self._write_call.cancel()
+            self._write_call = None
+        try:
+            parent = self._path.parent()
+            if not parent.exists():
+                parent.makedirs()
+            temporary = self._path.temporarySibling()
+            with temporary.open("w") as f:
+                f.write(json.dumps(self._positions))
+                f.flush()
+                fsync(f.fileno())
+            rename(temporary.path, self._path.path)
+        except Exception:
+            Message.new(system="checkpoint:write-failed").write()
+            write_traceback()
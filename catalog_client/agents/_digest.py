@@ -0,0 +1,75 @@
+# Canonical content digests of JSON-compatible values.
+#
+# A digest is computed for every dict and list in a value and kept in a tree
+# mirroring the value's structure.  Comparing two values is then a matter of
+# comparing two digests, and when they differ the children's digests show
+# which branches didn't change without walking them again.
+
+from hashlib import sha256
+import json
+
+from pyrsistent import PMap, PVector
+
+_MAPPINGS = (dict, PMap)
+_SEQUENCES = (list, tuple, PVector)
+_CONTAINERS = _MAPPINGS + _SEQUENCES
+
+
+class Digests(object):
+    """
+    The digest of one dict or list and of every dict or list nested in it.
+
+    :ivar bytes digest: The digest of the whole value.
+    :ivar children: For a dict, a ``dict`` mapping keys to the ``Digests`` of
+        those values which are themselves dicts or lists.  For a list, a
+        ``dict`` mapping indexes to the same.
+    """
+    __slots__ = ("digest", "children")
+
+    def __init__(self, digest, children):
+        self.digest = digest
+        self.children = children
+
+
+_NO_CHILDREN = Digests(None, {})
+
+
+def _canonical(leaf):
+    return json.dumps(leaf)
+
+
+def digest(value):
+    """
+    Compute the ``Digests`` of ``value``.
+
+    Equal values have equal digests no matter the order of their dict keys
+    or whether their strings are ``bytes`` or ``unicode``.
+    """
+    if isinstance(value, _MAPPINGS):
+        hasher = sha256(b"{")
+        items = sorted(value.items())
+    elif isinstance(value, _SEQUENCES):
+        hasher = sha256(b"[")
+        items = enumerate(value)
+    else:
+        return Digests(sha256(b"=" + _canonical(value)).digest(), {})
+
+    children = {}
+    for key, child in items:
+        hasher.update(_canonical(key))
+        if isinstance(child, _CONTAINERS):
+            node = children[key] = digest(child)
+            hasher.update(b"#" + node.digest)
+        else:
+            hasher.update(b"=" + _canonical(child) + b",")
+    return Digests(hasher.digest(), children)
+
+
+def child_digests(digests, key):
+    """
+    Get the ``Digests`` of one child, or an empty ``Digests`` if it isn't
+    known.
+    """
+    if digests is None:
+        return _NO_CHILDREN
+    return digests.children.get(key, _NO_CHILDREN)
@@ -0,0 +1,385 @@
+# A small Docker API client which doesn't block the reactor.
+#
+# docker-py does blocking I/O, so every call made from the reactor thread
+# stalls the whole agent for as long as Docker takes to answer.  This client
+# talks HTTP over the Docker unix socket with Twisted instead.  It keeps a few
+# connections to the daemon open, runs a bounded number of requests at once
+# and gives up on any request that takes too long.  Streams which stay open,
+# like events and logs, each have a connection of their own and are read as
+# they arrive.
+
+import json
+from datetime import timedelta
+from struct import Struct
+from urllib import urlencode
+
+import treq
+from treq.client import HTTPClient
+
+from zope.interface import implementer
+
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python.filepath import FilePath
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import NOT_FOUND, OK, PotentialDataLoss
+from twisted.web.iweb import IAgentEndpointFactory
+
+from pyrsistent import PClass, field
+
+# /var/run is normally a symlink and this breaks when bind-mounting /host
+DEFAULT_SOCKET = b"/host/run/docker.sock"
+DEFAULT_API_VERSION = b"1.19"
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = timedelta(seconds=10)
+
+# Which stream a frame of a multiplexed logs stream belongs to.
+STDOUT = 1
+STDERR = 2
+# Stream type, three bytes of padding and the payload length.
+_FRAME_HEADER = Struct("!BxxxI")
+
+
+class DockerClientSettings(PClass):
+    """
+    :ivar socket: The path of the Docker daemon's unix socket.
+    :ivar concurrency: The most requests allowed in flight at once.
+    :ivar timeout: How long to wait for any one request, including reading
+        its response body.
+    """
+    socket = field(type=bytes, mandatory=True, initial=DEFAULT_SOCKET)
+    concurrency = field(type=int, mandatory=True, initial=DEFAULT_CONCURRENCY)
+    timeout = field(type=timedelta, mandatory=True, initial=DEFAULT_TIMEOUT)
+
+
+def docker_client_settings_from_environment(environ):
+    """
+    Read ``DockerClientSettings`` from ``CATALOG_DOCKER_SOCKET``,
+    ``CATALOG_DOCKER_CONCURRENCY`` and ``CATALOG_DOCKER_TIMEOUT`` (in
+    seconds).
+    """
+    settings = DockerClientSettings()
+    if "CATALOG_DOCKER_SOCKET" in environ:
+        settings = settings.set(socket=environ["CATALOG_DOCKER_SOCKET"])
+    if "CATALOG_DOCKER_CONCURRENCY" in environ:
+        settings = settings.set(
+            concurrency=int(environ["CATALOG_DOCKER_CONCURRENCY"]),
+        )
+    if "CATALOG_DOCKER_TIMEOUT" in environ:
+        settings = settings.set(
+            timeout=timedelta(
+                seconds=float(environ["CATALOG_DOCKER_TIMEOUT"]),
+            ),
+        )
+    return settings
+
+
+class DockerError(Exception):
+    """
+    The Docker daemon answered with an error.
+
+    :ivar int code: The response code.
+    :ivar bytes body: The response body.
+    """
+    def __init__(self, code, body):
+        Exception.__init__(self, code, body)
+        self.code = code
+        self.body = body
+
+
+class NotFound(DockerError):
+    """
+    The Docker daemon doesn't know about the requested object.
+    """
+
+
+@implementer(IAgentEndpointFactory)
+class _UNIXEndpointFactory(object):
+    """
+    Connect to the same unix socket no matter what the URL says.
+    """
+    def __init__(self, reactor, path):
+        self._reactor = reactor
+        self._path = path
+
+    def endpointForURI(self, uri):
+        return UNIXClientEndpoint(self._reactor, self._path)
+
+
+class _JSONStream(object):
+    """
+    Split a stream of concatenated JSON documents, which may or may not be
+    separated by whitespace, into the individual documents.
+    """
+    def __init__(self, received):
+        self._received = received
+        self._buffer = b""
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        self._buffer += data
+        while True:
+            start = len(self._buffer) - len(self._buffer.lstrip())
+            if start == len(self._buffer):
+                self._buffer = b""
+                return
+            try:
+                document, end = self._decoder.raw_decode(self._buffer, start)
+            except ValueError:
+                # Wait for the rest of the document.
+                self._buffer = self._buffer[start:]
+                return
+            self._buffer = self._buffer[end:]
+            self._received(document)
+
+
+class _FrameStream(object):
+    """
+    Split Docker's multiplexed logs stream into its frames.
+
+    Containers with a TTY don't have separate stdout and stderr so their
+    logs aren't multiplexed; everything is passed on as stdout.
+    """
+    def __init__(self, received, multiplexed=True):
+        """
+        :param received: Called with a ``list`` of ``(stream, payload)``
+            pairs for the frames completed by each chunk of data.
+        """
+        self._received = received
+        self._multiplexed = multiplexed
+        self._buffer = b""
+
+    def feed(self, data):
+        if not self._multiplexed:
+            self._received([(STDOUT, data)])
+            return
+        buffer = self._buffer + data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= _FRAME_HEADER.size:
+            stream, length = _FRAME_HEADER.unpack_from(buffer, offset)
+            start = offset + _FRAME_HEADER.size
+            if len(buffer) - start < length:
+                break
+            frames.append((stream, buffer[start:start + length]))
+            offset = start + length
+        self._buffer = buffer[offset:]
+        if frames:
+            self._received(frames)
+
+
+class _StreamProtocol(Protocol):
+    """
+    Pass a response body on as it arrives, pausing it whenever asked to.
+
+    :ivar finished: A ``Deferred`` which fires when the body ends.
+    """
+    def __init__(self, reactor, received, throttle):
+        self._reactor = reactor
+        self._received = received
+        self._throttle = throttle
+        self.finished = Deferred()
+
+    def dataReceived(self, data):
+        self._received(data)
+        if self._throttle is not None:
+            delay = self._throttle(len(data))
+            if delay > 0:
+                self.transport.pauseProducing()
+                self._reactor.callLater(delay, self.transport.resumeProducing)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+def _with_timeout(reactor, seconds, d):
+    """
+    Cancel ``d`` if it hasn't fired after ``seconds`` and fail it with
+    ``TimeoutError`` instead.
+    """
+    timed_out = []
+
+    def cancel():
+        timed_out.append(True)
+        d.cancel()
+    call = reactor.callLater(seconds, cancel)
+
+    def finished(result):
+        if call.active():
+            call.cancel()
+        elif timed_out:
+            raise TimeoutError()
+        return result
+    d.addBoth(finished)
+    return d
+
+
+class DockerClient(object):
+    """
+    Talk to the Docker API over a unix socket.
+
+    Every method returns a ``Deferred`` which fails with ``DockerError`` (or
+    ``NotFound``) if the daemon rejects the request and with ``TimeoutError``
+    if the request takes longer than the configured timeout.
+
+    :ivar FilePath socket: The daemon's socket.
+    """
+    def __init__(
+        self, reactor, settings=DockerClientSettings(),
+        version=DEFAULT_API_VERSION,
+    ):
+        self._reactor = reactor
+        self.socket = FilePath(settings.socket)
+        self._version = version
+        self._timeout = settings.timeout.total_seconds()
+        self._semaphore = DeferredSemaphore(settings.concurrency)
+        endpoints = _UNIXEndpointFactory(reactor, settings.socket)
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = settings.concurrency
+        self._client = HTTPClient(
+            Agent.usingEndpointFactory(reactor, endpoints, pool=self.pool)
+        )
+        # The events stream stays open indefinitely so keep it out of the
+        # pool.
+        self._streaming_client = HTTPClient(
+            Agent.usingEndpointFactory(
+                reactor, endpoints,
+                pool=HTTPConnectionPool(reactor, persistent=False),
+            )
+        )
+
+    def _url(self, path, **params):
+        url = b"http://docker/v{}{}".format(self._version, path)
+        if params:
+            url += b"?" + urlencode(sorted(params.items()))
+        return url
+
+    def _get(self, path, **params):
+        """
+        :return: A ``Deferred`` firing with the body of a successful
+            response.
+        """
+        return self._semaphore.run(self._request, path, params)
+
+    def _get_json(self, path, **params):
+        getting = self._get(path, **params)
+        getting.addCallback(json.loads)
+        return getting
+
+    def _request(self, path, params):
+        requesting = self._client.get(self._url(path, **params))
+
+        def read(response):
+            reading = treq.content(response)
+            reading.addCallback(lambda body: (response.code, body))
+            return reading
+        requesting.addCallback(read)
+
+        def check((code, body)):
+            if code == NOT_FOUND:
+                raise NotFound(code, body)
+            if code != OK:
+                raise DockerError(code, body)
+            return body
+        requesting.addCallback(check)
+        return _with_timeout(self._reactor, self._timeout, requesting)
+
+    def containers(self, all=False):
+        """
+        :return: A ``Deferred`` firing with a ``list`` summarizing each
+            container, newest first.
+        """
+        return self._get_json(b"/containers/json", all=int(all))
+
+    def inspect_container(self, container, decode=True):
+        """
+        :param decode: If ``False`` fire with the undecoded JSON document.
+
+        :return: A ``Deferred`` firing with the full details of ``container``.
+        """
+        path = b"/containers/{}/json".format(container)
+        if decode:
+            return self._get_json(path)
+        return self._get(path)
+
+    def version(self):
+        return self._get_json(b"/version")
+
+    def _stream(self, path, params, received, throttle=None):
+        """
+        Pass the body of a response which stays open to ``received`` as it
+        arrives.
+        """
+        requesting = _with_timeout(
+            self._reactor, self._timeout,
+            self._streaming_client.get(self._url(path, **params)),
+        )
+
+        def follow(response):
+            if response.code != OK:
+                reading = treq.content(response)
+
+                def failed(body):
+                    if response.code == NOT_FOUND:
+                        raise NotFound(response.code, body)
+                    raise DockerError(response.code, body)
+                reading.addCallback(failed)
+                return reading
+            protocol = _StreamProtocol(self._reactor, received, throttle)
+            response.deliverBody(protocol)
+            return protocol.finished
+        requesting.addCallback(follow)
+        return requesting
+
+    def events(self, received, since=None):
+        """
+        Follow the daemon's events stream.
+
+        :param received: A one-argument callable to call with each decoded
+            event as it arrives.
+        :param since: Also replay events since this POSIX time.
+
+        :return: A ``Deferred`` which fires when the stream ends.  Only
+            establishing the stream is subject to the timeout.
+        """
+        params = {}
+        if since is not None:
+            params["since"] = int(since)
+        return self._stream(
+            b"/events", params, _JSONStream(received).feed,
+        )
+
+    def logs(
+        self, container, received, since=None, multiplexed=True,
+        throttle=None,
+    ):
+        """
+        Follow a container's stdout and stderr, each line prefixed with its
+        timestamp.
+
+        :param received: A one-argument callable to call with a ``list`` of
+            ``(stream, payload)`` pairs as frames arrive, where ``stream`` is
+            ``STDOUT`` or ``STDERR``.
+        :param since: Start from this POSIX time, in whole seconds, rather
+            than from the beginning.
+        :param multiplexed: ``False`` if the container has a TTY, so its logs
+            aren't split into frames.
+        :param throttle: If given, called with the size of each chunk read
+            and returns how many seconds to wait before reading more.
+
+        :return: A ``Deferred`` which fires when the stream ends, usually
+            because the container stopped.  Only establishing the stream is
+            subject to the timeout.
+        """
+        params = dict(follow=1, stdout=1, stderr=1, timestamps=1)
+        if since is not None:
+            params["since"] = int(since)
+        return self._stream(
+            b"/containers/{}/logs".format(container), params,
+            _FrameStream(received, multiplexed).feed, throttle,
+        )
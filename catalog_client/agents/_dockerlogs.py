@@ -1,18 +1,34 @@
-import json
-from time import time
+# Follow the logs of the Flocker containers through the Docker API.
+#
+# Each container's logs are streamed over the Docker socket in the reactor,
+# one connection per container and no threads.  Lines are timestamped by
+# Docker, so when a stream ends, because the container stopped or the daemon
+# went away, it is opened again from the last line read.  Times are kept in
+# whole nanoseconds, as Docker writes them, so that lines logged within the
+# same microsecond aren't mistaken for ones already read.
+
+from calendar import timegm
+from time import strptime
 
 from twisted.python.filepath import FilePath
 from twisted.internet.defer import succeed
-from twisted.internet.task import LoopingCall, deferLater
-from twisted.internet.threads import deferToThreadPool
+from twisted.internet.task import deferLater
 from twisted.internet import reactor
 
-from eliot import Message, write_traceback
+from eliot import Message, write_failure
 
-from docker import Client
-from docker.errors import NotFound
+from ._dockerclient import DockerClient, NotFound
+from ._loglib import (
+    DEFAULT_CATCH_UP_RATE, _READ_BYTES, _CatchUp, _MultiStreamRecorder,
+    _MultiStreamCollector,
+)
 
-from ._loglib import _MultiStreamRecorder, _MultiStreamCollector
+# How long to wait before opening a container's logs again after they ended.
+REOPEN_DELAY = 5.0
+# How long to wait before looking for a container again that wasn't there.
+MISSING_DELAY = 60.0
+
+_NANOSECONDS = 10 ** 9
 
 class _DockerCollector(object):
     _COREOS_PATH = FilePath(b"/host/etc/coreos/update.conf")
@@ -21,10 +37,46 @@ class _DockerCollector(object):
         "flocker-dataset-agent", "flocker-container-agent", "flocker-control",
     }
 
+    checkpoint_name = b"docker"
+
     _log_streams = None
 
     reactor = reactor
 
+    def __init__(
+        self, docker_client=None, checkpoint=None,
+        catch_up_rate=DEFAULT_CATCH_UP_RATE, recorder=None,
+    ):
+        """
+        :param DockerClient docker_client: The client for the daemon running
+            the containers.
+        :param checkpoint: What ``checkpoint`` returned before the agent was
+            restarted, if anything.
+        :param catch_up_rate: The most bytes per second to read from each
+            container while catching up from ``checkpoint``.
+        :param _MultiStreamRecorder recorder: What to record lines with.
+        """
+        if docker_client is None:
+            docker_client = DockerClient(self.reactor)
+        self._docker_client = docker_client
+        self._checkpoint = checkpoint or {}
+        self._catch_up_rate = catch_up_rate
+        if recorder is None:
+            recorder = _MultiStreamRecorder()
+        self._recorder = recorder
+
+    def checkpoint(self):
+        """
+        :return: For each container, the time of the last line collected in
+            nanoseconds since the epoch, for resuming from after a restart.
+        """
+        if self._log_streams is None:
+            return None
+        return dict(
+            (stream.container_id, stream.since)
+            for stream in self._log_streams.log_streams
+        )
+
     def detect(self):
         # Flocker only runs in Docker on CoreOS so far.
         return succeed(self._COREOS_PATH.exists())
@@ -36,14 +88,16 @@ class _DockerCollector(object):
         return succeed(self._recorder.consume())
 
     def _start_log_streams(self):
-        recorder = _MultiStreamRecorder()
+        recorder = self._recorder
 
         log_streams = list(
             _DockerLogStream(
-                docker_client=Client(base_url=b"unix://host/var/run/docker.sock"),
+                docker_client=self._docker_client,
                 reactor=self.reactor,
                 container_id=container_name,
                 record_log=recorder.recorder(container_name),
+                since=self._checkpoint.get(container_name),
+                catch_up_rate=self._catch_up_rate,
             )
             for container_name
             in self._CONTAINER_NAMES
@@ -53,141 +107,144 @@ class _DockerCollector(object):
             recorder,
         )
 
+
+def _parse_timestamp(timestamp):
+    """
+    :param bytes timestamp: An RFC 3339 UTC time as Docker writes it, like
+        ``2015-11-02T00:00:00.123456789Z``.
+
+    :return: The time in nanoseconds since the epoch.
+    """
+    whole, _, fraction = timestamp.rstrip(b"Z").partition(b".")
+    seconds = timegm(strptime(whole, "%Y-%m-%dT%H:%M:%S"))
+    return seconds * _NANOSECONDS + int(fraction[:9].ljust(9, b"0"))
+
+
 class _DockerLogStream(object):
     """
     Collect logs from one Docker container using the Docker API.
-    """
-    loop = None
-    log_stream = None
 
-    def __init__(self, docker_client, reactor, container_id, record_log):
+    :ivar since: The time of the last line recorded, in nanoseconds since
+        the epoch.
+    """
+    def __init__(
+        self, docker_client, reactor, container_id, record_log, since=None,
+        catch_up_rate=DEFAULT_CATCH_UP_RATE,
+    ):
+        """
+        :param since: A time, in nanoseconds since the epoch, to read logs
+            from rather than from now.
+        :param catch_up_rate: The most bytes per second to read while
+            catching up from ``since``.
+        """
         self.docker_client = docker_client
         self.reactor = reactor
         self.container_id = container_id
         self.record_log = record_log
+        self._catch_up = None
+        self._started = int(reactor.seconds() * _NANOSECONDS)
+        if since is None:
+            since = self._started
+        else:
+            self._catch_up = _CatchUp(reactor, catch_up_rate)
+        self.since = since
+        # Incomplete lines, by stream.
+        self._partial = {}
+        # Whether everything logged before the container last stopped has
+        # been read.
+        self._drained = False
 
-    def _open_log_stream(self):
-        log_stream = iter(self.docker_client.logs(
-            # http://docker-py.readthedocs.org/en/1.5.0/api/#logs
-            #
-            # The stream parameter makes the logs function return a blocking
-            # generator you can iterate over to retrieve log output as it
-            # happens.
-            #
-            # timestamps (bool): Show timestamps
-            #
-            # tail (str or int): Output specified number of lines at the end of
-            # logs: "all" or number. Default "all"
-            #
-            # stdout (bool): Get STDOUT
-            #
-            # stderr (bool): Get STDERR
-            #
-            # container (str): The container to get logs from
-            #
-            # tail=1 because https://github.com/docker/docker-py/issues/845
-            stream=True, timestamps=False, tail=1,
+    def run(self):
+        """
+        Follow the container's logs until they end.
+
+        :return: A ``Deferred`` which fires when it's time to open them
+            again.
+        """
+        inspecting = self.docker_client.inspect_container(self.container_id)
+        inspecting.addCallback(self._follow)
+
+        def failed(reason):
+            if reason.check(NotFound):
+                Message.new(
+                    system="log-agent:docker-collector:open:failed",
+                    container=self.container_id,
+                    reason="not found",
+                ).write()
+            else:
+                Message.new(
+                    system="log-agent:docker-collector:open:failed",
+                    container=self.container_id,
+                ).write()
+                write_failure(reason)
+            return deferLater(self.reactor, MISSING_DELAY, lambda: None)
+        inspecting.addErrback(failed)
+        return inspecting
+
+    def _follow(self, details):
+        if details[u"State"][u"Running"]:
+            self._drained = False
+        elif self._drained:
+            return deferLater(self.reactor, REOPEN_DELAY, lambda: None)
+        else:
+            # It may have stopped before everything it logged was read, for
+            # instance while the agent wasn't running.  Its logs end at once
+            # with whatever it logged after ``since``.
+            self._drained = True
+
+        Message.new(
+            system="log-agent:docker-collector:open:succeeded",
             container=self.container_id,
-        ))
-        # Throw away one line because of the tail=1 hack.
-        next(log_stream)
-        return log_stream
-
+            since=self.since,
+        ).write()
+        self._partial = {}
+        throttle = None
+        if self._catch_up is not None:
+            throttle = self._catch_up.delay
+        following = self.docker_client.logs(
+            self.container_id, self._received,
+            # Docker only understands whole seconds.  Lines from that second
+            # which were already recorded are skipped.
+            since=self.since // _NANOSECONDS,
+            multiplexed=not details[u"Config"].get(u"Tty", False),
+            throttle=throttle,
+        )
 
-    def run(self):
-        self.loop = LoopingCall(self._next)
-        return self.loop.start(5.0, now=True)
-
-    def _next(self):
-        def maybe_open_then_iterate(log_stream):
-            if log_stream is None:
-                # Try opening the stream any time we don't already have it
-                # open.  Maybe the container we're watching went away for a
-                # minute and is going to come back.
-                try:
-                    log_stream = self._open_log_stream()
-                except NotFound:
-                    Message.new(
-                        system="log-agent:docker-collector:open:failed",
-                        container=self.container_id,
-                        reason="not found",
-                    ).write()
-                    return None
-                except:
-                    write_traceback(
-                        system="log-agent:docker-collector:open:failed",
-                        container=self.container_id,
-                    )
-                    return None
-                else:
-                    Message.new(
-                        system="log-agent:docker-collector:open:succeeded",
-                        container=self.container_id,
-                    ).write()
-
-            def get_time(logchunk):
-                try:
-                    # Hope we find an Eliot message
-                    message = json.loads(logchunk)
-                    return message["timestamp"]
-                except:
-                    # Probably was some other kind of message, hope the next one is better.
-                    return None
-
-            chunks = []
-            start_time = None
-            recent_time = time()
-            for logchunk in log_stream:
-                chunks.append(logchunk)
-                if start_time is None:
-                    start_time = get_time(logchunk)
-                now = time()
-
-                if start_time is None:
-                    if len(chunks) > 25:
-                        # Don't collect more than some chunk-count-bounded
-                        # quantity of logs if we're failing to determine a
-                        # starting timestamp.  Something may be going wrong at
-                        # a layer of the system that doesn't generate
-                        # recognizable timestamps.  If that's happening we want
-                        # to avoid an unbounded loop.
-                        break
-                else:
-                    time_passed = now - start_time
-                    if time_passed > 15:
-                        # Don't collect more than some time-bounded quantity of
-                        # logs at a time.  Nothing is reported to Firehose
-                        # until we get out of this loop and return a result.
-                        break
-
-                time_passed = now - recent_time
-                # If a long time passed getting this new message then we're
-                # probably caught up and we were blocking waiting for the
-                # container to write a new log message.  If we're caught
-                # up, we may as well send what we have now.
-                if time_passed > 1:
-                    break
-
-                # Remember when we got this message for comparison to the next time
-                recent_time = now
-
-            # XXX Think about the case where we've reached EOF on some
-            # container's logs.  This happens if the container stops.  Current
-            # behavior is probably to never notice logs when the container
-            # restarts which is probably bad.
-            return (chunks, log_stream)
-
-        d = deferToThreadPool(
-            self.reactor, self.reactor.getThreadPool(),
-            maybe_open_then_iterate, self.log_stream,
+        def ended(ignored):
+            Message.new(
+                system="log-agent:docker-collector:ended",
+                container=self.container_id,
+            ).write()
+            return deferLater(self.reactor, REOPEN_DELAY, lambda: None)
+        following.addCallback(ended)
+        return following
+
+    def _received(self, frames):
+        _READ_BYTES.inc(
+            sum(len(payload) for (_, payload) in frames), source=u"docker",
         )
-        def record_it(iterate_result):
-            if iterate_result is None:
-                # Couldn't open the log stream.  Delay future attempts by a
-                # little longer than normal.
-                return deferLater(self.reactor, 60, lambda: None)
-            log_event, self.log_stream = iterate_result
-            if log_event:
-                self.record_log(log_event)
-        d.addCallback(record_it)
-        return d
+        lines = []
+        for (stream, payload) in frames:
+            data = self._partial.pop(stream, b"") + payload
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                self._partial[stream] = data[end:]
+            for line in data[:end].splitlines(True):
+                timestamp, _, line = line.partition(b" ")
+                try:
+                    logged = _parse_timestamp(timestamp)
+                except ValueError:
+                    lines.append(line)
+                    continue
+                if logged <= self.since:
+                    continue
+                self.since = logged
+                lines.append(line)
+        if (
+            self._catch_up is not None and
+            self.since >= self._started
+        ):
+            self._catch_up.finish()
+            self._catch_up = None
+        if lines:
+            self.record_log(lines)
@@ -0,0 +1,109 @@
+# Content-Encoding for report bodies sent to Firehose.
+
+import zlib
+
+from pyrsistent import PClass, field
+
+from ._metrics import counter
+
+_BODY_BYTES = counter(
+    "catalog_agent_report_body_bytes_total",
+    "Report body bytes before (raw) and after (encoded) content encoding.",
+)
+
+IDENTITY = b"identity"
+GZIP = b"gzip"
+DEFLATE = b"deflate"
+
+DEFAULT_LEVEL = 6
+# Below this many bytes compression overhead outweighs the savings.
+DEFAULT_MINIMUM_SIZE = 1024
+
+
+def _gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _deflate(data, level):
+    # HTTP "deflate" is the zlib format, not raw deflate.
+    return zlib.compress(data, level)
+
+
+_COMPRESSORS = {
+    IDENTITY: None,
+    GZIP: _gzip,
+    DEFLATE: _deflate,
+}
+
+
+class BodyEncoding(PClass):
+    """
+    How to encode a report body.
+
+    :ivar content_encoding: One of ``identity``, ``gzip`` or ``deflate``.
+    :ivar level: The zlib compression level, 1 (fastest) to 9 (smallest).
+    :ivar minimum_size: Bodies shorter than this many bytes are sent
+        uncompressed.
+    """
+    content_encoding = field(
+        type=bytes, mandatory=True, initial=IDENTITY,
+        invariant=lambda value: (
+            value in _COMPRESSORS, "Unknown content encoding",
+        ),
+    )
+    level = field(
+        type=int, mandatory=True, initial=DEFAULT_LEVEL,
+        invariant=lambda value: (1 <= value <= 9, "Level must be 1 to 9"),
+    )
+    minimum_size = field(
+        type=int, mandatory=True, initial=DEFAULT_MINIMUM_SIZE,
+    )
+
+    def encode(self, body):
+        """
+        Compress ``body`` if it is worth it.
+
+        This may take a while for a large body so it is meant to be called
+        outside of the reactor thread.
+
+        :param bytes body: The serialized report.
+
+        :return: A two-tuple of the headers to send and the encoded body.
+        """
+        compress = _COMPRESSORS[self.content_encoding]
+        if compress is None or len(body) < self.minimum_size:
+            return {}, body
+        return (
+            {b"Content-Encoding": [self.content_encoding]},
+            compress(body, self.level),
+        )
+
+
+def record_body_sizes(raw_size, encoded_size):
+    _BODY_BYTES.inc(raw_size, stage="raw")
+    _BODY_BYTES.inc(encoded_size, stage="encoded")
+
+
+def body_encoding_from_environment(environ):
+    """
+    Read ``BodyEncoding`` from ``CATALOG_FIREHOSE_CONTENT_ENCODING``,
+    ``CATALOG_FIREHOSE_COMPRESSION_LEVEL`` and
+    ``CATALOG_FIREHOSE_COMPRESSION_MINIMUM_SIZE``.
+    """
+    encoding = BodyEncoding()
+    if "CATALOG_FIREHOSE_CONTENT_ENCODING" in environ:
+        encoding = encoding.set(
+            content_encoding=environ["CATALOG_FIREHOSE_CONTENT_ENCODING"],
+        )
+    if "CATALOG_FIREHOSE_COMPRESSION_LEVEL" in environ:
+        encoding = encoding.set(
+            level=int(environ["CATALOG_FIREHOSE_COMPRESSION_LEVEL"]),
+        )
+    if "CATALOG_FIREHOSE_COMPRESSION_MINIMUM_SIZE" in environ:
+        encoding = encoding.set(
+            minimum_size=int(
+                environ["CATALOG_FIREHOSE_COMPRESSION_MINIMUM_SIZE"]
+            ),
+        )
+    return encoding
@@ -0,0 +1,151 @@
+# Carry reports from several collectors in one request to Firehose.
+#
+# Reports made within a short window of each other are posted together to
+# /v1/firehose/envelope.  The body has the usual common fields (secret, node
+# and cluster identifiers) plus an "envelope" list.  Each entry in that list
+# is what would otherwise have been posted to /v1/firehose/<collector>, minus
+# the common fields, tagged with the collector name and a per-collector
+# sequence number.
+#
+# Each collector is told of the delivery as though it had sent only its own
+# share of the envelope so that collectors sharing an envelope don't back off
+# for each other's bytes.
+
+import json
+from datetime import timedelta
+
+from pyrsistent import PClass, field, pmap, thaw
+
+from twisted.internet.defer import Deferred
+
+from ._metricsserver import defer_to_thread_pool
+
+ENVELOPE_NAME = u"envelope"
+
+DEFAULT_WINDOW = timedelta(seconds=1.0)
+
+
+class EnvelopeSettings(PClass):
+    """
+    :ivar enabled: Whether to post reports in envelopes.
+    :ivar window: How long to wait for other collectors' reports before
+        posting an envelope.
+    """
+    enabled = field(type=bool, mandatory=True, initial=False)
+    window = field(type=timedelta, mandatory=True, initial=DEFAULT_WINDOW)
+
+
+def envelope_settings_from_environment(environ):
+    settings = EnvelopeSettings(
+        enabled=environ.get("CATALOG_FIREHOSE_ENVELOPE", "0") == "1",
+    )
+    if "CATALOG_FIREHOSE_ENVELOPE_WINDOW" in environ:
+        settings = settings.set(
+            window=timedelta(
+                seconds=float(environ["CATALOG_FIREHOSE_ENVELOPE_WINDOW"]),
+            ),
+        )
+    return settings
+
+
+class _Envelope(object):
+    """
+    Coalesce reports made within ``window`` of the first one into a single
+    post through ``reporter``.
+    """
+    def __init__(self, reactor, reporter, window):
+        self._reactor = reactor
+        self._wrapped_reporter = reporter
+        self._window = window.total_seconds()
+        self._sequences = {}
+        self._pending = []
+        self._call = None
+
+    def reporter_for(self, name):
+        """
+        :return: A reporter which sends ``name``'s reports in envelopes.
+        """
+        return _EnvelopeReporter(self, name)
+
+    def add(self, name, fields):
+        """
+        Put ``fields`` from collector ``name`` into the next envelope.
+
+        :return: A ``Deferred`` firing with the ``Delivery`` of that envelope.
+        """
+        sequence = self._sequences.get(name, 0) + 1
+        self._sequences[name] = sequence
+        entry = fields.update({u"collector": name, u"sequence": sequence})
+        delivered = Deferred()
+        self._pending.append((entry, delivered))
+        if self._call is None:
+            self._call = self._reactor.callLater(self._window, self._flush)
+        return delivered
+
+    def _flush(self):
+        self._call = None
+        pending, self._pending = self._pending, []
+        # Serializing large reports stalls the reactor so do it in a thread,
+        # as the reporter encodes them.  The reporter puts the entries in the
+        # body as they are rather than serializing them again.
+        measuring = defer_to_thread_pool(
+            self._reactor, _serialize, list(entry for (entry, _) in pending),
+        )
+
+        def measured(result):
+            entries, sizes = result
+            sending = self._wrapped_reporter.send(
+                pmap(), serialized=pmap({u"envelope": entries}),
+            )
+            sending.addCallback(_shares, sizes)
+            return sending
+        measuring.addCallback(measured)
+
+        def delivered(deliveries):
+            for ((_, waiting), delivery) in zip(pending, deliveries):
+                waiting.callback(delivery)
+
+        def failed(reason):
+            for (_, waiting) in pending:
+                waiting.errback(reason)
+
+        measuring.addCallbacks(delivered, failed)
+
+
+def _serialize(entries):
+    """
+    :return: ``entries`` serialized as a JSON list and the size of each one
+        in it.
+    """
+    serialized = list(json.dumps(thaw(entry)) for entry in entries)
+    return (
+        b"[" + b", ".join(serialized) + b"]",
+        list(len(entry) for entry in serialized),
+    )
+
+
+def _shares(delivery, sizes):
+    """
+    :return: A ``Delivery`` for each entry of an envelope with ``sizes``,
+        with the bytes sent divided between them in proportion.
+    """
+    total = float(sum(sizes)) or 1.0
+    return list(
+        delivery.set(sent_bytes=int(round(delivery.sent_bytes * size / total)))
+        for size in sizes
+    )
+
+
+class _EnvelopeReporter(object):
+    """
+    The reporter for one collector whose reports go out in envelopes.
+    """
+    def __init__(self, envelope, name):
+        self._envelope = envelope
+        self._name = name
+
+    def report(self, result):
+        return self.send(pmap({u"result": result}))
+
+    def send(self, fields):
+        return self._envelope.add(self._name, fields)
@@ -1,16 +1,64 @@
-from os import SEEK_END
+# Follow log files the way ``tail -F`` does.
+#
+# Each file is read when inotify says its directory changed rather than on a
+# timer, in large chunks up to a byte budget per wake-up, and split into lines
+# in memory.  Files which are renamed away and replaced ("create" rotation) are
+# read to the end before switching to the new file.  Files which are copied
+# and truncated in place ("copytruncate" rotation) are read again from the
+# start.  If inotify isn't available the files are polled instead.
+#
+# A stream can resume from a checkpoint of the inodes and offsets it had
+# reported up to, finding files rotated in the meantime by their inodes, and
+# then reads the backlog no faster than a catch-up rate.
 
+from functools import partial
+from os import SEEK_END, SEEK_CUR, SEEK_SET, fstat, lseek, read, stat
+
+from twisted.internet import reactor
 from twisted.internet.defer import succeed
 from twisted.python.filepath import FilePath
 from twisted.internet.task import LoopingCall
 
-from ._loglib import _MultiStreamRecorder, _MultiStreamCollector
+from eliot import Message, write_traceback
+
+from ._loglib import (
+    DEFAULT_CATCH_UP_RATE, _READ_BYTES, _CatchUp, _MultiStreamRecorder,
+    _MultiStreamCollector,
+)
+
+# The most to read from one file per wake-up before giving other work a go.
+DEFAULT_READ_BUDGET = 1024 * 1024
+_READ_SIZE = 64 * 1024
+# A "line" this long without a newline is recorded anyway.
+_MAXIMUM_LINE = 1024 * 1024
+
+# How often to look at the files if inotify isn't available.
+POLL_INTERVAL = 1.0
+# How often to look at the files anyway, in case an inotify event was lost.
+CHECK_INTERVAL = 10.0
+# How long to keep reading a file after it was rotated away, for whatever
+# its writer still had to say before switching to the new file.
+ROTATED_GRACE = 5.0
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+    _WATCH_MASK = None
+else:
+    _WATCH_MASK = (
+        inotify.IN_MODIFY | inotify.IN_CREATE | inotify.IN_MOVED_FROM |
+        inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE | inotify.IN_Q_OVERFLOW
+    )
+
 
 def _path_to_unit(path):
     # /host/var/log/flocker/flocker-dataset-agent.log -> flocker-dataset-agent
     return path.basename().split(b".")[0]
 
 class _SyslogCollector(object):
+    checkpoint_name = b"files"
+
     _LOG_PATHS = {
         # The paths we configure Flocker to log to in the upstart configuration
         # file.  See Flocker/admin/package-files/upstart/flocker-*.conf
@@ -21,9 +69,40 @@ class _SyslogCollector(object):
 
     _log_streams = None
 
+    reactor = reactor
+
+    def __init__(
+        self, checkpoint=None, catch_up_rate=DEFAULT_CATCH_UP_RATE,
+        recorder=None,
+    ):
+        """
+        :param checkpoint: What ``checkpoint`` returned before the agent was
+            restarted, if anything.
+        :param catch_up_rate: The most bytes per second to read from each
+            file while catching up from ``checkpoint``.
+        :param _MultiStreamRecorder recorder: What to record lines with.
+        """
+        self._checkpoint = checkpoint or {}
+        self._catch_up_rate = catch_up_rate
+        if recorder is None:
+            recorder = _MultiStreamRecorder()
+        self._recorder = recorder
+
     def detect(self):
         return succeed(any(path.exists() for path in self._LOG_PATHS))
 
+    def checkpoint(self):
+        """
+        :return: The position of each file up to which lines have been
+            collected, for resuming from after a restart.
+        """
+        if self._log_streams is None:
+            return None
+        return dict(
+            (stream.path.path, stream.position())
+            for stream in self._log_streams.log_streams
+        )
+
     def collect(self):
         if self._log_streams is None:
             self._log_streams, self._recorder = self._start_log_streams()
@@ -31,11 +110,16 @@ class _SyslogCollector(object):
         return succeed(self._recorder.consume())
 
     def _start_log_streams(self):
-        recorder = _MultiStreamRecorder()
+        recorder = self._recorder
+        watcher = _DirectoryWatcher(self.reactor)
         log_streams = list(
             _FileLogStream(
                 path=path,
-                record_log=recorder.recorder(_path_to_unit(path))
+                record_log=recorder.recorder(_path_to_unit(path)),
+                reactor=self.reactor,
+                watcher=watcher,
+                checkpoint=self._checkpoint.get(path.path),
+                catch_up_rate=self._catch_up_rate,
             )
             for path
             in self._LOG_PATHS
@@ -46,29 +130,318 @@ class _SyslogCollector(object):
             recorder,
         )
 
+
+class _DirectoryWatcher(object):
+    """
+    Share one inotify watch on each directory between the streams of all the
+    files in it.
+    """
+    def __init__(self, reactor):
+        self._notifier = None
+        # Directory path -> list of (file name prefix, callback)
+        self._watches = {}
+        if inotify is None:
+            return
+        try:
+            notifier = inotify.INotify(reactor)
+            notifier.startReading()
+        except Exception:
+            Message.new(system="log-agent:inotify:unavailable").write()
+            write_traceback()
+        else:
+            self._notifier = notifier
+
+    def watch(self, path, changed):
+        """
+        Call ``changed`` whenever ``path``, or a file in the same directory
+        whose name starts with ``path``'s, changes.
+
+        :return: ``True`` if the watch was set up or ``False`` if the caller
+            will have to poll instead.
+        """
+        if self._notifier is None:
+            return False
+        directory = path.parent()
+        watches = self._watches.get(directory.path)
+        if watches is None:
+            try:
+                self._notifier.watch(
+                    directory, mask=_WATCH_MASK,
+                    callbacks=[partial(self._notify, directory.path)],
+                )
+            except Exception:
+                Message.new(
+                    system="log-agent:inotify:unavailable",
+                    path=directory.path,
+                ).write()
+                write_traceback()
+                return False
+            watches = self._watches[directory.path] = []
+        watches.append((path.basename(), changed))
+        return True
+
+    def _notify(self, directory, ignored, path, mask):
+        overflowed = mask & inotify.IN_Q_OVERFLOW
+        name = path.basename()
+        for (prefix, changed) in self._watches[directory]:
+            # Rotated files are usually the name with a suffix.
+            if overflowed or name.startswith(prefix):
+                changed()
+
+
+class _OpenLog(object):
+    """
+    One open log file and whatever incomplete line was last read from it.
+
+    :ivar bool at_end: Whether the last read reached the end of the file.
+    """
+    def __init__(self, log_file):
+        self.file = log_file
+        self.partial = b""
+        self.last_read = None
+        self.at_end = False
+
+    def inode(self):
+        return fstat(self.file.fileno()).st_ino
+
+    def offset(self):
+        return lseek(self.file.fileno(), 0, SEEK_CUR)
+
+    def position(self):
+        """
+        :return: The inode and the offset of the end of the last complete
+            line read.
+        """
+        return [self.inode(), self.offset() - len(self.partial)]
+
+    def restart(self):
+        lseek(self.file.fileno(), 0, SEEK_SET)
+        self.partial = b""
+
+    def read(self, budget, now):
+        """
+        Read complete lines.
+
+        :param budget: Roughly the most bytes to read.
+
+        :return: A two-tuple of a ``list`` of lines and the number of bytes
+            read.
+        """
+        chunks = []
+        total = 0
+        self.at_end = False
+        while total < budget:
+            chunk = read(self.file.fileno(), _READ_SIZE)
+            if not chunk:
+                self.at_end = True
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        if not chunks:
+            return [], 0
+        self.last_read = now
+        _READ_BYTES.inc(total, source=u"files")
+
+        data = self.partial + b"".join(chunks)
+        end = data.rfind(b"\n") + 1
+        if end == 0 and len(data) >= _MAXIMUM_LINE:
+            data += b"\n"
+            end = len(data)
+        self.partial = data[end:]
+        if end == 0:
+            return [], total
+        lines = data[:end - 1].split(b"\n")
+        return list(line + b"\n" for line in lines), total
+
+    def close(self):
+        self.file.close()
+
+
 class _FileLogStream(object):
     """
-    Collect log lines from one file by periodically reading it.
+    Collect log lines from one file as they are written.
     """
-    def __init__(self, path, record_log):
+    loop = None
+
+    def __init__(
+        self, path, record_log, reactor=reactor, watcher=None,
+        read_budget=DEFAULT_READ_BUDGET, checkpoint=None,
+        catch_up_rate=DEFAULT_CATCH_UP_RATE,
+    ):
+        """
+        :param checkpoint: What ``position`` returned before the agent was
+            restarted, to carry on from there rather than from the end of the
+            file.
+        :param catch_up_rate: The most bytes per second to read while
+            catching up from ``checkpoint``.
+        """
+        if watcher is None:
+            watcher = _DirectoryWatcher(reactor)
         self.path = path
         self.record_log = record_log
-        self.log_file = self.path.open()
-        self.log_file.seek(0, SEEK_END)
+        self.reactor = reactor
+        self._watcher = watcher
+        self._read_budget = read_budget
+        self._reading = None
+        # Files rotated away which may still have a little more to read.
+        self._rotated = []
+        self._catch_up = None
+
+        if checkpoint:
+            self._resume(checkpoint, catch_up_rate)
+        else:
+            log_file = self.path.open()
+            log_file.seek(0, SEEK_END)
+            self._current = _OpenLog(log_file)
+
+    def _resume(self, checkpoint, catch_up_rate):
+        """
+        Open the files ``checkpoint`` describes, wherever they have been
+        rotated to, at the offsets reached.
+        """
+        candidates = {}
+        for child in self.path.parent().children():
+            if child.basename().startswith(self.path.basename()):
+                try:
+                    candidates[stat(child.path).st_ino] = child
+                except OSError:
+                    pass
+        try:
+            current_inode = stat(self.path.path).st_ino
+        except OSError:
+            # Renamed away and not replaced yet.  The newest file found is
+            # still the current one until its replacement turns up.
+            current_inode = None
+        now = self.reactor.seconds()
+        self._current = None
+        for (inode, offset) in checkpoint:
+            found = candidates.get(inode)
+            if found is None:
+                Message.new(
+                    system="log-agent:file-collector:checkpoint-lost",
+                    path=self.path.path, inode=inode,
+                ).write()
+                continue
+            open_log = _OpenLog(found.open())
+            if offset <= fstat(open_log.file.fileno()).st_size:
+                # Otherwise it was truncated; read it all again.
+                lseek(open_log.file.fileno(), offset, SEEK_SET)
+            if inode == current_inode:
+                self._current = open_log
+            else:
+                open_log.last_read = now
+                self._rotated.append(open_log)
+        if self._current is None and current_inode is None and self._rotated:
+            self._current = self._rotated.pop()
+        if self._current is None:
+            # Everything in the file now was written after the checkpoint.
+            self._current = _OpenLog(self.path.open())
+        self._catch_up = _CatchUp(self.reactor, catch_up_rate)
+
+    def position(self):
+        """
+        :return: The inodes and offsets up to which lines have been
+            recorded, of the rotated files still being read and then of the
+            current one.
+        """
+        return list(
+            open_log.position()
+            for open_log in self._rotated + [self._current]
+        )
 
     def run(self):
-        self.loop = LoopingCall(self._next, self.log_file)
-        return self.loop.start(1.0, now=True)
+        if self.loop is None:
+            if self._watcher.watch(self.path, self._wake):
+                interval = CHECK_INTERVAL
+            else:
+                interval = POLL_INTERVAL
+            self.loop = LoopingCall(self._wake)
+            self._running = self.loop.start(interval, now=True)
+        return self._running
+
+    def _wake(self):
+        # Many changes may be reported in one go.  Read once for all of them.
+        if self._reading is None:
+            self._reading = self.reactor.callLater(0, self._read)
 
-    def _next(self, log_file):
-        # Try to read more than one line per iteration but also try to avoid
-        # doing an unbounded amount of work.  100 lines is picked out of a hat.
+    def _read(self):
+        self._reading = None
+        now = self.reactor.seconds()
+        budget = self._read_budget
+        read = 0
         lines = []
-        for i in range(100):
-            line = log_file.readline()
-            if line:
-                lines.append(line)
-            else:
-                break
+        try:
+            self._check_rotation(now)
+            open_logs = self._rotated + [self._current]
+            for open_log in open_logs:
+                # Only what is read to the end in this pass may be closed.
+                open_log.at_end = False
+            # Whatever was written before the rotation comes first.
+            for open_log in open_logs:
+                more, size = open_log.read(budget, now)
+                lines.extend(more)
+                read += size
+                budget -= size
+                if budget <= 0:
+                    break
+            lines.extend(self._close_rotated(now))
+        except:
+            Message.new(
+                system="log-agent:file-collector:read-failed",
+                path=self.path.path,
+            ).write()
+            write_traceback()
         if lines:
             self.record_log(lines)
+        if budget > 0:
+            # Caught up, if it was catching up.
+            self._catch_up = None
+        elif self._catch_up is not None:
+            # Work through the backlog gradually.
+            self._reading = self.reactor.callLater(
+                self._catch_up.delay(read), self._read,
+            )
+        else:
+            # There's probably more.  Carry on after anything else that's
+            # waiting.
+            self._wake()
+
+    def _check_rotation(self, now):
+        try:
+            on_disk = stat(self.path.path)
+        except OSError:
+            # Renamed away and not replaced yet.
+            return
+        if on_disk.st_ino != self._current.inode():
+            Message.new(
+                system="log-agent:file-collector:rotated",
+                path=self.path.path,
+            ).write()
+            self._current.last_read = now
+            self._rotated.append(self._current)
+            self._current = _OpenLog(self.path.open())
+        elif on_disk.st_size < self._current.offset():
+            Message.new(
+                system="log-agent:file-collector:truncated",
+                path=self.path.path,
+            ).write()
+            self._current.restart()
+
+    def _close_rotated(self, now):
+        """
+        Stop reading rotated files which were read to the end just now and
+        have been quiet for a while.
+
+        :return: The incomplete last lines of those files, if any.
+        """
+        lines = []
+        for open_log in list(self._rotated):
+            if (
+                open_log.at_end and
+                now - open_log.last_read >= ROTATED_GRACE
+            ):
+                if open_log.partial:
+                    lines.append(open_log.partial + b"\n")
+                open_log.close()
+                self._rotated.remove(open_log)
+        return lines
@@ -0,0 +1,358 @@
+# Persistent, pooled HTTP(S) connections for talking to Firehose and to the
+# Flocker control service.
+#
+# Every agent posts a report every few seconds.  Without a dedicated pool each
+# of those posts pays for a new TCP connection and a full TLS handshake.  The
+# pieces here keep connections open between reports, offer the previous TLS
+# session on any new connection that does have to be made, and bound how many
+# requests can be in flight at once.
+
+from collections import deque
+from time import time
+
+import treq
+from treq.client import HTTPClient
+
+from OpenSSL import SSL
+
+from service_identity import VerificationError
+from service_identity.pyopenssl import verify_hostname, verify_ip_address
+
+from zope.interface import implementer
+
+from eliot import write_traceback
+
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.ssl import CertificateOptions, platformTrust
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.iweb import IPolicyForHTTPS
+
+from pyrsistent import PClass, field
+
+from ._metrics import counter, gauge
+
+_CONNECTIONS = counter(
+    "catalog_agent_http_connections_total",
+    "Connections handed out by a connection pool, by whether they were newly "
+    "opened or reused from the pool.",
+)
+_TLS_HANDSHAKES = counter(
+    "catalog_agent_tls_handshakes_total",
+    "Completed TLS handshakes, by whether a previous session was offered for "
+    "resumption.",
+)
+_TLS_HANDSHAKE_RATE = gauge(
+    "catalog_agent_tls_handshakes_per_minute",
+    "TLS handshakes completed in the last minute, by pool.",
+)
+
+# A little under the 60 second idle timeout of common load balancers so that
+# we close idle connections before the other end does.  Twisted will not
+# retry a POST that fails because a cached connection went away underneath
+# it.
+DEFAULT_IDLE_TIMEOUT = 50.0
+DEFAULT_MAX_IDLE_CONNECTIONS = 2
+DEFAULT_MAX_CONNECTIONS = 2
+
+
+class PoolSettings(PClass):
+    """
+    Limits for a persistent connection pool.
+
+    :ivar max_connections: The most requests allowed in flight at once.
+    :ivar max_idle_connections: The most idle connections kept open per host.
+    :ivar idle_timeout: Seconds an idle connection is kept open.
+    """
+    max_connections = field(
+        type=int, mandatory=True, initial=DEFAULT_MAX_CONNECTIONS,
+    )
+    max_idle_connections = field(
+        type=int, mandatory=True, initial=DEFAULT_MAX_IDLE_CONNECTIONS,
+    )
+    idle_timeout = field(
+        type=(int, float), mandatory=True, initial=DEFAULT_IDLE_TIMEOUT,
+    )
+
+
+def pool_settings_from_environment(environ, prefix, defaults=PoolSettings()):
+    """
+    Read ``PoolSettings`` from ``<prefix>_MAX_CONNECTIONS``,
+    ``<prefix>_MAX_IDLE_CONNECTIONS`` and ``<prefix>_IDLE_TIMEOUT``, falling
+    back to ``defaults``.
+    """
+    settings = defaults
+    if prefix + "_MAX_CONNECTIONS" in environ:
+        settings = settings.set(
+            max_connections=int(environ[prefix + "_MAX_CONNECTIONS"]),
+        )
+    if prefix + "_MAX_IDLE_CONNECTIONS" in environ:
+        settings = settings.set(
+            max_idle_connections=int(
+                environ[prefix + "_MAX_IDLE_CONNECTIONS"]
+            ),
+        )
+    if prefix + "_IDLE_TIMEOUT" in environ:
+        settings = settings.set(
+            idle_timeout=float(environ[prefix + "_IDLE_TIMEOUT"]),
+        )
+    return settings
+
+
+class _HandshakeRate(object):
+    """
+    Keep the handshakes per minute gauge for one pool up to date.
+    """
+    def __init__(self, name, clock=time):
+        self._name = name
+        self._clock = clock
+        self._handshakes = deque()
+
+    def handshake(self):
+        self._handshakes.append(self._clock())
+        self.update()
+
+    def update(self):
+        since = self._clock() - 60
+        while self._handshakes and self._handshakes[0] < since:
+            self._handshakes.popleft()
+        _TLS_HANDSHAKE_RATE.set(len(self._handshakes), pool=self._name)
+
+
+_HANDSHAKE_RATES = {}
+
+
+def _handshake_rate(name):
+    rate = _HANDSHAKE_RATES.get(name)
+    if rate is None:
+        rate = _HANDSHAKE_RATES[name] = _HandshakeRate(name)
+    return rate
+
+
+def _handshake_done(name, offered):
+    _TLS_HANDSHAKES.inc(pool=name, offered=offered)
+    _handshake_rate(name).handshake()
+
+
+class Delivery(PClass):
+    """
+    The outcome of one request.
+
+    :ivar response: The response.
+    :ivar bytes body: The response body.
+    :ivar int sent_bytes: The size of the request body as sent.
+    """
+    response = field(mandatory=True)
+    body = field(type=bytes, mandatory=True)
+    sent_bytes = field(type=int, mandatory=True)
+
+
+class _CountingConnectionPool(HTTPConnectionPool):
+    """
+    A persistent ``HTTPConnectionPool`` which counts how often it hands out a
+    cached connection versus opening a new one.
+    """
+    def __init__(self, reactor, name):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self._name = name
+
+    def getConnection(self, key, endpoint):
+        if self._connections.get(key):
+            _CONNECTIONS.inc(pool=self._name, state="reused")
+        else:
+            _CONNECTIONS.inc(pool=self._name, state="new")
+        # Let the handshake rate fall even when there are no handshakes.
+        _handshake_rate(self._name).update()
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+
+def _tolerate_errors(callback):
+    """
+    Wrap an OpenSSL info callback so that an exception fails the connection
+    instead of escaping into OpenSSL, which can't deal with it.
+    """
+    def info_callback(connection, where, ret):
+        try:
+            return callback(connection, where, ret)
+        except:
+            failure = Failure()
+            write_traceback()
+            connection.get_app_data().failVerification(failure)
+    return info_callback
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ResumingConnectionCreator(object):
+    """
+    Create client TLS connections from one ready-made OpenSSL context,
+    offering the session negotiated by the most recent handshake so that a
+    connection which does have to be re-established can skip the full
+    handshake.
+
+    If a hostname is given it is sent with SNI and the server's certificate
+    must be for it.  Otherwise whatever verification the context is set up
+    to do is all there is.
+    """
+    _session = None
+
+    def __init__(self, context, name, hostname=None):
+        """
+        :param OpenSSL.SSL.Context context: The context, which is this
+            creator's alone.
+        :param unicode hostname: The server's hostname, if it is to be
+            checked.
+        """
+        self._context = context
+        self._name = name
+        self._hostname = hostname
+        self._is_ip = hostname is not None and (
+            isIPAddress(hostname) or isIPv6Address(hostname)
+        )
+        context.set_info_callback(_tolerate_errors(self._info_callback))
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self._context, None)
+        connection.set_app_data(tlsProtocol)
+        if self._hostname is not None and not self._is_ip:
+            connection.set_tlsext_host_name(self._hostname.encode("idna"))
+        if self._session is not None:
+            connection.set_session(self._session)
+        return connection
+
+    def _info_callback(self, connection, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            if self._hostname is not None:
+                if self._is_ip:
+                    verify = verify_ip_address
+                else:
+                    verify = verify_hostname
+                try:
+                    verify(connection, self._hostname)
+                except VerificationError:
+                    connection.get_app_data().failVerification(Failure())
+                    return
+            _handshake_done(self._name, offered=self._session is not None)
+            self._session = connection.get_session()
+
+
+@implementer(IPolicyForHTTPS)
+class _FixedContextPolicy(object):
+    """
+    Use the same OpenSSL context, and the same remembered TLS session, for
+    every destination.  Only suitable for a client which talks to a single
+    server.
+    """
+    def __init__(self, context, name):
+        self._creator = _ResumingConnectionCreator(context, name)
+
+    def creatorForNetloc(self, hostname, port):
+        return self._creator
+
+
+@implementer(IPolicyForHTTPS)
+class _ResumingPolicyForHTTPS(object):
+    """
+    Like ``BrowserLikePolicyForHTTPS`` but with one OpenSSL context and one
+    remembered TLS session per destination instead of a new context for every
+    connection.
+    """
+    def __init__(self, name, trust_root=None):
+        self._name = name
+        self._trust_root = trust_root
+        self._creators = {}
+
+    def creatorForNetloc(self, hostname, port):
+        key = (hostname, port)
+        creator = self._creators.get(key)
+        if creator is None:
+            trust_root = self._trust_root
+            if trust_root is None:
+                trust_root = platformTrust()
+            context = CertificateOptions(trustRoot=trust_root).getContext()
+            creator = self._creators[key] = _ResumingConnectionCreator(
+                context, self._name, hostname.decode("ascii"),
+            )
+        return creator
+
+
+class PooledClient(object):
+    """
+    A minimal ``treq``-like client which sends requests over one persistent
+    connection pool and runs at most ``PoolSettings.max_connections`` of them
+    at a time.
+
+    Unlike ``treq`` the response body is always read before the result is
+    delivered so the connection can go straight back to the pool.  Requests
+    fire with a ``Delivery``.
+    """
+    def __init__(self, client, pool, concurrency):
+        self._client = client
+        self.pool = pool
+        self._semaphore = DeferredSemaphore(concurrency)
+
+    def post(self, url, data, **kwargs):
+        return self._semaphore.run(
+            self._request, b"POST", url, data=data, **kwargs
+        )
+
+    def _request(self, method, url, **kwargs):
+        requesting = self._client.request(method, url, **kwargs)
+
+        def read_body(response):
+            reading = treq.content(response)
+            reading.addCallback(
+                lambda body: Delivery(
+                    response=response,
+                    body=body,
+                    sent_bytes=len(kwargs.get("data") or b""),
+                )
+            )
+            return reading
+        requesting.addCallback(read_body)
+        return requesting
+
+
+def _pool(reactor, settings, name):
+    pool = _CountingConnectionPool(reactor, name)
+    pool.maxPersistentPerHost = settings.max_idle_connections
+    pool.cachedConnectionTimeout = settings.idle_timeout
+    return pool
+
+
+def pooled_client(reactor, settings, name):
+    """
+    Create a ``PooledClient`` which verifies HTTPS servers against the
+    platform's trust roots.
+
+    :param PoolSettings settings: Limits for the pool.
+    :param name: A label for this pool's connection and handshake counters.
+    """
+    pool = _pool(reactor, settings, name)
+    agent = Agent(
+        reactor, contextFactory=_ResumingPolicyForHTTPS(name), pool=pool,
+    )
+    return PooledClient(HTTPClient(agent), pool, settings.max_connections)
+
+
+def persistent_client(reactor, context, settings, name):
+    """
+    Create a ``treq`` ``HTTPClient`` which keeps connections open and uses
+    ``context`` for every HTTPS connection, resuming TLS sessions where it
+    can.
+
+    Only ``settings.max_idle_connections`` and ``settings.idle_timeout``
+    apply; requests aren't limited.
+
+    :param OpenSSL.SSL.Context context: The context, already set up with
+        any client certificate and trust roots.
+    :param PoolSettings settings: Limits for the pool.
+    :param name: A label for this pool's connection and handshake counters.
+    """
+    agent = Agent(
+        reactor,
+        contextFactory=_FixedContextPolicy(context, name),
+        pool=_pool(reactor, settings, name),
+    )
+    return HTTPClient(agent)
@@ -1,14 +1,36 @@
+# Read the Flocker units' logs from the host's journal.
+#
+# By default one long-lived ``journalctl --follow --output=json`` process
+# covers all of the units.  Its output is parsed as it arrives, each record is
+# routed to its unit's batch by ``_SYSTEMD_UNIT`` and the cursor of the last
+# record read is kept so a restarted process carries on where the last one
+# stopped.  That cursor is also the checkpoint a restarted agent resumes
+# from, reading the backlog no faster than a catch-up rate.  The old mode,
+# which runs ``journalctl`` once per unit on every collection, is still
+# available.  It checkpoints each unit's cursor but reads whatever backlog
+# there is in one go.
+
+import json
 from os import environ
 
+from twisted.internet import reactor
 from twisted.internet.utils import getProcessValue, getProcessOutput
-from twisted.internet.defer import DeferredList
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.protocol import ProcessProtocol
+
+from eliot import Message, write_failure, write_traceback
 
-from eliot import Message
+from ._loglib import (
+    DEFAULT_CATCH_UP_RATE, _READ_BYTES, _CatchUp, _MultiStreamRecorder,
+)
 
 _HOST_COMMAND = [
     b"/usr/sbin/chroot", b"/host",
 ]
 
+# A record this long without a newline is given up on.
+_MAXIMUM_RECORD = 16 * 1024 * 1024
+
 def _check(unit):
     command = _HOST_COMMAND + [b"/usr/bin/systemctl", b"status"] + [unit]
     Message.new(
@@ -18,16 +40,159 @@ def _check(unit):
     ).write()
     return getProcessValue(command[0], command[1:], env=environ)
 
+def _message(record):
+    """
+    :return: The ``MESSAGE`` of a journal record as UTF-8 encoded ``bytes``.
+    """
+    message = record.get(u"MESSAGE")
+    if message is None:
+        return b""
+    if isinstance(message, list):
+        # journalctl writes messages which aren't valid UTF-8 as a list of
+        # byte values.  Replace the invalid parts so that the message can
+        # still be reported as JSON.
+        return bytes(bytearray(message)).decode("utf-8", "replace").encode(
+            "utf-8",
+        )
+    return message.encode("utf-8")
+
+
+# journalctl --unit matches on these, as well as on the process' own unit, to
+# include messages about the unit from systemd and the like.
+_UNIT_FIELDS = (
+    u"_SYSTEMD_UNIT", u"UNIT", u"OBJECT_SYSTEMD_UNIT", u"COREDUMP_UNIT",
+)
+
+
+def _record_unit(record, units):
+    """
+    :return: Which of ``units`` the record is about, or ``None``.
+    """
+    for field in _UNIT_FIELDS:
+        value = record.get(field)
+        if value is not None:
+            # flocker-control.service -> flocker-control
+            unit = value.encode("utf-8").rsplit(b".", 1)[0]
+            if unit in units:
+                return unit
+    return None
+
+
+class _JournalProtocol(ProcessProtocol):
+    """
+    Parse ``journalctl --output=json`` output as it arrives.
+
+    :ivar finished: A ``Deferred`` which fires when the process exits.
+    """
+    def __init__(self, received, reactor, catch_up=None):
+        """
+        :param received: Called with a ``list`` of the records read from
+            each chunk of output.
+        :param _CatchUp catch_up: If given, limits how quickly output is read
+            until it is finished.
+        """
+        self._received = received
+        self._reactor = reactor
+        self._catch_up = catch_up
+        self._buffer = b""
+        self.finished = Deferred()
+
+    def outReceived(self, data):
+        size = len(data)
+        _READ_BYTES.inc(size, source=u"journald")
+        data = self._buffer + data
+        end = data.rfind(b"\n") + 1
+        self._buffer = data[end:]
+        if len(self._buffer) > _MAXIMUM_RECORD:
+            Message.new(
+                system="log-agent:journald-collector:record-too-long",
+                length=len(self._buffer),
+            ).write()
+            self._buffer = b""
+        records = []
+        for line in data[:end].splitlines():
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                Message.new(
+                    system="log-agent:journald-collector:bad-record",
+                ).write()
+                write_traceback()
+        if records:
+            self._received(records)
+        if self._catch_up is not None:
+            delay = self._catch_up.delay(size)
+            if delay > 0:
+                self.transport.pauseProducing()
+                self._reactor.callLater(delay, self.transport.resumeProducing)
+
+    def errReceived(self, data):
+        Message.new(
+            system="log-agent:journald-collector:stderr",
+            output=data,
+        ).write()
+
+    def processEnded(self, reason):
+        self.finished.callback(reason.value)
+
+
 class _JournaldCollector(object):
     mark = None
+    checkpoint_name = b"journald"
 
     _units = [
         b"flocker-container-agent",
         b"flocker-dataset-agent",
         b"flocker-control",
     ]
-    def __init__(self):
+
+    def __init__(
+        self, follow=True, checkpoint=None,
+        catch_up_rate=DEFAULT_CATCH_UP_RATE, recorder=None,
+        reactor=reactor,
+    ):
+        """
+        :param bool follow: Read the journal with one long-lived
+            ``journalctl --follow`` rather than running ``journalctl`` for
+            each unit on every collection.
+        :param checkpoint: What ``checkpoint`` returned before the agent was
+            restarted, if anything.
+        :param catch_up_rate: The most bytes per second to read while
+            catching up from ``checkpoint``.
+        :param _MultiStreamRecorder recorder: What to record lines with.
+        """
+        self.follow = follow
+        self.reactor = reactor
         self.cursors = {}
+        # The cursor of the last record read by the follower, from any unit.
+        self.cursor = None
+        self._catch_up = None
+        if checkpoint is not None:
+            self._resume(checkpoint, catch_up_rate)
+        self._following = False
+        if recorder is None:
+            recorder = _MultiStreamRecorder()
+        self._recorder = recorder
+
+    def _resume(self, checkpoint, catch_up_rate):
+        if self.follow == isinstance(checkpoint, dict):
+            # Written in the other mode.  Start from the end.
+            Message.new(
+                system="log-agent:journald-collector:checkpoint-ignored",
+                follow=self.follow,
+            ).write()
+        elif self.follow:
+            self.cursor = checkpoint.encode("ascii")
+            self._catch_up = _CatchUp(self.reactor, catch_up_rate)
+            # Records logged after this are live, not backlog.
+            self._resumed = int(self.reactor.seconds() * 1000000)
+        else:
+            self.cursors = dict(
+                (unit.encode("ascii"), cursor.encode("ascii"))
+                for (unit, cursor) in checkpoint.items()
+            )
 
     def detect(self):
         checking = _check(b"flocker-dataset-agent")
@@ -54,20 +219,41 @@ class _JournaldCollector(object):
 
         return checking
 
+    def checkpoint(self):
+        """
+        :return: The cursor of the last record collected or, if not
+            following, of the last record collected from each unit, for
+            resuming from after a restart.
+        """
+        if not self.follow:
+            cursors = dict(
+                (unit.decode("ascii"), cursor.decode("ascii"))
+                for (unit, cursor) in self.cursors.items()
+                if cursor is not None
+            )
+            return cursors or None
+        if self.cursor is None:
+            return None
+        return self.cursor.decode("ascii")
+
     def collect(self):
+        if self.follow:
+            if not self._following:
+                self._start_following()
+            return succeed(self._recorder.consume())
+
         reading_journals = DeferredList(list(
             self._read_journal(unit, self.cursors.get(unit))
             for unit in self._units
         ))
 
         def check_results(read_results, units):
-            combined_results = {}
             for (unit, (success, result)) in zip(units, read_results):
                 if success and result is not None:
                     journal, cursor = result
-                    combined_results[unit] = journal
+                    self._recorder.recorder(unit)(journal)
                     self.cursors[unit] = cursor
-            return combined_results
+            return self._recorder.consume()
 
         reading_journals.addCallback(check_results, self._units)
         return reading_journals
@@ -88,6 +274,7 @@ class _JournaldCollector(object):
         reading = read_journal(unit, cursor)
 
         def split_cursor(journal):
+            _READ_BYTES.inc(len(journal), source=u"journald")
             # -- cursor: s=91bc(...)0984
             lines = journal.splitlines()
 
@@ -107,3 +294,60 @@ class _JournaldCollector(object):
             return (lines, cursor)
         saving = reading.addCallback(split_cursor)
         return saving
+
+    def _start_following(self):
+        command = _HOST_COMMAND + [
+            b"/usr/bin/journalctl", b"--follow", b"--output", b"json",
+        ]
+        for unit in self._units:
+            command.extend([b"--unit", unit])
+        if self.cursor is None:
+            command.extend([b"--lines", b"0"])
+        else:
+            command.extend([b"--after-cursor", self.cursor])
+        Message.new(
+            system="log-agent:journald-collector:following",
+            command=command,
+        ).write()
+
+        protocol = _JournalProtocol(
+            self._received, self.reactor, self._catch_up,
+        )
+        self._following = True
+        try:
+            self.reactor.spawnProcess(
+                protocol, command[0], command, env=environ,
+            )
+        except Exception:
+            self._following = False
+            raise
+        following = protocol.finished
+        following.addCallback(self._stopped_following)
+        following.addErrback(write_failure)
+
+    def _received(self, records):
+        batches = {}
+        for record in records:
+            unit = _record_unit(record, self._units)
+            cursor = record.get(u"__CURSOR")
+            if cursor is not None:
+                self.cursor = cursor.encode("ascii")
+                if unit is not None:
+                    self.cursors[unit] = self.cursor
+            if unit is not None:
+                batches.setdefault(unit, []).append(_message(record))
+        for (unit, lines) in batches.items():
+            self._recorder.recorder(unit)(lines)
+        if self._catch_up is not None and int(
+            records[-1].get(u"__REALTIME_TIMESTAMP", self._resumed)
+        ) >= self._resumed:
+            self._catch_up.finish()
+            self._catch_up = None
+
+    def _stopped_following(self, reason):
+        # Start it again, after the last record read, on the next collection.
+        Message.new(
+            system="log-agent:journald-collector:stopped",
+            reason=str(reason),
+        ).write()
+        self._following = False
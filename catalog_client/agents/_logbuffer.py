@@ -0,0 +1,321 @@
+# Hold each stream's log lines until they are collected, within limits.
+#
+# Lines are kept compactly: each batch recorded is joined into one string with
+# an array of where each line ends, rather than a Python string per line.  A
+# stream's buffer is capped both in bytes and in lines.  When a unit logs more
+# than that before the next collection, either the oldest lines make way for
+# the new ones or the new ones are dropped, and the next report says how many
+# were lost.
+#
+# Lines are normally collected on the agent's schedule, but a stream asks to
+# be collected early once enough bytes are waiting or as soon as a line at a
+# high enough level arrives.  However much is waiting, one collection takes at
+# most a batch's worth of bytes and leaves the rest for the next.
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from pyrsistent import PClass, field
+
+from ._logfilter import ERROR, _list
+from ._metrics import counter, gauge
+
+DROP_OLDEST = u"oldest"
+DROP_NEWEST = u"newest"
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_LINES = 50000
+DEFAULT_FLUSH_BYTES = 256 * 1024
+DEFAULT_FLUSH_LEVELS = (ERROR,)
+DEFAULT_BATCH_BYTES = 1024 * 1024
+
+_BUFFERED_BYTES = gauge(
+    "catalog_agent_log_buffer_bytes",
+    "Bytes of log lines waiting to be collected, by unit.",
+)
+_BUFFERED_LINES = gauge(
+    "catalog_agent_log_buffer_lines",
+    "Log lines waiting to be collected, by unit.",
+)
+_OVERFLOWED = counter(
+    "catalog_agent_log_buffer_overflowed_lines_total",
+    "Log lines thrown away because their unit's buffer was full.",
+)
+
+
+class LogBufferSettings(PClass):
+    """
+    :ivar max_bytes: The most bytes of lines to hold for each stream.
+    :ivar max_lines: The most lines to hold for each stream.
+    :ivar drop: Which lines to throw away when a buffer is full:
+        ``DROP_OLDEST`` or ``DROP_NEWEST``.
+    """
+    max_bytes = field(type=int, mandatory=True, initial=DEFAULT_MAX_BYTES)
+    max_lines = field(type=int, mandatory=True, initial=DEFAULT_MAX_LINES)
+    drop = field(
+        type=unicode, mandatory=True, initial=DROP_OLDEST,
+        invariant=lambda drop: (
+            drop in (DROP_OLDEST, DROP_NEWEST),
+            "drop must be {!r} or {!r}".format(DROP_OLDEST, DROP_NEWEST),
+        ),
+    )
+
+
+def log_buffer_settings_from_environment(environ):
+    """
+    Read ``LogBufferSettings`` from ``CATALOG_LOG_BUFFER_BYTES``,
+    ``CATALOG_LOG_BUFFER_LINES`` and ``CATALOG_LOG_BUFFER_DROP`` (``oldest``
+    or ``newest``).
+    """
+    settings = LogBufferSettings()
+    if "CATALOG_LOG_BUFFER_BYTES" in environ:
+        settings = settings.set(
+            max_bytes=int(environ["CATALOG_LOG_BUFFER_BYTES"]),
+        )
+    if "CATALOG_LOG_BUFFER_LINES" in environ:
+        settings = settings.set(
+            max_lines=int(environ["CATALOG_LOG_BUFFER_LINES"]),
+        )
+    if "CATALOG_LOG_BUFFER_DROP" in environ:
+        settings = settings.set(
+            drop=environ["CATALOG_LOG_BUFFER_DROP"].decode("ascii"),
+        )
+    return settings
+
+
+class LogFlushSettings(PClass):
+    """
+    :ivar flush_bytes: Ask to be collected early once this many bytes of
+        lines are waiting.
+    :ivar flush_levels: Ask to be collected early when a line at one of
+        these levels arrives.
+    :ivar batch_bytes: The most bytes of lines to take in one collection.
+    """
+    flush_bytes = field(
+        type=int, mandatory=True, initial=DEFAULT_FLUSH_BYTES,
+    )
+    flush_levels = field(
+        type=tuple, mandatory=True, initial=DEFAULT_FLUSH_LEVELS,
+    )
+    batch_bytes = field(
+        type=int, mandatory=True, initial=DEFAULT_BATCH_BYTES,
+    )
+
+
+def log_flush_settings_from_environment(environ):
+    """
+    Read ``LogFlushSettings`` from ``CATALOG_LOG_FLUSH_BYTES``,
+    ``CATALOG_LOG_FLUSH_LEVELS`` (a comma separated list) and
+    ``CATALOG_LOG_BATCH_BYTES``.
+    """
+    settings = LogFlushSettings()
+    if "CATALOG_LOG_FLUSH_BYTES" in environ:
+        settings = settings.set(
+            flush_bytes=int(environ["CATALOG_LOG_FLUSH_BYTES"]),
+        )
+    if "CATALOG_LOG_FLUSH_LEVELS" in environ:
+        settings = settings.set(
+            flush_levels=_list(environ["CATALOG_LOG_FLUSH_LEVELS"]),
+        )
+    if "CATALOG_LOG_BATCH_BYTES" in environ:
+        settings = settings.set(
+            batch_bytes=int(environ["CATALOG_LOG_BATCH_BYTES"]),
+        )
+    return settings
+
+
+class _Chunk(object):
+    """
+    Some lines recorded together.
+
+    :ivar bytes data: The lines, one after another.
+    :ivar ends: Where in ``data`` each line ends.
+    :ivar int start: How many of the lines have been taken.
+    :ivar float written: When the oldest of the lines was logged.
+    """
+    __slots__ = ("data", "ends", "start", "written")
+
+    def __init__(self, lines, written):
+        self.written = written
+        self.data = b"".join(lines)
+        self.ends = array("L")
+        end = 0
+        for line in lines:
+            end += len(line)
+            self.ends.append(end)
+        self.start = 0
+
+    def offset(self):
+        if self.start == 0:
+            return 0
+        return self.ends[self.start - 1]
+
+    def size(self):
+        return len(self.data) - self.offset()
+
+    def count(self):
+        return len(self.ends) - self.start
+
+    def take(self, max_bytes):
+        """
+        Remove lines from the front: at least one and otherwise as many as
+        fit in ``max_bytes``.
+
+        :return: A ``list`` of them.
+        """
+        offset = self.offset()
+        stop = max(
+            self.start + 1,
+            bisect_right(self.ends, offset + max_bytes, self.start),
+        )
+        data = self.data
+        lines = []
+        for end in self.ends[self.start:stop]:
+            lines.append(data[offset:end])
+            offset = end
+        self.start = stop
+        return lines
+
+    def drop(self, start):
+        """
+        Throw away the lines before ``start`` and the memory they use.
+        """
+        offset = self.ends[start - 1]
+        self.data = self.data[offset:]
+        self.ends = array("L", (end - offset for end in self.ends[start:]))
+        self.start = 0
+
+
+class _StreamBuffer(object):
+    """
+    The lines recorded from one stream since it was last collected.
+
+    :ivar int size: Bytes of lines held.
+    :ivar int count: Lines held.
+    :ivar int overflowed: Lines thrown away since the last collection.
+    :ivar int overflowed_bytes: Bytes of them.
+    """
+    def __init__(self, unit, settings):
+        self._unit = unit
+        self._max_bytes = settings.max_bytes
+        self._max_lines = settings.max_lines
+        self._drop_oldest = settings.drop == DROP_OLDEST
+        self._chunks = deque()
+        self.size = 0
+        self.count = 0
+        self.overflowed = 0
+        self.overflowed_bytes = 0
+
+    def append(self, lines, written):
+        """
+        :param lines: Lines just recorded.
+        :param written: When the oldest of them was logged.
+        """
+        if not self._drop_oldest:
+            lines = self._fitting(lines)
+        if lines:
+            chunk = _Chunk(lines, written)
+            self._chunks.append(chunk)
+            self.size += chunk.size()
+            self.count += chunk.count()
+            if self._drop_oldest:
+                self._trim()
+        self._update_gauges()
+
+    def _overflow(self, count, size):
+        self.overflowed += count
+        self.overflowed_bytes += int(size)
+        _OVERFLOWED.inc(count, unit=self._unit)
+
+    def _fitting(self, lines):
+        """
+        :return: As many of ``lines`` as fit, from the start.
+        """
+        room = self._max_bytes - self.size
+        fitting = min(len(lines), max(0, self._max_lines - self.count))
+        for (index, line) in enumerate(lines[:fitting]):
+            room -= len(line)
+            if room < 0:
+                fitting = index
+                break
+        if fitting < len(lines):
+            self._overflow(
+                len(lines) - fitting, sum(map(len, lines[fitting:])),
+            )
+        return lines[:fitting]
+
+    def _trim(self):
+        """
+        Throw away the oldest lines until the buffer is within its limits.
+        """
+        while self.size > self._max_bytes or self.count > self._max_lines:
+            chunk = self._chunks[0]
+            excess_bytes = self.size - self._max_bytes
+            excess_lines = self.count - self._max_lines
+            if chunk.size() <= excess_bytes or chunk.count() <= excess_lines:
+                # All of it has to go.
+                self._chunks.popleft()
+                self.size -= chunk.size()
+                self.count -= chunk.count()
+                self._overflow(chunk.count(), chunk.size())
+                continue
+            # Drop just enough lines from the front of it.
+            offset = chunk.offset()
+            dropping = max(0, excess_lines)
+            if excess_bytes > 0:
+                # The first line ending at least excess_bytes in goes too.
+                last = bisect_left(
+                    chunk.ends, offset + excess_bytes, chunk.start,
+                )
+                dropping = max(dropping, last - chunk.start + 1)
+            start = chunk.start + dropping
+            dropped_bytes = chunk.ends[start - 1] - offset
+            dropped_lines = start - chunk.start
+            chunk.drop(start)
+            self.size -= dropped_bytes
+            self.count -= dropped_lines
+            self._overflow(dropped_lines, dropped_bytes)
+
+    def take(self, max_bytes):
+        """
+        Remove the oldest lines held: at least one, if there are any, and
+        otherwise as many as fit in ``max_bytes``.
+
+        :return: A ``list`` of the lines and a ``list`` of ``(written,
+            count)`` pairs saying when they were logged.
+        """
+        lines = []
+        written = []
+        while self._chunks and (not lines or max_bytes > 0):
+            chunk = self._chunks[0]
+            size = chunk.size()
+            taken = chunk.take(max_bytes)
+            if not chunk.count():
+                self._chunks.popleft()
+            taken_bytes = size - chunk.size()
+            max_bytes -= taken_bytes
+            self.size -= taken_bytes
+            self.count -= len(taken)
+            lines.extend(taken)
+            written.append((chunk.written, len(taken)))
+        self._update_gauges()
+        return lines, written
+
+    def markers(self):
+        """
+        :return: A ``list`` with a marker for any lines thrown away since the
+            last time, and forget about them.
+        """
+        if not self.overflowed:
+            return []
+        marker = {
+            u"overflowed": self.overflowed,
+            u"overflowed_bytes": self.overflowed_bytes,
+        }
+        self.overflowed = self.overflowed_bytes = 0
+        return [marker]
+
+    def _update_gauges(self):
+        _BUFFERED_BYTES.set(self.size, unit=self._unit)
+        _BUFFERED_LINES.set(self.count, unit=self._unit)
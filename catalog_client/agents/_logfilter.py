@@ -0,0 +1,228 @@
+# Parse log lines once and decide which are worth reporting.
+#
+# Flocker logs Eliot messages, one JSON document per line.  Each line is
+# parsed as it is read, from whichever source, and the few fields needed to
+# filter and summarize it are pulled out: when it was logged, the task it is
+# part of, its action or message type, the action's status and a level.  Lines
+# which aren't JSON are kept as they are, with a level guessed from their
+# text.
+#
+# Rules drop lines by type (shell-style patterns like
+# "flocker:agent:converge*") or by level, unless a keep rule matches them too.
+# By default the routine chatter of the agents' convergence loop is dropped
+# unless something went wrong.
+
+from fnmatch import fnmatchcase
+import json
+import re
+
+from pyrsistent import PClass, field
+
+from ._metrics import counter
+
+ERROR = u"error"
+WARNING = u"warning"
+INFO = u"info"
+DEBUG = u"debug"
+
+LEVELS = (DEBUG, INFO, WARNING, ERROR)
+
+# Eliot messages which are about something having gone wrong.
+_ERROR_TYPES = {u"eliot:traceback", u"eliot:destination_failure"}
+
+# Flocker's agents log these on every iteration of their convergence loops,
+# several times a second.
+DEFAULT_DROP_TYPES = (
+    u"flocker:agent:converge*",
+    u"flocker:agent:discovery*",
+    u"flocker:agent:send_to_control_service*",
+)
+DEFAULT_KEEP_LEVELS = (ERROR, WARNING)
+
+# Like the level names Python's logging and most other loggers use.
+_PLAIN_LEVEL = re.compile(
+    br"\b(CRITICAL|FATAL|ERROR|ERR|WARNING|WARN|INFO|DEBUG|TRACE)\b",
+    re.IGNORECASE,
+)
+_PLAIN_LEVELS = {
+    b"critical": ERROR, b"fatal": ERROR, b"error": ERROR, b"err": ERROR,
+    b"warning": WARNING, b"warn": WARNING,
+    b"info": INFO,
+    b"debug": DEBUG, b"trace": DEBUG,
+}
+# Only look for a level near the start of a plain line.
+_PLAIN_LEVEL_SEARCH = 100
+
+_MAXIMUM_REMEMBERED_TYPES = 1024
+
+_LINES = counter(
+    "catalog_agent_log_lines_total",
+    "Log lines read, by unit and whether they were kept or dropped.",
+)
+
+
+class LogRecord(object):
+    """
+    One log line and what was learned from parsing it.
+
+    :ivar bytes line: The line as it was read.
+    :ivar timestamp: When it was logged, in seconds since the epoch, if it
+        said.
+    :ivar task_uuid: The Eliot task it is part of, if any.
+    :ivar type: Its Eliot action or message type, if any.
+    :ivar status: Its Eliot action status, if any.
+    :ivar level: One of ``LEVELS``.
+    """
+    __slots__ = (
+        "line", "timestamp", "task_uuid", "type", "status", "level",
+    )
+
+    def __init__(
+        self, line, timestamp=None, task_uuid=None, type=None, status=None,
+        level=INFO,
+    ):
+        self.line = line
+        self.timestamp = timestamp
+        self.task_uuid = task_uuid
+        self.type = type
+        self.status = status
+        self.level = level
+
+
+def _plain_level(line):
+    match = _PLAIN_LEVEL.search(line, 0, _PLAIN_LEVEL_SEARCH)
+    if match is None:
+        return INFO
+    return _PLAIN_LEVELS[match.group(1).lower()]
+
+
+def parse(line):
+    """
+    :param bytes line: A log line.
+
+    :return: A ``LogRecord`` for it.
+    """
+    if not line.lstrip().startswith(b"{"):
+        return LogRecord(line, level=_plain_level(line))
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return LogRecord(line, level=_plain_level(line))
+    if not isinstance(message, dict):
+        return LogRecord(line, level=_plain_level(line))
+
+    status = message.get(u"action_status")
+    type = message.get(u"action_type")
+    if type is None:
+        type = message.get(u"message_type")
+    if (
+        status == u"failed" or type in _ERROR_TYPES or
+        # Twisted's log.err, through Eliot's Twisted log bridge.
+        message.get(u"error") is True
+    ):
+        level = ERROR
+    else:
+        level = INFO
+    timestamp = message.get(u"timestamp")
+    if not isinstance(timestamp, (int, long, float)):
+        timestamp = None
+    return LogRecord(
+        line, timestamp=timestamp, task_uuid=message.get(u"task_uuid"),
+        type=type, status=status, level=level,
+    )
+
+
+class LogFilterSettings(PClass):
+    """
+    :ivar drop_types: Patterns of Eliot types to drop.
+    :ivar drop_levels: Levels to drop.
+    :ivar keep_types: Patterns of Eliot types to keep even if a drop rule
+        matches.
+    :ivar keep_levels: Levels to keep even if a drop rule matches.
+    """
+    drop_types = field(
+        type=tuple, mandatory=True, initial=DEFAULT_DROP_TYPES,
+    )
+    drop_levels = field(type=tuple, mandatory=True, initial=(DEBUG,))
+    keep_types = field(type=tuple, mandatory=True, initial=())
+    keep_levels = field(
+        type=tuple, mandatory=True, initial=DEFAULT_KEEP_LEVELS,
+    )
+
+
+def _list(value):
+    return tuple(
+        item.strip().decode("utf-8") for item in value.split(b",")
+        if item.strip()
+    )
+
+
+def log_filter_settings_from_environment(environ):
+    """
+    Read ``LogFilterSettings`` from ``CATALOG_LOG_DROP_TYPES``,
+    ``CATALOG_LOG_DROP_LEVELS``, ``CATALOG_LOG_KEEP_TYPES`` and
+    ``CATALOG_LOG_KEEP_LEVELS``, each a comma separated list.
+    """
+    settings = LogFilterSettings()
+    for name in ("drop_types", "drop_levels", "keep_types", "keep_levels"):
+        variable = "CATALOG_LOG_" + name.upper()
+        if variable in environ:
+            settings = settings.set(name, _list(environ[variable]))
+    return settings
+
+
+def _matches(patterns, value):
+    return value is not None and any(
+        fnmatchcase(value, pattern) for pattern in patterns
+    )
+
+
+class LogFilter(object):
+    """
+    Parse log lines and drop the ones the rules say to.
+    """
+    def __init__(self, settings=LogFilterSettings()):
+        self._settings = settings
+        # Types repeat a great deal so remember the verdict for each.
+        self._dropped_types = {}
+
+    @classmethod
+    def keep_everything(cls):
+        return cls(LogFilterSettings(drop_types=(), drop_levels=()))
+
+    def _type_dropped(self, type):
+        dropped = self._dropped_types.get(type)
+        if dropped is None:
+            if len(self._dropped_types) >= _MAXIMUM_REMEMBERED_TYPES:
+                self._dropped_types.clear()
+            dropped = self._dropped_types[type] = (
+                _matches(self._settings.drop_types, type) and
+                not _matches(self._settings.keep_types, type)
+            )
+        return dropped
+
+    def _kept(self, record):
+        if record.level in self._settings.keep_levels:
+            return True
+        if record.level in self._settings.drop_levels:
+            return _matches(self._settings.keep_types, record.type)
+        return not self._type_dropped(record.type)
+
+    def records(self, unit, lines):
+        """
+        :param unit: Which unit ``lines`` were logged by.
+        :param lines: Log lines, as ``bytes``.
+
+        :return: A ``list`` of a ``LogRecord`` for each line which is kept.
+        """
+        records = list(
+            record for record in (parse(line) for line in lines)
+            if self._kept(record)
+        )
+        if records:
+            _LINES.inc(len(records), unit=unit, outcome=u"kept")
+        if len(records) < len(lines):
+            _LINES.inc(
+                len(lines) - len(records), unit=unit, outcome=u"dropped",
+            )
+        return records
@@ -1,9 +1,81 @@
 from functools import partial
 
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 
 from eliot import write_failure
 
+from ._logbuffer import LogBufferSettings, LogFlushSettings, _StreamBuffer
+from ._logfilter import LogFilter
+from ._metrics import counter, histogram
+
+# How quickly, in bytes per second, a stream resumed from a checkpoint may
+# read whatever was logged while the agent wasn't running.
+DEFAULT_CATCH_UP_RATE = 1024 * 1024
+
+_READ_BYTES = counter(
+    "catalog_agent_log_read_bytes_total",
+    "Bytes of logs read, by source.",
+)
+_UPLOAD_LATENCY = histogram(
+    "catalog_agent_log_upload_latency_seconds",
+    "Time from a log line being logged to Firehose accepting it.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0),
+)
+
+
+class _CatchUp(object):
+    """
+    Limit the average rate at which a stream reads its backlog until it has
+    caught up.
+
+    :ivar done: Whether the stream has caught up.
+    """
+    def __init__(self, reactor, rate):
+        self._reactor = reactor
+        self._rate = float(rate)
+        self._started = reactor.seconds()
+        self._read = 0
+        self.done = False
+
+    def delay(self, size):
+        """
+        Account for ``size`` more bytes read.
+
+        :return: How many seconds to wait before reading more.
+        """
+        if self.done:
+            return 0
+        self._read += size
+        elapsed = self._reactor.seconds() - self._started
+        return max(0, self._read / self._rate - elapsed)
+
+    def finish(self):
+        self.done = True
+
+
+def _utf8(line):
+    """
+    :return: ``line`` with anything which isn't valid UTF-8 replaced, so
+        that it can always be encoded as JSON.
+    """
+    try:
+        line.decode("utf-8")
+    except UnicodeDecodeError:
+        return line.decode("utf-8", "replace").encode("utf-8")
+    return line
+
+
+def record_upload_latency(written, now):
+    """
+    Some lines have just been uploaded.
+
+    :param written: When they were logged, as ``(written, count)`` pairs.
+    :param now: The current time.
+    """
+    for (logged, count) in written:
+        _UPLOAD_LATENCY.observe(max(0, now - logged), count)
+
 
 class _MultiStreamCollector(object):
     def __init__(self, log_streams):
@@ -25,18 +97,130 @@ class _MultiStreamCollector(object):
 
 
 class _MultiStreamRecorder(object):
-    def __init__(self):
-        self._logs = {}
+    """
+    Keep the log lines read from several streams until they are collected.
+
+    Lines are parsed, filtered and throttled as they are recorded, so those
+    which are dropped are never kept at all, and then held in a bounded
+    buffer for each stream.  Each stream's collected lines are followed by
+    markers for any lines which were collapsed or dropped.
+
+    Each collection takes at most a batch's worth of lines, shared between
+    the streams.
+    """
+    def __init__(
+        self, log_filter=None, log_throttle=None,
+        buffer_settings=LogBufferSettings(),
+        flush_settings=LogFlushSettings(), flush=None, reactor=reactor,
+    ):
+        """
+        :param LogFilter log_filter: What to parse and filter lines with.  By
+            default everything is kept.
+        :param LogThrottle log_throttle: What to collapse repeated lines and
+            limit the rate of lines with, if anything.
+        :param LogBufferSettings buffer_settings: How much to hold for each
+            stream.
+        :param LogFlushSettings flush_settings: When to ask to be collected
+            early and how much to take at once.
+        :param flush: A no-argument callable to ask to be collected early
+            with, if anything.
+        """
+        if log_filter is None:
+            log_filter = LogFilter.keep_everything()
+        self._log_filter = log_filter
+        self._log_throttle = log_throttle
+        self._buffer_settings = buffer_settings
+        self._flush_settings = flush_settings
+        self._flush = flush
+        self._reactor = reactor
+        self._buffers = {}
+        # Bytes held in all of the buffers.
+        self.size = 0
+        self._flush_requested = False
+        # When the lines collected last were logged, as (written, count)
+        # pairs.
+        self.written = []
 
     def recorder(self, key):
         return partial(self._record_log, key)
 
     def consume(self):
-        result = self._logs
-        self._logs = {}
+        self._flush_requested = False
+        taken = {}
+        written = []
+
+        def take(key, buffer, max_bytes):
+            before = buffer.size
+            lines, lines_written = buffer.take(max_bytes)
+            self.size -= before - buffer.size
+            taken.setdefault(key, []).extend(lines)
+            written.extend(lines_written)
+            return before - buffer.size
+
+        # Give each stream a fair share of the batch first and then give
+        # whatever they left to whichever still have more.
+        budget = self._flush_settings.batch_bytes
+        waiting = list(
+            (key, buffer) for (key, buffer) in self._buffers.items()
+            if buffer.count
+        )
+        if waiting:
+            share = max(1, budget // len(waiting))
+            for (key, buffer) in waiting:
+                budget -= take(key, buffer, share)
+            for (key, buffer) in waiting:
+                if budget <= 0:
+                    break
+                if buffer.count:
+                    budget -= take(key, buffer, budget)
+        self.written = written
+
+        result = {}
+        for (key, buffer) in self._buffers.items():
+            entries = taken.get(key, []) + buffer.markers()
+            if entries:
+                result[key] = entries
+        if self._log_throttle is not None:
+            for (key, markers) in self._log_throttle.markers().items():
+                result.setdefault(key, []).extend(markers)
+        if self.size and self._flush is not None:
+            # There is more than fit in one batch.
+            self._request_flush()
         return result
 
+    def _request_flush(self):
+        self._flush_requested = True
+        self._flush()
+
+    def _should_flush(self, records):
+        if self._flush is None or self._flush_requested:
+            return False
+        if self.size >= self._flush_settings.flush_bytes:
+            return True
+        levels = self._flush_settings.flush_levels
+        return any(record.level in levels for record in records)
+
     def _record_log(self, key, log_event):
         if not isinstance(log_event, list):
             raise Exception("Log event isn't a list: {}".format(log_event))
-        self._logs.setdefault(key, []).extend(log_event)
+        log_event = list(_utf8(line) for line in log_event)
+        records = self._log_filter.records(key, log_event)
+        if records and self._log_throttle is not None:
+            records = self._log_throttle.records(key, records)
+        if records:
+            # Lines which say when they were logged are timed from then and
+            # the others from now.  The first is the oldest.
+            now = self._reactor.seconds()
+            written = records[0].timestamp
+            if written is None or written > now:
+                written = now
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = _StreamBuffer(
+                    key, self._buffer_settings,
+                )
+            before = buffer.size
+            buffer.append(list(record.line for record in records), written)
+            self.size += buffer.size - before
+            if self._should_flush(records):
+                self._request_flush()
@@ -0,0 +1,251 @@
+# Keep a noisy unit from flooding the reports.
+#
+# A unit stuck in a loop on some error tends to log the same message over and
+# over.  The first time a message is seen it is kept; copies of it seen within
+# the repeat window after that are only counted, and reported as one marker
+# with the count and the times of the first and last copies.  Messages count
+# as copies if they differ only in their Eliot timestamp, task_uuid and
+# task_level or, for plain lines, only in their digits.
+#
+# After that a token bucket per unit limits how many lines a second are kept.
+# Lines over the limit are counted and reported as a marker too.
+
+import re
+
+from pyrsistent import PClass, field
+
+from ._metrics import counter
+
+DEFAULT_REPEAT_WINDOW = 10.0
+DEFAULT_RATE = 1000.0
+DEFAULT_BURST = 5000
+
+_ELIOT_VOLATILE = re.compile(
+    br'"(?:timestamp|task_uuid|task_level)": *'
+    br'(?:"[^"]*"|\[[^\]]*\]|[-+.0-9eE]+)'
+)
+_DIGITS = re.compile(br"[0-9]+")
+
+# The most distinct messages to remember per unit.  Beyond that new messages
+# are kept without looking out for copies of them.
+_MAXIMUM_MESSAGES = 10000
+# How often to forget messages whose windows are over.
+_EXPIRE_INTERVAL = 1.0
+
+_REPEATED = counter(
+    "catalog_agent_log_repeated_lines_total",
+    "Log lines collapsed into an earlier copy of the same message.",
+)
+_RATE_LIMITED = counter(
+    "catalog_agent_log_rate_limited_lines_total",
+    "Log lines dropped because their unit logged too many too quickly.",
+)
+
+
+class LogThrottleSettings(PClass):
+    """
+    :ivar repeat_window: For how many seconds after a message is kept copies
+        of it are only counted.  ``0`` keeps every copy.
+    :ivar rate: The most lines per second to keep from each unit, on
+        average.  ``0`` means no limit.
+    :ivar burst: The most lines to keep from a unit at once, however quiet
+        it had been.
+    """
+    repeat_window = field(
+        type=(int, float), mandatory=True, initial=DEFAULT_REPEAT_WINDOW,
+    )
+    rate = field(type=(int, float), mandatory=True, initial=DEFAULT_RATE)
+    burst = field(type=int, mandatory=True, initial=DEFAULT_BURST)
+
+
+def log_throttle_settings_from_environment(environ):
+    """
+    Read ``LogThrottleSettings`` from ``CATALOG_LOG_REPEAT_WINDOW``,
+    ``CATALOG_LOG_RATE`` and ``CATALOG_LOG_BURST``.
+    """
+    settings = LogThrottleSettings()
+    if "CATALOG_LOG_REPEAT_WINDOW" in environ:
+        settings = settings.set(
+            repeat_window=float(environ["CATALOG_LOG_REPEAT_WINDOW"]),
+        )
+    if "CATALOG_LOG_RATE" in environ:
+        settings = settings.set(rate=float(environ["CATALOG_LOG_RATE"]))
+    if "CATALOG_LOG_BURST" in environ:
+        settings = settings.set(burst=int(environ["CATALOG_LOG_BURST"]))
+    return settings
+
+
+def _repeat_key(record):
+    if record.type is not None:
+        return _ELIOT_VOLATILE.sub(b"", record.line)
+    return _DIGITS.sub(b"", record.line)
+
+
+class _Repeats(object):
+    """
+    Copies of one message seen since it was last reported.
+    """
+    __slots__ = ("line", "expires", "count", "first", "last")
+
+    def __init__(self, line, expires):
+        self.line = line
+        self.expires = expires
+        self.count = 0
+        self.first = None
+        self.last = None
+
+
+class _Overflow(object):
+    """
+    Lines dropped by the rate limit since they were last reported.
+    """
+    __slots__ = ("count", "first", "last")
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+
+
+class _UnitThrottle(object):
+    def __init__(self, unit, settings, now):
+        self._unit = unit
+        self._window = settings.repeat_window
+        self._rate = settings.rate
+        self._burst = settings.burst
+        self._repeats = {}
+        self._tokens = float(settings.burst)
+        self._filled = now
+        self._overflow = _Overflow()
+        self._next_expiry = now + _EXPIRE_INTERVAL
+
+    def _expire(self, now):
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + _EXPIRE_INTERVAL
+        for (key, repeats) in self._repeats.items():
+            if repeats.expires <= now and not repeats.count:
+                del self._repeats[key]
+
+    def records(self, records, now):
+        if self._window:
+            self._expire(now)
+            records = self._collapse(records, now)
+        if self._rate:
+            records = self._limit(records, now)
+        return records
+
+    def _collapse(self, records, now):
+        kept = []
+        repeats_by_key = self._repeats
+        for record in records:
+            key = _repeat_key(record)
+            repeats = repeats_by_key.get(key)
+            if repeats is None or repeats.expires <= now:
+                if repeats is None or not repeats.count:
+                    if (
+                        repeats is not None or
+                        len(repeats_by_key) < _MAXIMUM_MESSAGES
+                    ):
+                        repeats_by_key[key] = _Repeats(
+                            record.line, now + self._window,
+                        )
+                    kept.append(record)
+                    continue
+                # The window is over but the copies in it haven't been
+                # reported yet.  Carry on counting until they are.
+            when = record.timestamp
+            if when is None:
+                when = now
+            if repeats.first is None:
+                repeats.first = when
+            repeats.last = when
+            repeats.count += 1
+        return kept
+
+    def _limit(self, records, now):
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._filled) * self._rate,
+        )
+        self._filled = now
+        allowed = int(self._tokens)
+        if allowed >= len(records):
+            self._tokens -= len(records)
+            return records
+        self._tokens -= allowed
+        dropped = records[allowed:]
+        overflow = self._overflow
+        if overflow.first is None:
+            overflow.first = dropped[0].timestamp or now
+        overflow.last = dropped[-1].timestamp or now
+        overflow.count += len(dropped)
+        return records[:allowed]
+
+    def markers(self):
+        """
+        :return: A ``list`` of ``dict``\\ s describing the lines collapsed or
+            dropped since the last time, and forget about them.
+        """
+        markers = []
+        for repeats in self._repeats.values():
+            if repeats.count:
+                markers.append({
+                    u"line": repeats.line,
+                    u"repeated": repeats.count,
+                    u"first": repeats.first,
+                    u"last": repeats.last,
+                })
+                _REPEATED.inc(repeats.count, unit=self._unit)
+                repeats.count = 0
+                repeats.first = repeats.last = None
+        overflow = self._overflow
+        if overflow.count:
+            markers.append({
+                u"dropped": overflow.count,
+                u"first": overflow.first,
+                u"last": overflow.last,
+            })
+            _RATE_LIMITED.inc(overflow.count, unit=self._unit)
+            self._overflow = _Overflow()
+        return markers
+
+    def pending(self):
+        return (
+            self._overflow.count or
+            any(repeats.count for repeats in self._repeats.values())
+        )
+
+
+class LogThrottle(object):
+    """
+    Collapse repeated messages and limit the rate of lines from each unit.
+    """
+    def __init__(self, reactor, settings=LogThrottleSettings()):
+        self._reactor = reactor
+        self._settings = settings
+        self._units = {}
+
+    def records(self, unit, records):
+        """
+        :param records: ``LogRecord``\\ s just read from ``unit``.
+
+        :return: A ``list`` of those which should be kept.
+        """
+        now = self._reactor.seconds()
+        throttle = self._units.get(unit)
+        if throttle is None:
+            throttle = self._units[unit] = _UnitThrottle(
+                unit, self._settings, now,
+            )
+        return throttle.records(records, now)
+
+    def markers(self):
+        """
+        :return: A ``dict`` mapping units to ``list``\\ s of markers for the
+            lines collapsed or dropped since the last time.
+        """
+        return dict(
+            (unit, throttle.markers())
+            for (unit, throttle) in self._units.items()
+            if throttle.pending()
+        )
@@ -0,0 +1,232 @@
+# In-process counters, gauges and histograms describing the agent itself.
+#
+# Metrics are registered once at module level by whichever part of the agent
+# owns them and are periodically written out as an Eliot message.  They can
+# also be rendered in the Prometheus text format.
+
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    return u",".join(u"{}={}".format(name, value) for (name, value) in key)
+
+
+def _escape(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return unicode(value).replace(u"\\", u"\\\\").replace(
+        u'"', u'\\"',
+    ).replace(u"\n", u"\\n")
+
+
+def _exposition_labels(key):
+    if not key:
+        return u""
+    return u"{" + u",".join(
+        u'{}="{}"'.format(name, _escape(value)) for (name, value) in key
+    ) + u"}"
+
+
+def _exposition_value(value):
+    if isinstance(value, float):
+        return repr(value).decode("ascii")
+    return unicode(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+
+    def samples(self):
+        """
+        :return: A sorted ``list`` of ``(label_key, value)`` pairs where
+            ``label_key`` is a sorted tuple of ``(name, value)`` pairs.
+        """
+        return sorted(self._values.items())
+
+    def snapshot(self):
+        return dict(
+            (_format_labels(key), value) for (key, value) in self.samples()
+        )
+
+    def exposition(self):
+        """
+        :return: A ``list`` of lines in the Prometheus text format for the
+            samples of this metric.
+        """
+        return list(
+            u"{}{} {}".format(
+                self.name, _exposition_labels(key), _exposition_value(value),
+            )
+            for (key, value) in self.samples()
+        )
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation):
+        _Metric.__init__(self, name, documentation)
+        self._functions = {}
+
+    def samples(self):
+        values = dict(self._values)
+        for (key, function) in self._functions.items():
+            values[key] = function()
+        return sorted(values.items())
+
+    def set(self, value, **labels):
+        self._values[_label_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """
+        Take the value ``function`` returns each time the gauge is read,
+        for a value which changes all the time, like an age.
+        """
+        key = _label_key(labels)
+        self._values.pop(key, None)
+        self._functions[key] = function
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class _HistogramValue(object):
+    def __init__(self, bucket_count):
+        self.buckets = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, count=1, **labels):
+        """
+        :param count: How many times ``value`` was seen.
+        """
+        key = _label_key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = _HistogramValue(len(self.buckets))
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state.buckets[index] += count
+        state.count += count
+        state.sum += value * count
+
+    def snapshot(self):
+        return dict(
+            (_format_labels(key), dict(count=state.count, sum=state.sum))
+            for (key, state) in self.samples()
+        )
+
+    def exposition(self):
+        lines = []
+        for (key, state) in self.samples():
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, state.buckets):
+                cumulative += count
+                lines.append(u"{}_bucket{} {}".format(
+                    self.name,
+                    _exposition_labels(key + ((u"le", repr(bound)),)),
+                    cumulative,
+                ))
+            lines.append(u"{}_bucket{} {}".format(
+                self.name,
+                _exposition_labels(key + ((u"le", u"+Inf"),)),
+                state.count,
+            ))
+            labels = _exposition_labels(key)
+            lines.append(u"{}_sum{} {}".format(
+                self.name, labels, _exposition_value(state.sum),
+            ))
+            lines.append(u"{}_count{} {}".format(
+                self.name, labels, state.count,
+            ))
+        return lines
+
+
+class _Registry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if existing.kind != metric.kind:
+                raise ValueError(
+                    "Metric {} already registered as a {}".format(
+                        metric.name, existing.kind,
+                    )
+                )
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name, documentation):
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets))
+
+    def metrics(self):
+        return list(
+            metric for (name, metric) in sorted(self._metrics.items())
+        )
+
+    def snapshot(self):
+        return dict(
+            (metric.name, metric.snapshot()) for metric in self.metrics()
+        )
+
+    def exposition(self):
+        """
+        :return: Every metric in the Prometheus text format, as ``bytes``.
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.append(u"# HELP {} {}".format(
+                metric.name,
+                metric.documentation.replace(u"\\", u"\\\\").replace(
+                    u"\n", u"\\n",
+                ),
+            ))
+            lines.append(u"# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.exposition())
+        return u"".join(line + u"\n" for line in lines).encode("utf-8")
+
+
+REGISTRY = _Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,144 @@
+# Serve the agent's own metrics over HTTP for Prometheus to scrape.
+#
+# Off unless a port is configured, and then only listening on the loopback
+# interface by default.  The reactor is sampled here too, for two things
+# nothing else measures: how late it runs timed calls, which is how long
+# anything else waiting on it is stalled, and how busy its thread pool is.
+# Twisted doesn't say how much work is waiting for a thread so the agent's
+# own work is counted as it is handed to the pool.
+
+from pyrsistent import PClass, field
+
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from ._metrics import REGISTRY, gauge, histogram
+
+DEFAULT_INTERFACE = u"127.0.0.1"
+# How often to sample the reactor and its thread pool.
+SAMPLE_INTERVAL = 1.0
+
+_CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+_REACTOR_LAG = histogram(
+    "catalog_agent_reactor_lag_seconds",
+    "How much later than scheduled a timed call ran.",
+)
+_THREADS_BUSY = gauge(
+    "catalog_agent_threadpool_busy_threads",
+    "Threads in the reactor's thread pool doing work.",
+)
+_THREADS_MAX = gauge(
+    "catalog_agent_threadpool_max_threads",
+    "The most threads the reactor's thread pool will start.",
+)
+_THREADS_QUEUED = gauge(
+    "catalog_agent_threadpool_queued_tasks",
+    "Work the agent gave the reactor's thread pool which is waiting for a "
+    "thread.",
+)
+
+
+class MetricsSettings(PClass):
+    """
+    :ivar port: The TCP port to serve ``/metrics`` on, or ``None`` not to.
+    :ivar interface: The address to listen on.
+    """
+    port = field(type=(int, type(None)), mandatory=True, initial=None)
+    interface = field(type=unicode, mandatory=True, initial=DEFAULT_INTERFACE)
+
+
+def metrics_settings_from_environment(environ):
+    """
+    Read ``MetricsSettings`` from ``CATALOG_METRICS_PORT`` and
+    ``CATALOG_METRICS_INTERFACE``.
+    """
+    settings = MetricsSettings()
+    if environ.get("CATALOG_METRICS_PORT"):
+        settings = settings.set(port=int(environ["CATALOG_METRICS_PORT"]))
+    if "CATALOG_METRICS_INTERFACE" in environ:
+        settings = settings.set(
+            interface=environ["CATALOG_METRICS_INTERFACE"].decode("ascii"),
+        )
+    return settings
+
+
+class _MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", _CONTENT_TYPE)
+        return self._registry.exposition()
+
+
+class _ReactorSampler(object):
+    """
+    Every ``interval`` seconds record how late the reactor was in getting
+    round to it and how busy its thread pool is.
+    """
+    def __init__(self, reactor, interval=SAMPLE_INTERVAL):
+        self._reactor = reactor
+        self._interval = interval
+        self._call = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._call = self._reactor.callLater(
+            self._interval, self._sample, self._reactor.seconds(),
+        )
+
+    def _sample(self, scheduled):
+        _REACTOR_LAG.observe(
+            max(0, self._reactor.seconds() - scheduled - self._interval),
+        )
+        pool = self._reactor.getThreadPool()
+        _THREADS_BUSY.set(len(pool.working))
+        _THREADS_MAX.set(pool.max)
+        self._schedule()
+
+
+def defer_to_thread_pool(reactor, f, *args, **kwargs):
+    """
+    Like ``deferToThreadPool`` with the reactor's thread pool, counting the
+    call as queued until a thread starts on it.
+    """
+    _THREADS_QUEUED.inc()
+
+    def started(*args, **kwargs):
+        reactor.callFromThread(_THREADS_QUEUED.inc, -1)
+        return f(*args, **kwargs)
+    return deferToThreadPool(
+        reactor, reactor.getThreadPool(), started, *args, **kwargs
+    )
+
+
+def serve_metrics(reactor, settings, registry=REGISTRY):
+    """
+    Start serving ``registry`` in the Prometheus text format at ``/metrics``
+    if ``settings`` has a port.
+
+    :return: A ``Deferred`` firing with the listening port, or ``None`` if
+        not serving.
+    """
+    if settings.port is None:
+        return succeed(None)
+    root = Resource()
+    root.putChild(b"metrics", _MetricsResource(registry))
+    endpoint = TCP4ServerEndpoint(
+        reactor, settings.port, interface=settings.interface,
+    )
+    return endpoint.listen(Site(root))
@@ -0,0 +1,106 @@
+# Compute RFC 6902 JSON Patch documents between two JSON-compatible values.
+#
+# Only "add", "remove" and "replace" operations are generated.  Lists are
+# compared position by position which suits the reports the agents send: the
+# order of containers, datasets and nodes is stable between ticks.
+#
+# If the ``Digests`` of both values are supplied, branches whose digests match
+# are skipped without being walked.
+
+from ._digest import child_digests
+
+
+def _escape(token):
+    # RFC 6901 section 4
+    return unicode(token).replace(u"~", u"~0").replace(u"/", u"~1")
+
+
+def diff(old, new, old_digests=None, new_digests=None):
+    """
+    Compute the operations which turn ``old`` into ``new``.
+
+    :param old: A thawed (plain ``dict``/``list``) JSON-compatible value.
+    :param new: Another one.
+    :param Digests old_digests: The digests of ``old``, if known.
+    :param Digests new_digests: The digests of ``new``, if known.
+
+    :return: A ``list`` of JSON Patch operations.  It is empty if ``old`` and
+        ``new`` are equal.
+    """
+    operations = []
+    _diff(old, new, old_digests, new_digests, u"", operations)
+    return operations
+
+
+def _diff(old, new, old_digests, new_digests, path, operations):
+    if (old_digests is not None and new_digests is not None and
+            old_digests.digest is not None and
+            old_digests.digest == new_digests.digest):
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        _diff_dict(old, new, old_digests, new_digests, path, operations)
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_list(old, new, old_digests, new_digests, path, operations)
+    elif not _same_scalar(old, new):
+        operations.append(dict(op=u"replace", path=path, value=new))
+
+
+_INTEGERS = (int, long)
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def _same_scalar(old, new):
+    """
+    :return: Whether two scalars encode to the same JSON.  ``bytes`` and
+        ``unicode`` strings are alike, as are ``int`` and ``long``, but
+        ``1``, ``1.0`` and ``True`` are not.
+    """
+    if isinstance(old, basestring) and isinstance(new, basestring):
+        return _text(old) == _text(new)
+    if type(old) in _INTEGERS and type(new) in _INTEGERS:
+        return old == new
+    return type(old) is type(new) and old == new
+
+
+def _diff_dict(old, new, old_digests, new_digests, path, operations):
+    for key in old:
+        if key not in new:
+            operations.append(
+                dict(op=u"remove", path=path + u"/" + _escape(key))
+            )
+    for key, value in new.iteritems():
+        child = path + u"/" + _escape(key)
+        if key in old:
+            _diff(
+                old[key], value,
+                child_digests(old_digests, key),
+                child_digests(new_digests, key),
+                child, operations,
+            )
+        else:
+            operations.append(dict(op=u"add", path=child, value=value))
+
+
+def _diff_list(old, new, old_digests, new_digests, path, operations):
+    common = min(len(old), len(new))
+    for index in range(common):
+        _diff(
+            old[index], new[index],
+            child_digests(old_digests, index),
+            child_digests(new_digests, index),
+            u"{}/{}".format(path, index), operations,
+        )
+    for index in range(common, len(new)):
+        operations.append(
+            dict(op=u"add", path=u"{}/-".format(path), value=new[index])
+        )
+    # Remove from the end so earlier indexes stay valid.
+    for index in reversed(range(common, len(old))):
+        operations.append(
+            dict(op=u"remove", path=u"{}/{}".format(path, index))
+        )
@@ -0,0 +1,89 @@
+# Keep only the interesting parts of a JSON-like document.
+#
+# A projection is described by an allow-list of dotted paths, like
+# "Config.Image", and a list of paths whose values are replaced by a
+# placeholder.  "*" stands for every key at that level.  A path through a list
+# applies to each item in it.  Projecting builds new containers for the
+# selected structure only; everything else is never touched.
+
+ELIDED = u"<elided>"
+EVERYTHING = u"*"
+
+_KEEP = object()
+_ELIDE = object()
+
+
+def _split(path):
+    return tuple(path.split(u"."))
+
+
+def _insert(tree, path, leaf):
+    for key in path[:-1]:
+        child = tree.get(key)
+        if child is _ELIDE:
+            return
+        if child is None and tree.get(EVERYTHING) is _KEEP:
+            child = _KEEP
+        if child is _KEEP:
+            child = tree[key] = {EVERYTHING: _KEEP}
+        elif child is None:
+            child = tree[key] = {}
+        tree = child
+    last = path[-1]
+    existing = tree.get(last)
+    if leaf is _KEEP and isinstance(existing, dict):
+        # Keep everything under here but respect elisions already made.
+        existing.setdefault(EVERYTHING, _KEEP)
+    elif leaf is _ELIDE or existing is None:
+        tree[last] = leaf
+
+
+class Projection(object):
+    """
+    A compiled projection.
+    """
+    def __init__(self, fields, elided=()):
+        """
+        :param fields: The dotted paths to keep.
+        :param elided: The dotted paths to replace with ``ELIDED`` if they are
+            kept at all.
+        """
+        tree = {}
+        for path in fields:
+            _insert(tree, _split(path), _KEEP)
+        for path in elided:
+            path = _split(path)
+            if self._kept(tree, path):
+                _insert(tree, path, _ELIDE)
+        self._tree = tree
+
+    @staticmethod
+    def _kept(tree, path):
+        for key in path:
+            if tree is _KEEP:
+                return True
+            if not isinstance(tree, dict):
+                return False
+            tree = tree.get(key, tree.get(EVERYTHING))
+        return tree is not None
+
+    def project(self, value):
+        return _project(value, self._tree)
+
+
+def _project(value, node):
+    if node is _KEEP:
+        return value
+    if node is _ELIDE:
+        return ELIDED
+    if isinstance(value, dict):
+        default = node.get(EVERYTHING)
+        projected = {}
+        for (key, child) in value.iteritems():
+            selected = node.get(key, default)
+            if selected is not None:
+                projected[key] = _project(child, selected)
+        return projected
+    if isinstance(value, list):
+        return list(_project(item, node) for item in value)
+    return value
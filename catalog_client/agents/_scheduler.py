@@ -0,0 +1,345 @@
+# Decide when each collector runs next.
+#
+# Instead of collecting every five seconds no matter what, the interval for
+# each collector adapts to what the last tick cost and to what Firehose said
+# about it:
+#
+#  - a collector never spends more than a fixed fraction of its time
+#    collecting,
+#  - big uploads are spread out to stay within an upload rate budget,
+#  - "429 Too Many Requests" and "503 Service Unavailable" double the interval
+#    (or wait as long as ``Retry-After`` asks, if that is longer),
+#
+# and once the pressure is off the interval decays back towards the minimum.
+# Every delay is jittered so that agents restarted together drift apart.
+#
+# A collector can also ask to be collected early, when it has something which
+# shouldn't wait.  That is ignored while backing off.
+
+from datetime import timedelta
+from random import random
+from time import time
+
+from eliot import Message, write_failure
+
+from pyrsistent import PClass, field
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.web.http import (
+    MULTIPLE_CHOICE, OK, SERVICE_UNAVAILABLE, stringToDatetime,
+)
+
+from ._metrics import gauge, histogram
+
+TOO_MANY_REQUESTS = 429
+
+DEFAULT_MINIMUM_INTERVAL = timedelta(seconds=5.0)
+DEFAULT_MAXIMUM_INTERVAL = timedelta(minutes=2)
+DEFAULT_JITTER = 0.2
+# Collecting may take at most one tenth of the time.
+COLLECT_COST_RATIO = 10
+DEFAULT_UPLOAD_RATE = 64 * 1024
+# The shortest time between two collections when a collector asks for them.
+MINIMUM_WAKE_UP_INTERVAL = timedelta(seconds=1.0)
+
+_COLLECT_SECONDS = histogram(
+    "catalog_agent_collect_seconds",
+    "Time spent collecting one result, by collector.",
+)
+_INTERVAL = gauge(
+    "catalog_agent_collect_interval_seconds",
+    "The current interval between collections, by collector.",
+)
+
+
+class ScheduleSettings(PClass):
+    """
+    :ivar minimum_interval: The shortest time between two collections.
+    :ivar maximum_interval: The longest time between two collections.
+    :ivar jitter: The fraction by which each delay is randomly lengthened or
+        shortened.
+    :ivar upload_rate: The bytes per second of report body to aim for.
+    """
+    minimum_interval = field(
+        type=timedelta, mandatory=True, initial=DEFAULT_MINIMUM_INTERVAL,
+    )
+    maximum_interval = field(
+        type=timedelta, mandatory=True, initial=DEFAULT_MAXIMUM_INTERVAL,
+    )
+    jitter = field(type=float, mandatory=True, initial=DEFAULT_JITTER)
+    upload_rate = field(type=int, mandatory=True, initial=DEFAULT_UPLOAD_RATE)
+
+
+def schedule_settings_from_environment(environ, collector):
+    """
+    Read ``ScheduleSettings`` for ``collector``.
+
+    The collector may supply its own defaults as ``minimum_interval`` and
+    ``maximum_interval`` attributes.  These are overridden by
+    ``CATALOG_<NAME>_MINIMUM_INTERVAL`` and ``CATALOG_<NAME>_MAXIMUM_INTERVAL``
+    (in seconds).  ``CATALOG_SCHEDULE_JITTER`` and
+    ``CATALOG_SCHEDULE_UPLOAD_RATE`` apply to every collector.
+    """
+    settings = ScheduleSettings(
+        minimum_interval=getattr(
+            collector, "minimum_interval", DEFAULT_MINIMUM_INTERVAL,
+        ),
+        maximum_interval=getattr(
+            collector, "maximum_interval", DEFAULT_MAXIMUM_INTERVAL,
+        ),
+    )
+    prefix = "CATALOG_{}_".format(collector.name.upper())
+    if prefix + "MINIMUM_INTERVAL" in environ:
+        settings = settings.set(
+            minimum_interval=timedelta(
+                seconds=float(environ[prefix + "MINIMUM_INTERVAL"]),
+            ),
+        )
+    if prefix + "MAXIMUM_INTERVAL" in environ:
+        settings = settings.set(
+            maximum_interval=timedelta(
+                seconds=float(environ[prefix + "MAXIMUM_INTERVAL"]),
+            ),
+        )
+    if "CATALOG_SCHEDULE_JITTER" in environ:
+        settings = settings.set(
+            jitter=float(environ["CATALOG_SCHEDULE_JITTER"]),
+        )
+    if "CATALOG_SCHEDULE_UPLOAD_RATE" in environ:
+        settings = settings.set(
+            upload_rate=int(environ["CATALOG_SCHEDULE_UPLOAD_RATE"]),
+        )
+    return settings
+
+
+def _retry_after(response, now):
+    """
+    :return: The number of seconds ``response``'s ``Retry-After`` header asks
+        us to wait, or ``0`` if it doesn't say.
+    """
+    for value in response.headers.getRawHeaders(b"Retry-After", []):
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, stringToDatetime(value) - now)
+        except (ValueError, IndexError):
+            pass
+    return 0
+
+
+class _AdaptiveInterval(object):
+    """
+    The interval for one collector.
+    """
+    def __init__(self, settings, random=random):
+        self._minimum = settings.minimum_interval.total_seconds()
+        self._maximum = settings.maximum_interval.total_seconds()
+        self._jitter = settings.jitter
+        self._upload_rate = settings.upload_rate
+        self._random = random
+        self.current = self._minimum
+
+    def _jittered(self, interval):
+        return interval * (1 + self._jitter * (2 * self._random() - 1))
+
+    def first_delay(self):
+        """
+        :return: A random delay before the first collection so that agents
+            which start together don't collect together.
+        """
+        return self._random() * self._minimum
+
+    def next_delay(self, collect_seconds, delivery, now):
+        """
+        Adapt to the last tick and compute the delay before the next one.
+
+        :param collect_seconds: How long the last collection took.
+        :param delivery: The ``Delivery`` of the last report or ``None`` if
+            nothing was sent.
+        :param now: The current POSIX time.
+        """
+        target = max(self._minimum, collect_seconds * COLLECT_COST_RATIO)
+        if delivery is not None:
+            target = max(
+                target, delivery.sent_bytes / float(self._upload_rate),
+            )
+            code = delivery.response.code
+            if code in (TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE):
+                target = max(
+                    target,
+                    self.current * 2,
+                    _retry_after(delivery.response, now),
+                )
+        if target < self.current:
+            # Back off quickly, recover gradually.
+            target = max(target, self.current / 2)
+        self.current = min(self._maximum, target)
+        return self._jittered(self.current)
+
+    def failed_delay(self):
+        """
+        Back off after a failed tick and compute the delay before the next
+        one.
+        """
+        self.current = min(self._maximum, self.current * 2)
+        return self._jittered(self.current)
+
+    def backing_off(self):
+        """
+        :return: Whether the interval is longer than the minimum.
+        """
+        return self.current > self._minimum
+
+
+class _CollectorLoop(object):
+    """
+    Repeatedly collect and report for one collector.
+    """
+    def __init__(self, reactor, collector, report, interval, isolate):
+        self._reactor = reactor
+        self._collector = collector
+        self._report = report
+        self._interval = interval
+        self._isolate = isolate
+        self.finished = Deferred()
+        self._call = None
+        self._started = None
+        self._woken = False
+
+    def start(self):
+        self._call = self._reactor.callLater(
+            self._interval.first_delay(), self._tick,
+        )
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def wake_up(self):
+        """
+        Collect soon instead of waiting for the rest of the interval, unless
+        backing off.
+        """
+        if self._interval.backing_off():
+            return
+        if self._call is None:
+            # Collecting right now.  Collect again once it's done.
+            self._woken = True
+        elif self._call.active():
+            self._call.reset(self._wake_up_delay())
+
+    def _wake_up_delay(self):
+        if self._started is None:
+            return 0
+        return max(
+            0,
+            self._started + MINIMUM_WAKE_UP_INTERVAL.total_seconds() -
+            self._reactor.seconds(),
+        )
+
+    def _tick(self):
+        self._call = None
+        self._started = self._reactor.seconds()
+        name = self._collector.name
+        before = time()
+        collecting = maybeDeferred(self._collector.collect)
+
+        def collected(result):
+            elapsed = time() - before
+            _COLLECT_SECONDS.observe(elapsed, collector=name)
+            reporting = maybeDeferred(self._report, result)
+            reporting.addCallback(self._reported, result)
+            reporting.addCallback(lambda delivery: (elapsed, delivery))
+            return reporting
+        collecting.addCallback(collected)
+
+        def reschedule(outcome):
+            elapsed, delivery = outcome
+            self._schedule(
+                self._interval.next_delay(
+                    elapsed, delivery, self._reactor.seconds(),
+                )
+            )
+
+        collecting.addCallback(reschedule)
+        # Scheduling the next tick can fail too.
+        collecting.addErrback(self._failed)
+
+    def _reported(self, delivery, result):
+        """
+        Tell the collector that ``result`` has been dealt with, if it wants
+        to know and Firehose accepted it or there was nothing to send.
+        """
+        acknowledge = getattr(self._collector, "acknowledge", None)
+        if acknowledge is not None and (
+            delivery is None or
+            OK <= delivery.response.code < MULTIPLE_CHOICE
+        ):
+            acknowledge(result)
+        return delivery
+
+    def _schedule(self, delay):
+        _INTERVAL.set(self._interval.current, collector=self._collector.name)
+        if self._woken:
+            self._woken = False
+            if not self._interval.backing_off():
+                delay = min(delay, self._wake_up_delay())
+        self._call = self._reactor.callLater(delay, self._tick)
+
+    def _failed(self, reason):
+        if self._isolate:
+            Message.new(
+                system="scheduler:collector-failed",
+                collector=self._collector.name,
+            ).write()
+            write_failure(reason)
+            self._schedule(self._interval.failed_delay())
+        else:
+            self.stop()
+            self.finished.errback(reason)
+
+
+class Scheduler(object):
+    """
+    Run any number of collectors, each on its own adaptive interval.
+
+    :ivar isolate: If ``True`` a failed collection or report is logged and
+        retried after backing off, so that one broken collector doesn't stop
+        the others.  Otherwise collection stops at the first failure.
+    """
+    def __init__(self, reactor, isolate=False):
+        self._reactor = reactor
+        self._isolate = isolate
+        self._loops = {}
+
+    def add(self, collector, report, settings):
+        """
+        Start collecting from ``collector`` and passing the results to
+        ``report``.
+
+        If ``collector`` has an ``acknowledge`` method it is called with each
+        result which Firehose accepted or which didn't need sending.  If it
+        has a ``set_wake_up`` method it is called with a no-argument callable
+        which the collector can call to be collected early.
+
+        :param report: A one-argument callable returning a ``Deferred`` that
+            fires with a ``Delivery`` or ``None``.
+        :param ScheduleSettings settings: How often to collect.
+
+        :return: A ``Deferred`` which fails if a collection or report fails
+            and failures are not isolated.  Collection from this collector
+            stops at that point.
+        """
+        loop = _CollectorLoop(
+            self._reactor, collector, report, _AdaptiveInterval(settings),
+            self._isolate,
+        )
+        self._loops[collector.name] = loop
+        set_wake_up = getattr(collector, "set_wake_up", None)
+        if set_wake_up is not None:
+            set_wake_up(loop.wake_up)
+        loop.start()
+        return loop.finished
@@ -0,0 +1,515 @@
+# A bounded, append-only, on-disk queue of results waiting to be reported.
+#
+# Results are appended to numbered segment files.  Each record is a header
+# (payload length, CRC32 of the payload, time of append) followed by the
+# JSON-encoded result.  A small cursor file remembers how far into the spool
+# Firehose has acknowledged so a restarted agent replays only what it hadn't
+# delivered yet.  When the spool grows beyond its size limit whole segments
+# are evicted, oldest first.
+#
+# Appends and cursor updates are fsynced together at most every sync
+# interval, in a thread, so that a busy spool doesn't block the reactor on the
+# disk.  A crash can lose that much: recent records, or the note that recent
+# records were acknowledged, which are then sent again.
+
+from collections import deque
+from os import fsync, rename
+from struct import Struct
+from zlib import crc32
+import json
+import os
+
+from eliot import Message, write_failure
+
+from pyrsistent import PClass, field
+
+from twisted.internet.defer import DeferredLock
+from twisted.python.filepath import FilePath
+
+from ._metrics import counter, gauge
+from ._metricsserver import defer_to_thread_pool
+
+_HEADER = Struct("!Iid")
+
+_SEGMENT_SUFFIX = b".segment"
+_CURSOR = b"cursor"
+
+_DEPTH = gauge(
+    "catalog_agent_spool_records",
+    "Records in the spool which have not been acknowledged by Firehose.",
+)
+_SIZE = gauge(
+    "catalog_agent_spool_bytes",
+    "Bytes of segment files in the spool.",
+)
+_AGE = gauge(
+    "catalog_agent_spool_oldest_age_seconds",
+    "Age of the oldest record in the spool which has not been acknowledged.",
+)
+_EVICTED = counter(
+    "catalog_agent_spool_evicted_records_total",
+    "Records thrown away unacknowledged because the spool was full.",
+)
+
+DEFAULT_SPOOL_PATH = b"/var/lib/catalog-agents/spool"
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_SYNC_INTERVAL = 1.0
+DEFAULT_REPLAY_BATCH = 20
+
+
+class SpoolSettings(PClass):
+    """
+    :ivar path: The directory to keep spools in.  Each collector gets its own
+        subdirectory.
+    :ivar max_size: The most bytes of segment files to keep.
+    :ivar segment_size: Start a new segment file once one reaches this size.
+    :ivar sync_interval: The longest time, in seconds, appended records may
+        go without being ``fsync``\\ ed.
+    :ivar replay_batch: The most spooled records to send per report.
+    """
+    path = field(type=FilePath, mandatory=True)
+    max_size = field(type=int, mandatory=True, initial=DEFAULT_MAX_SIZE)
+    segment_size = field(
+        type=int, mandatory=True, initial=DEFAULT_SEGMENT_SIZE,
+    )
+    sync_interval = field(
+        type=(int, float), mandatory=True, initial=DEFAULT_SYNC_INTERVAL,
+    )
+    replay_batch = field(
+        type=int, mandatory=True, initial=DEFAULT_REPLAY_BATCH,
+    )
+
+
+def spool_settings_from_environment(environ):
+    settings = SpoolSettings(
+        path=FilePath(
+            environ.get("CATALOG_SPOOL_PATH", DEFAULT_SPOOL_PATH),
+        ),
+    )
+    if "CATALOG_SPOOL_MAX_SIZE" in environ:
+        settings = settings.set(
+            max_size=int(environ["CATALOG_SPOOL_MAX_SIZE"]),
+        )
+    if "CATALOG_SPOOL_SEGMENT_SIZE" in environ:
+        settings = settings.set(
+            segment_size=int(environ["CATALOG_SPOOL_SEGMENT_SIZE"]),
+        )
+    if "CATALOG_SPOOL_SYNC_INTERVAL" in environ:
+        settings = settings.set(
+            sync_interval=float(environ["CATALOG_SPOOL_SYNC_INTERVAL"]),
+        )
+    return settings
+
+
+class _Segment(object):
+    def __init__(self, path, identifier, size, records):
+        self.path = path
+        self.identifier = identifier
+        self.size = size
+        self.records = records
+
+
+class SpooledRecord(PClass):
+    """
+    One result read back from the spool.
+
+    :ivar segment: The identifier of the segment it is in.
+    :ivar end: The offset in that segment just past the record.
+    :ivar timestamp: When it was appended.
+    :ivar result: The result itself.
+    """
+    segment = field(type=(int, long), mandatory=True)
+    end = field(type=(int, long), mandatory=True)
+    timestamp = field(type=float, mandatory=True)
+    result = field(mandatory=True)
+
+
+def _sync_directory(path):
+    directory = os.open(path.path, os.O_RDONLY)
+    try:
+        fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def _write_cursor(path, segment, offset):
+    cursor = path.child(_CURSOR)
+    temporary = cursor.temporarySibling()
+    with temporary.open("w") as f:
+        f.write(json.dumps(dict(segment=segment, offset=offset)))
+        f.flush()
+        fsync(f.fileno())
+    rename(temporary.path, cursor.path)
+    _sync_directory(path)
+
+
+def _sync_files(path, descriptor, directory_changed, cursor):
+    """
+    Get a spool's files onto the disk.  This blocks so it is meant to be
+    called outside of the reactor thread.
+
+    :param FilePath path: The spool's directory.
+    :param descriptor: A duplicate of the descriptor of the segment being
+        appended to, which is closed afterwards, or ``None``.
+    :param bool directory_changed: Whether segments were created since the
+        last sync.
+    :param cursor: The ``(segment, offset)`` to write to the cursor file, or
+        ``None`` if it hasn't moved.
+    """
+    if descriptor is not None:
+        try:
+            fsync(descriptor)
+        finally:
+            os.close(descriptor)
+    if directory_changed:
+        _sync_directory(path)
+    # Only once the records it refers to are on disk.
+    if cursor is not None:
+        _write_cursor(path, *cursor)
+
+
+def _scan(path):
+    """
+    Find the intact records in a segment file.
+
+    :return: A three-tuple of the number of records, the offset just past
+        the last intact one and a ``list`` of when each was appended.
+    """
+    records = 0
+    offset = 0
+    timestamps = []
+    with path.open() as segment:
+        while True:
+            header = segment.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            length, checksum, timestamp = _HEADER.unpack(header)
+            payload = segment.read(length)
+            if len(payload) < length or crc32(payload) != checksum:
+                break
+            records += 1
+            offset += _HEADER.size + length
+            timestamps.append(timestamp)
+    return records, offset, timestamps
+
+
+class Spool(object):
+    """
+    A spool of results in one directory.
+
+    :ivar depth: The number of records not yet acknowledged.
+    """
+    def __init__(self, path, max_size, segment_size, sync_interval, reactor,
+                 name):
+        self._path = path
+        self._max_size = max_size
+        self._segment_size = segment_size
+        self._sync_interval = sync_interval
+        self._reactor = reactor
+        self._name = name
+        self._segments = []
+        self._writer = None
+        self._sync_call = None
+        # Syncs run one at a time, in order, so that the cursor is never
+        # written before the records it refers to.
+        self._sync_lock = DeferredLock()
+        self._cursor_changed = False
+        self._directory_changed = False
+        self._head_segment = None
+        self._head_offset = 0
+        # How many records in the head segment have been acknowledged.
+        self._head_records = 0
+        # When each record not yet acknowledged was appended, oldest first.
+        self._timestamps = deque()
+        self._peeked = None
+        self._next_identifier = 0
+        self.depth = 0
+        self._open()
+        _AGE.set_function(self._oldest_age, spool=name)
+
+    @classmethod
+    def from_settings(cls, settings, reactor, name):
+        return cls(
+            path=settings.path.child(name),
+            max_size=settings.max_size,
+            segment_size=settings.segment_size,
+            sync_interval=settings.sync_interval,
+            reactor=reactor,
+            name=name,
+        )
+
+    def _segment_path(self, identifier):
+        return self._path.child(b"%020d%s" % (identifier, _SEGMENT_SUFFIX))
+
+    def _open(self):
+        if not self._path.exists():
+            self._path.makedirs()
+
+        identifiers = sorted(
+            int(child.basename()[:-len(_SEGMENT_SUFFIX)])
+            for child in self._path.children()
+            if child.basename().endswith(_SEGMENT_SUFFIX)
+        )
+        timestamps = {}
+        for identifier in identifiers:
+            path = self._segment_path(identifier)
+            records, end, timestamps[identifier] = _scan(path)
+            if end < path.getsize():
+                # The agent died part way through an append.
+                with open(path.path, "r+b") as segment:
+                    segment.truncate(end)
+            self._segments.append(_Segment(path, identifier, end, records))
+
+        head_segment, head_offset = self._read_cursor()
+        for segment in list(self._segments):
+            if segment.identifier < head_segment:
+                self._remove_segment(segment)
+        # Never reuse an identifier the cursor might still refer to.
+        self._next_identifier = max(
+            [head_segment] + list(
+                segment.identifier + 1 for segment in self._segments
+            )
+        )
+
+        if self._segments:
+            self._head_segment = self._segments[0]
+            if self._head_segment.identifier == head_segment:
+                self._head_offset = min(head_offset, self._head_segment.size)
+            self.depth = sum(segment.records for segment in self._segments)
+            self._head_records = self._records_before(
+                self._head_segment, self._head_offset,
+            )
+            self.depth -= self._head_records
+            for segment in self._segments:
+                self._timestamps.extend(timestamps[segment.identifier])
+            for _ in range(self._head_records):
+                self._timestamps.popleft()
+            last = self._segments[-1]
+            if last.size < self._segment_size:
+                self._writer = open(last.path.path, "ab")
+        self._update_gauges()
+
+    def _records_before(self, segment, offset):
+        count = 0
+        position = 0
+        with segment.path.open() as reader:
+            while position < offset:
+                length, checksum, timestamp = _HEADER.unpack(
+                    reader.read(_HEADER.size)
+                )
+                reader.seek(length, os.SEEK_CUR)
+                position += _HEADER.size + length
+                count += 1
+        return count
+
+    def _read_cursor(self):
+        cursor = self._path.child(_CURSOR)
+        if not cursor.exists():
+            return (0, 0)
+        try:
+            position = json.loads(cursor.getContent())
+            return (position[u"segment"], position[u"offset"])
+        except ValueError:
+            Message.new(
+                system="spool:cursor:corrupt", spool=self._name,
+            ).write()
+            return (0, 0)
+
+    def _cursor_moved(self):
+        self._cursor_changed = True
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        if self._sync_call is None:
+            self._sync_call = self._reactor.callLater(
+                self._sync_interval, self._sync,
+            )
+
+    def _new_segment(self):
+        if self._writer is not None:
+            self._sync()
+            self._writer.close()
+        identifier = self._next_identifier
+        self._next_identifier += 1
+        segment = _Segment(self._segment_path(identifier), identifier, 0, 0)
+        self._writer = open(segment.path.path, "ab")
+        self._directory_changed = True
+        self._schedule_sync()
+        self._segments.append(segment)
+        if self._head_segment is None:
+            self._head_segment = segment
+            self._head_offset = 0
+        return segment
+
+    def _sync(self):
+        if self._sync_call is not None:
+            if self._sync_call.active():
+                self._sync_call.cancel()
+            self._sync_call = None
+        descriptor = None
+        if self._writer is not None:
+            self._writer.flush()
+            # The segment may be closed before the thread gets to it.
+            descriptor = os.dup(self._writer.fileno())
+        cursor = None
+        if self._cursor_changed and self._head_segment is not None:
+            cursor = (self._head_segment.identifier, self._head_offset)
+            self._cursor_changed = False
+        directory_changed, self._directory_changed = (
+            self._directory_changed, False,
+        )
+        syncing = self._sync_lock.run(
+            defer_to_thread_pool, self._reactor,
+            _sync_files, self._path, descriptor, directory_changed, cursor,
+        )
+
+        def failed(reason):
+            Message.new(system="spool:sync-failed", spool=self._name).write()
+            write_failure(reason)
+            # Try again with the next sync.
+            if cursor is not None:
+                self._cursor_changed = True
+            if directory_changed:
+                self._directory_changed = True
+        syncing.addErrback(failed)
+        return syncing
+
+    def sync(self):
+        """
+        Make sure everything appended and acknowledged so far is on disk.
+
+        :return: A ``Deferred`` which fires once it is.
+        """
+        return self._sync()
+
+    def append(self, result):
+        """
+        Add a result to the end of the spool.
+
+        It is flushed to the operating system immediately and ``fsync``\\ ed
+        within ``sync_interval`` seconds.
+
+        :return: The position of the new record: the ``segment`` and ``end``
+            its ``SpooledRecord`` will have.  Later records have greater
+            positions.
+        """
+        payload = json.dumps(result)
+        timestamp = self._reactor.seconds()
+        record = _HEADER.pack(
+            len(payload), crc32(payload), timestamp,
+        ) + payload
+
+        if self._writer is None or (
+                self._segments[-1].size + len(record) > self._segment_size and
+                self._segments[-1].size > 0):
+            self._new_segment()
+        segment = self._segments[-1]
+        self._writer.write(record)
+        self._writer.flush()
+        segment.size += len(record)
+        segment.records += 1
+        self.depth += 1
+        self._timestamps.append(timestamp)
+
+        self._schedule_sync()
+        position = (segment.identifier, segment.size)
+        self._evict()
+        self._update_gauges()
+        return position
+
+    def _evict(self):
+        while (sum(segment.size for segment in self._segments) >
+               self._max_size and len(self._segments) > 1):
+            oldest = self._segments[0]
+            if oldest is self._head_segment:
+                lost = oldest.records - self._head_records
+                self._head_segment = self._segments[1]
+                self._head_offset = 0
+                self._head_records = 0
+                self._peeked = None
+                self._cursor_moved()
+            else:
+                lost = oldest.records
+            self.depth -= lost
+            for _ in range(lost):
+                self._timestamps.popleft()
+            _EVICTED.inc(lost, spool=self._name)
+            Message.new(
+                system="spool:evicted", spool=self._name,
+                segment=oldest.identifier, records=lost,
+            ).write()
+            self._remove_segment(oldest)
+
+    def _remove_segment(self, segment):
+        self._segments.remove(segment)
+        segment.path.remove()
+
+    def _advance_head(self):
+        """
+        Move the head past a fully read segment if there is a later one.
+        """
+        while (self._head_offset >= self._head_segment.size and
+               self._head_segment is not self._segments[-1]):
+            finished = self._head_segment
+            self._head_segment = self._segments[
+                self._segments.index(finished) + 1
+            ]
+            self._head_offset = 0
+            self._head_records = 0
+            self._remove_segment(finished)
+
+    def _read(self, segment, offset):
+        with segment.path.open() as reader:
+            reader.seek(offset)
+            length, checksum, timestamp = _HEADER.unpack(
+                reader.read(_HEADER.size)
+            )
+            payload = reader.read(length)
+        return SpooledRecord(
+            segment=segment.identifier,
+            end=offset + _HEADER.size + length,
+            timestamp=timestamp,
+            result=json.loads(payload),
+        )
+
+    def peek(self):
+        """
+        Read the oldest record which has not been acknowledged.
+
+        :return: A ``SpooledRecord`` or ``None`` if the spool is empty.
+        """
+        if self.depth == 0:
+            return None
+        self._advance_head()
+        if self._peeked is None:
+            # Failed sends peek at the same record again and again.
+            self._peeked = self._read(self._head_segment, self._head_offset)
+        return self._peeked
+
+    def acknowledge(self, record):
+        """
+        Forget about ``record`` and everything before it.
+        """
+        if record.segment != self._head_segment.identifier:
+            # It was evicted while it was being sent.
+            return
+        self._head_offset = record.end
+        self._head_records += 1
+        self.depth -= 1
+        self._timestamps.popleft()
+        self._peeked = None
+        self._advance_head()
+        self._cursor_moved()
+        self._update_gauges()
+
+    def _update_gauges(self):
+        _DEPTH.set(self.depth, spool=self._name)
+        _SIZE.set(
+            sum(segment.size for segment in self._segments), spool=self._name,
+        )
+
+    def _oldest_age(self):
+        if not self._timestamps:
+            return 0
+        return self._reactor.seconds() - self._timestamps[0]
@@ -1,38 +1,95 @@
+from collections import deque
 from datetime import timedelta
+from functools import partial
 from os import environ
 import sys
+from time import time
 
-import treq
-from treq.client import HTTPClient
 import json
 
 from OpenSSL.crypto import FILETYPE_PEM, load_certificate
 
-from eliot import to_file, start_action
+from eliot import (
+    Message, to_file, start_action, write_failure, write_traceback,
+)
 from eliot.twisted import DeferredContext
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import gatherResults, succeed
 from twisted.internet.task import LoopingCall, react
 from twisted.python.filepath import FilePath
 from twisted.internet import reactor, ssl
-from twisted.web.client import Agent
 from twisted.python.log import startLogging
+from twisted.web.http import OK, MULTIPLE_CHOICE, CONFLICT
 
 import yaml
 
 from pyrsistent import PClass, PMap, pmap, field, thaw
 
+from ._encoding import (
+    BodyEncoding, body_encoding_from_environment, record_body_sizes,
+)
+from ._envelope import (
+    ENVELOPE_NAME, EnvelopeSettings, _Envelope,
+    envelope_settings_from_environment,
+)
+from ._httpclient import (
+    PoolSettings, persistent_client, pool_settings_from_environment,
+    pooled_client,
+)
+from ._digest import digest
+from ._metrics import REGISTRY, counter, histogram
+from ._metricsserver import (
+    MetricsSettings, _ReactorSampler, defer_to_thread_pool,
+    metrics_settings_from_environment, serve_metrics,
+)
+from ._patch import diff
+from ._scheduler import (
+    ScheduleSettings, Scheduler, schedule_settings_from_environment,
+)
+from ._spool import Spool, spool_settings_from_environment
+
 DEFAULT_FIREHOSE_HOSTNAME = b"firehose-volumehub.clusterhq.com"
 DEFAULT_FIREHOSE_PORT = 443
 DEFAULT_FIREHOSE_PROTOCOL = "https"
 
-REPORT_INTERVAL = timedelta(seconds=5.0)
+# The label of the connection pool to the control service in metrics.
+CONTROL_SERVICE_POOL = u"flocker-control"
+# One connection for each listing polled at once.
+CONTROL_SERVICE_POOL_SETTINGS = PoolSettings(max_idle_connections=3)
+
+DEFAULT_SNAPSHOT_INTERVAL = timedelta(minutes=5)
+METRICS_LOG_INTERVAL = timedelta(seconds=60.0)
+
+# Firehose sets this response header to "required" when it wants a whole
+# snapshot instead of a patch.
+SNAPSHOT_HEADER = b"X-Catalog-Snapshot"
+SNAPSHOT_REQUIRED = b"required"
+
+_CHANGE_DETECTION_SECONDS = histogram(
+    "catalog_agent_change_detection_seconds",
+    "Time spent computing the digest of a result to decide whether it "
+    "changed.",
+)
+_POST_SECONDS = histogram(
+    "catalog_agent_report_post_seconds",
+    "Time taken to post a report to Firehose and read the response.",
+)
+_POST_RESPONSES = counter(
+    "catalog_agent_report_responses_total",
+    "Responses to reports posted to Firehose, by status code.",
+)
+_RESULTS = counter(
+    "catalog_agent_results_total",
+    "Results given to a reporter, by whether they were sent or skipped "
+    "because they hadn't changed.",
+)
 
 
 def get_client(
     reactor=reactor, certificates_path=FilePath("/etc/flocker"),
     user_certificate_filename="plugin.crt", user_key_filename="plugin.key",
-    cluster_certificate_filename="cluster.crt", target_hostname=None
+    cluster_certificate_filename="cluster.crt", target_hostname=None,
+    pool_settings=CONTROL_SERVICE_POOL_SETTINGS,
 ):
     """
     Create a ``treq``-API object that implements the REST API TLS
@@ -41,6 +98,9 @@ def get_client(
     That is, validating the control service as well as presenting a
     certificate to the control service for authentication.
 
+    Connections are kept open according to ``pool_settings`` and TLS
+    sessions are resumed when a new connection is needed.
+
     :return: ``treq`` compatible object.
     """
     if target_hostname is None:
@@ -63,12 +123,14 @@ def get_client(
         authority = ssl.Certificate.loadPEM(cert_data)
         client_certificate = ssl.PrivateCertificate.loadPEM(auth_data)
 
-        class ContextFactory(object):
-            def getContext(self, hostname, port):
-                context = client_certificate.options(authority).getContext()
-                return context
-
-        return HTTPClient(Agent(reactor, contextFactory=ContextFactory()))
+        # The control service's certificate is verified against the cluster
+        # CA but, as before, not against the hostname.  The context is built
+        # once and shared by every connection so that TLS sessions can be
+        # resumed.
+        context = client_certificate.options(authority).getContext()
+        return persistent_client(
+            reactor, context, pool_settings, CONTROL_SERVICE_POOL,
+        )
     else:
         raise Exception(
             "Not enough information to construct TLS context: "
@@ -79,45 +141,334 @@ def get_client(
         )
 
 
+def _add_serialized(body, serialized):
+    """
+    Add fields whose values are already serialized to the JSON object
+    ``body``.
+    """
+    if not serialized:
+        return body
+    members = list(
+        json.dumps(key) + b": " + value
+        for (key, value) in sorted(serialized.items())
+    )
+    if body != b"{}":
+        members.insert(0, body[1:-1])
+    return b"{" + b", ".join(members) + b"}"
+
+
 class HTTPReporter(PClass):
     common = field(type=PMap, factory=pmap, mandatory=True)
     location = field(type=unicode, mandatory=True)
+    # A ``PooledClient`` so that reports reuse connections to Firehose.
+    client = field(mandatory=True)
+    encoding = field(type=BodyEncoding, mandatory=True, initial=BodyEncoding())
+    reactor = field(mandatory=True, initial=reactor)
 
     def report(self, result):
-        result = self.common.set("result", result)
+        return self.send(pmap({"result": result}))
+
+    def send(self, fields, serialized=pmap()):
+        """
+        Post ``common`` combined with ``fields``.
+
+        :param serialized: More fields whose values are already serialized as
+            JSON, to be put in the body as they are.
+
+        :return: A ``Deferred`` firing with a ``Delivery``.
+        """
+        document = self.common.update(fields)
         context = start_action(system="reporter:post")
         with context.context():
+            # Serializing and compressing a large report takes long enough to
+            # stall everything else in the reactor so do it in a thread.
             posting = DeferredContext(
-                treq.post(
-                    self.location.encode("ascii"),
-                    json.dumps(thaw(result)),
-                    timeout=30,
+                defer_to_thread_pool(
+                    self.reactor, self._encode, document, serialized,
                 )
             )
+            posting.addCallback(self._post)
             return posting.addActionFinish()
 
+    def _encode(self, document, serialized):
+        body = _add_serialized(json.dumps(thaw(document)), serialized)
+        headers, encoded = self.encoding.encode(body)
+        return len(body), headers, encoded
+
+    def _post(self, encoded):
+        raw_size, headers, body = encoded
+        record_body_sizes(raw_size, len(body))
+        before = self.reactor.seconds()
+        posting = self.client.post(
+            self.location.encode("ascii"),
+            body,
+            headers=headers,
+            timeout=30,
+        )
+
+        def posted(delivery):
+            _POST_SECONDS.observe(self.reactor.seconds() - before)
+            _POST_RESPONSES.inc(code=delivery.response.code)
+            return delivery
+
+        def failed(reason):
+            _POST_SECONDS.observe(self.reactor.seconds() - before)
+            _POST_RESPONSES.inc(code=u"none")
+            return reason
+        posting.addCallbacks(posted, failed)
+        return posting
+
+
+def _acknowledged(response):
+    return OK <= response.code < MULTIPLE_CHOICE
+
+
+def _snapshot_requested(response):
+    if response.code == CONFLICT:
+        # Firehose doesn't know the base revision of the patch.
+        return True
+    return SNAPSHOT_REQUIRED in response.headers.getRawHeaders(
+        SNAPSHOT_HEADER, [],
+    )
+
+
+class DeltaSettings(PClass):
+    """
+    :ivar enabled: Whether to send patches instead of whole results.
+    :ivar snapshot_interval: How often to send a whole result anyway.
+    """
+    enabled = field(type=bool, mandatory=True, initial=False)
+    snapshot_interval = field(
+        type=timedelta, mandatory=True, initial=DEFAULT_SNAPSHOT_INTERVAL,
+    )
+
+
+def delta_settings_from_environment(environ):
+    settings = DeltaSettings(
+        enabled=environ.get("CATALOG_FIREHOSE_DELTAS", "0") == "1",
+    )
+    if "CATALOG_FIREHOSE_SNAPSHOT_INTERVAL" in environ:
+        settings = settings.set(
+            snapshot_interval=timedelta(
+                seconds=float(environ["CATALOG_FIREHOSE_SNAPSHOT_INTERVAL"]),
+            ),
+        )
+    return settings
+
+
+def _timed_digest(result):
+    """
+    Compute the ``Digests`` of ``result``, recording how long it took.
+    """
+    before = time()
+    digests = digest(result)
+    _CHANGE_DETECTION_SECONDS.observe(time() - before)
+    return digests
+
+
+class _DeltaReporter(object):
+    """
+    Send each result as a JSON Patch against the last result Firehose
+    acknowledged instead of sending the whole thing.  Results which haven't
+    changed since then aren't sent at all.
+
+    Every report carries a ``revision``.  A patch also carries the ``base``
+    revision it applies to.  A whole snapshot is sent first, then every
+    ``snapshot_interval``, and whenever Firehose responds to a patch with
+    ``409 Conflict`` or an ``X-Catalog-Snapshot: required`` header.
+    """
+    def __init__(self, reporter, snapshot_interval, clock):
+        self._wrapped_reporter = reporter
+        self._snapshot_interval = snapshot_interval.total_seconds()
+        self._clock = clock
+        self._revision = 0
+        self._base = None
+        self._base_digests = None
+        self._base_revision = None
+        self._snapshot_time = None
+
+    def report(self, result):
+        result = thaw(result)
+        digests = _timed_digest(result)
+        if self._base is not None:
+            if digests.digest == self._base_digests.digest:
+                _RESULTS.inc(outcome=u"skipped")
+                return succeed(None)
+            if not self._snapshot_due():
+                _RESULTS.inc(outcome=u"sent")
+                return self._send_patch(result, digests)
+        _RESULTS.inc(outcome=u"sent")
+        return self._send_snapshot(result, digests)
+
+    def _snapshot_due(self):
+        elapsed = self._clock.seconds() - self._snapshot_time
+        return elapsed >= self._snapshot_interval
+
+    def _next_revision(self):
+        self._revision += 1
+        return self._revision
+
+    def _rebase(self, result, digests, revision):
+        self._base = result
+        self._base_digests = digests
+        self._base_revision = revision
+
+    def _send_snapshot(self, result, digests):
+        revision = self._next_revision()
+        sending = self._wrapped_reporter.send(
+            pmap({u"result": result, u"revision": revision})
+        )
+
+        def sent(delivery):
+            response = delivery.response
+            if _snapshot_requested(response):
+                self._base = None
+            elif _acknowledged(response):
+                self._rebase(result, digests, revision)
+                self._snapshot_time = self._clock.seconds()
+            return delivery
+        sending.addCallback(sent)
+        return sending
+
+    def _send_patch(self, result, digests):
+        revision = self._next_revision()
+        patch = diff(self._base, result, self._base_digests, digests)
+        sending = self._wrapped_reporter.send(
+            pmap({
+                u"patch": patch,
+                u"base": self._base_revision,
+                u"revision": revision,
+            })
+        )
+
+        def sent(delivery):
+            response = delivery.response
+            if _snapshot_requested(response):
+                Message.new(
+                    system="reporter:delta:snapshot-requested",
+                    code=response.code,
+                    base=self._base_revision,
+                ).write()
+                self._base = None
+                return self._send_snapshot(result, digests)
+            if _acknowledged(response):
+                self._rebase(result, digests, revision)
+            return delivery
+        sending.addCallback(sent)
+        return sending
+
 
 class _ChangeReporter(object):
+    """
+    Only report results which differ from the last result Firehose
+    acknowledged.
+
+    Only the digest of that result is kept, not the result itself.
+    """
     def __init__(self, reporter):
         self._wrapped_reporter = reporter
-        self._last_result = None
+        self._last_digest = None
 
     def report(self, result):
-        if result != self._last_result:
-            return self._report_and_update(result)
+        result_digest = _timed_digest(result).digest
+        if result_digest != self._last_digest:
+            _RESULTS.inc(outcome=u"sent")
+            return self._report_and_update(result, result_digest)
+        _RESULTS.inc(outcome=u"skipped")
         return succeed(None)
 
-    def _report_and_update(self, result):
+    def _report_and_update(self, result, result_digest):
         reporting = self._wrapped_reporter.report(result)
 
-        def update(passthrough):
-            self._last_result = result
-            return passthrough
+        def update(delivery):
+            response = delivery.response
+            # Only skip results Firehose actually has.
+            if _acknowledged(response):
+                self._last_digest = result_digest
+            return delivery
 
         reporting.addCallback(update)
         return reporting
 
 
+class _SpoolReporter(object):
+    """
+    Append every result to an on-disk ``Spool`` and then send spooled
+    results, oldest first, until the spool is empty, ``replay_batch`` of them
+    have been sent or Firehose doesn't acknowledge one.
+
+    Results which could not be sent stay in the spool for a later report
+    instead of failing the agent.
+
+    If given, ``delivered`` is called once for each result reported, in
+    order, when it is known what became of it: with ``True`` once Firehose
+    has acknowledged it and with ``False`` if it was evicted from the spool
+    or couldn't be spooled at all.
+    """
+    def __init__(self, spool, reporter, replay_batch, delivered=None):
+        self._spool = spool
+        self._wrapped_reporter = reporter
+        self._replay_batch = replay_batch
+        self._delivered = delivered
+        # The positions of the records appended by this reporter which
+        # haven't been acknowledged yet, or None for results which couldn't
+        # be appended.
+        self._appended = deque()
+
+    def report(self, result):
+        if result:
+            try:
+                position = self._spool.append(thaw(result))
+            except (TypeError, ValueError):
+                # It can't be encoded as JSON so it would never be sent.
+                # Drop it rather than failing every tick on it.
+                Message.new(system="reporter:spool:unencodable").write()
+                write_traceback()
+                position = None
+            if self._delivered is not None:
+                self._appended.append(position)
+        return self._replay(self._replay_batch)
+
+    def _acknowledged(self, record):
+        self._spool.acknowledge(record)
+        position = (record.segment, record.end)
+        # Anything appended before it which is still waiting was evicted.
+        while self._appended and (
+            self._appended[0] is None or self._appended[0] <= position
+        ):
+            self._delivered(self._appended.popleft() == position)
+
+    def _replay(self, remaining, last_delivery=None):
+        if remaining == 0:
+            return succeed(last_delivery)
+        record = self._spool.peek()
+        if record is None:
+            return succeed(last_delivery)
+
+        sending = self._wrapped_reporter.report(record.result)
+
+        def sent(delivery):
+            response = delivery.response
+            if _acknowledged(response):
+                self._acknowledged(record)
+                return self._replay(remaining - 1, delivery)
+            Message.new(
+                system="reporter:spool:rejected",
+                code=response.code,
+                depth=self._spool.depth,
+            ).write()
+            return delivery
+
+        def failed(reason):
+            Message.new(
+                system="reporter:spool:failed", depth=self._spool.depth,
+            ).write()
+            write_failure(reason)
+
+        sending.addCallbacks(sent, failed)
+        return sending
+
+
 class StdoutReporter(PClass):
     common = field(type=PMap, factory=pmap, mandatory=True)
 
@@ -159,32 +510,166 @@ def _maybe_report(result, reporter):
     return None
 
 
-def run_agent(
-    reactor, config_path, protocol, firehose, port, secret, collector
+def _log_metrics():
+    Message.new(system="agent:metrics", metrics=REGISTRY.snapshot()).write()
+
+
+def _firehose_location(protocol, firehose, port, name):
+    return u"{protocol}://{host}:{port}/v1/firehose/{name}".format(
+        protocol=protocol, host=firehose, port=port, name=name,
+    )
+
+
+def _report_delivered(result, reporter, delivered):
+    """
+    Report a non-empty ``result`` and then tell ``delivered`` whether
+    Firehose acknowledged it.
+    """
+    if not result:
+        return None
+    reporting = reporter.report(result)
+
+    def sent(delivery):
+        delivered(_acknowledged(delivery.response))
+        return delivery
+
+    def failed(reason):
+        delivered(False)
+        return reason
+    reporting.addCallbacks(sent, failed)
+    return reporting
+
+
+def _reporter_for(
+    reactor, collector, reporter, delta_settings, spool_settings,
+):
+    """
+    Build the chain of reporters for one collector on top of ``reporter``.
+
+    A durable collector may have a ``delivered`` method.  It is called once
+    for each non-empty result, in order, with whether Firehose acknowledged
+    that result.
+
+    :return: A one-argument callable which reports a result.
+    """
+    delivered = getattr(collector, "delivered", None)
+    if getattr(collector, "durable", False):
+        if spool_settings is not None:
+            # Every result matters, not just the latest one.  Keep them on
+            # disk until Firehose has them.
+            spool = Spool.from_settings(
+                spool_settings, reactor, collector.name,
+            )
+            # Don't replay what was acknowledged in the last few seconds
+            # when stopped gracefully.
+            reactor.addSystemEventTrigger(b"before", b"shutdown", spool.sync)
+            reporter = _SpoolReporter(
+                spool, reporter, spool_settings.replay_batch, delivered,
+            )
+            return reporter.report
+        if delivered is not None:
+            # No two results are the same so don't look for changes.
+            return partial(
+                _report_delivered, reporter=reporter, delivered=delivered,
+            )
+
+    if delta_settings.enabled:
+        # This skips unchanged results itself.
+        reporter = _DeltaReporter(
+            reporter, delta_settings.snapshot_interval, reactor,
+        )
+    else:
+        reporter = _ChangeReporter(reporter)
+    return partial(_maybe_report, reporter=reporter)
+
+
+def run_agents(
+    reactor, config_path, protocol, firehose, port, secret, collectors,
+    pool_settings=PoolSettings(), body_encoding=BodyEncoding(),
+    delta_settings=DeltaSettings(), spool_settings=None,
+    schedule_settings=pmap(), isolate=False,
+    envelope_settings=EnvelopeSettings(),
+    metrics_settings=MetricsSettings(),
 ):
+    """
+    Run several collectors in this process, sharing one connection pool to
+    Firehose and one scheduler.
+
+    :param schedule_settings: A mapping from collector names to their
+        ``ScheduleSettings``.  Collectors not in it get the defaults.
+    :param bool isolate: Whether a failing collector should be retried
+        instead of stopping the process.
+    :param EnvelopeSettings envelope_settings: Whether to combine reports
+        from all collectors into envelopes.
+    :param MetricsSettings metrics_settings: Where to serve metrics for
+        Prometheus, if anywhere.
+    """
     identifiers = find_identifiers(FilePath(config_path))
     # Base64 encoded so it is valid json
     common = identifiers.set(u"secret", secret)
-    location = u"{protocol}://{host}:{port}/v1/firehose/{collector}".format(
-        protocol=protocol, host=firehose, port=port, collector=collector.name,
-    )
-    reporter = HTTPReporter(location=location, common=common)
-    # reporter = StdoutReporter(common=common)
-    reporter = _ChangeReporter(reporter)
+    client = pooled_client(reactor, pool_settings, u"firehose")
+
+    def http_reporter(name):
+        # return StdoutReporter(common=common)
+        return HTTPReporter(
+            location=_firehose_location(protocol, firehose, port, name),
+            common=common, client=client, encoding=body_encoding,
+            reactor=reactor,
+        )
 
-    loop = LoopingCall(
-        lambda: collector.collect().addCallback(_maybe_report, reporter)
-    )
+    envelope = None
+    if envelope_settings.enabled:
+        envelope = _Envelope(
+            reactor, http_reporter(ENVELOPE_NAME), envelope_settings.window,
+        )
+
+    metrics = LoopingCall(_log_metrics)
+    metrics.start(
+        METRICS_LOG_INTERVAL.total_seconds(), now=False,
+    ).addErrback(write_failure)
+    _ReactorSampler(reactor).start()
+    serve_metrics(reactor, metrics_settings).addErrback(write_failure)
+
+    scheduler = Scheduler(reactor, isolate=isolate)
+    running = []
+    for collector in collectors:
+        if envelope is None:
+            reporter = http_reporter(collector.name)
+        else:
+            reporter = envelope.reporter_for(collector.name)
+        report = _reporter_for(
+            reactor, collector, reporter, delta_settings, spool_settings,
+        )
+        running.append(
+            scheduler.add(
+                collector, report,
+                schedule_settings.get(collector.name, ScheduleSettings()),
+            )
+        )
     # If an iteration fails this Deferred fires with a failure and the process
     # exits.  Docker will restart us.
-    return loop.start(REPORT_INTERVAL.total_seconds(), now=True)
+    return gatherResults(running, consumeErrors=True)
 
 
-def agent_main(collector):
+def run_agent(
+    reactor, config_path, protocol, firehose, port, secret, collector,
+    schedule_settings=ScheduleSettings(), **kwargs
+):
+    return run_agents(
+        reactor, config_path, protocol, firehose, port, secret, [collector],
+        schedule_settings=pmap({collector.name: schedule_settings}),
+        **kwargs
+    )
+
+
+def agents_main(collectors, isolate=False):
+    """
+    Run ``collectors`` in one process, configured from the environment.
+    """
     to_file(sys.stdout)
     startLogging(sys.stdout)
     return react(
-        run_agent, [
+        run_agents, [
             environ.get(
                 "FLOCKER_CONFIGURATION_PATH",
                 "/etc/flocker",
@@ -205,6 +690,22 @@ def agent_main(collector):
             ),
             # Base64 encoded
             environ["CATALOG_FIREHOSE_SECRET"].decode("ascii"),
-            collector,
+            collectors,
+            pool_settings_from_environment(environ, "CATALOG_FIREHOSE"),
+            body_encoding_from_environment(environ),
+            delta_settings_from_environment(environ),
+            spool_settings_from_environment(environ),
+            pmap(dict(
+                (collector.name,
+                 schedule_settings_from_environment(environ, collector))
+                for collector in collectors
+            )),
+            isolate,
+            envelope_settings_from_environment(environ),
+            metrics_settings_from_environment(environ),
         ],
     )
+
+
+def agent_main(collector):
+    return agents_main([collector])
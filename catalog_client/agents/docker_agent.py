@@ -4,49 +4,362 @@
 #    about their state
 #
 #  - send that information to Firehose server
+#
+# By default the container details are kept in a local index which follows
+# the Docker events stream.  Only containers which had lifecycle events since
+# the last tick are inspected again, with a full listing and inspection every
+# few minutes as a safety net.
 
 from __future__ import print_function
 
-from copy import deepcopy
+from datetime import timedelta
+from hashlib import sha1
+from os import environ
+import json
 
-import docker
-from twisted.internet.defer import succeed
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, succeed
 
-from eliot import write_traceback
+from eliot import Message, write_failure
 
 from .agentlib import agent_main
+from ._dockerclient import (
+    DockerClient, NotFound, docker_client_settings_from_environment,
+)
+from ._metrics import gauge
+from ._projection import Projection
+
+DEFAULT_RECONCILE_INTERVAL = timedelta(minutes=5)
+
+# The parts of each container's inspect output which are reported.  Id and
+# Created are always kept.  Others can be chosen with CATALOG_DOCKER_FIELDS, a
+# comma separated list of dotted paths ("*" reports everything).
+DEFAULT_FIELDS = (
+    u"Id", u"Name", u"Created", u"Path", u"Args", u"Image", u"RestartCount",
+    u"State",
+    u"Config.Hostname", u"Config.Image", u"Config.Cmd", u"Config.Entrypoint",
+    u"Config.Env", u"Config.Labels", u"Config.Volumes",
+    u"Config.ExposedPorts", u"Config.WorkingDir", u"Config.VolumeDriver",
+    u"HostConfig.Binds", u"HostConfig.VolumeDriver",
+    u"HostConfig.RestartPolicy", u"HostConfig.PortBindings",
+    u"HostConfig.NetworkMode", u"HostConfig.Privileged",
+    u"Mounts.Name", u"Mounts.Source", u"Mounts.Destination",
+    u"Mounts.Driver", u"Mounts.Mode", u"Mounts.RW",
+    u"Volumes", u"VolumesRW",
+    u"NetworkSettings.IPAddress", u"NetworkSettings.Ports",
+)
+_REQUIRED_FIELDS = (u"Id", u"Created")
+# Reported only as a placeholder.
+ELIDED_FIELDS = (u"Config.Env",)
+
+_PAYLOAD_BYTES = gauge(
+    "catalog_agent_docker_payload_bytes",
+    "The JSON size of the container details in the last docker report before "
+    "(raw) and after (projected) dropping unreported fields.",
+)
+
+# Events after which a container's inspect output may have changed.
+_LIFECYCLE_EVENTS = {
+    u"create", u"start", u"restart", u"die", u"stop", u"kill", u"oom",
+    u"pause", u"unpause", u"destroy", u"rename", u"update",
+    u"health_status",
+}
+
 
 def main():
-    return agent_main(Collector())
+    return agent_main(_collector_from_environment(environ))
+
+
+def _collector_from_environment(environ):
+    return Collector(
+        client=DockerClient(
+            reactor, docker_client_settings_from_environment(environ),
+        ),
+        projection=_projection_from_environment(environ),
+        events=environ.get(b"CATALOG_DOCKER_EVENTS", b"1") == b"1",
+        reconcile_interval=timedelta(
+            seconds=float(
+                environ.get(
+                    b"CATALOG_DOCKER_RECONCILE_INTERVAL",
+                    DEFAULT_RECONCILE_INTERVAL.total_seconds(),
+                )
+            )
+        ),
+    )
+
+
+def _projection_from_environment(environ):
+    fields = DEFAULT_FIELDS
+    if b"CATALOG_DOCKER_FIELDS" in environ:
+        fields = list(
+            field.strip().decode("ascii")
+            for field in environ[b"CATALOG_DOCKER_FIELDS"].split(b",")
+            if field.strip()
+        )
+    return _projection(fields)
+
+
+def _projection(fields):
+    return Projection(list(fields) + list(_REQUIRED_FIELDS), ELIDED_FIELDS)
+
+
+def _event_container(event):
+    """
+    :return: The ID of the container a lifecycle event is about or ``None`` if
+        it isn't about a container's lifecycle.
+    """
+    if event.get(u"Type", u"container") != u"container":
+        return None
+    # Newer Docker versions have Action, older ones status.
+    action = event.get(u"Action", event.get(u"status", u""))
+    if action.split(u":")[0] not in _LIFECYCLE_EVENTS:
+        return None
+    return event.get(u"id", event.get(u"Actor", {}).get(u"ID"))
+
+
+def _daemon_identity(socket):
+    """
+    :return: Something which changes when the daemon listening on ``socket``
+        restarts and creates it again, or ``None`` if it can't be told.
+    """
+    try:
+        socket.restat()
+    except OSError:
+        return None
+    return (socket.getInodeNumber(), socket.getStatusChangeTime())
+
+
+class _InspectCache(object):
+    """
+    The reported details of containers as of the last time they changed.
+
+    Inspecting a container whose inspect document is byte for byte the same
+    as last time gives back the same details as before without decoding or
+    projecting it again.
+    """
+    def __init__(self, projection):
+        self._projection = projection
+        # Container ID -> (body digest, details, raw size, projected size)
+        self._cache = {}
+
+    def details(self, body, identity):
+        """
+        :param bytes body: The undecoded inspect document for ``identity``.
+
+        :return: The details to report for the container.
+        """
+        fingerprint = sha1(body).digest()
+        cached = self._cache.get(identity)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        details = self._projection.project(json.loads(body))
+        self._cache[identity] = (
+            fingerprint, details, len(body), len(json.dumps(details)),
+        )
+        return details
+
+    def record_sizes(self, docker_info):
+        """
+        Set the payload size gauges for a report of ``docker_info``.
+        """
+        raw = projected = 0
+        for details in docker_info:
+            cached = self._cache.get(details[u"Id"])
+            if cached is not None:
+                raw += cached[2]
+                projected += cached[3]
+        _PAYLOAD_BYTES.set(raw, stage="raw")
+        _PAYLOAD_BYTES.set(projected, stage="projected")
+
+    def forget(self, identity):
+        self._cache.pop(identity, None)
+
+    def retain(self, identities):
+        """
+        Forget every container except ``identities``.
+        """
+        identities = set(identities)
+        for identity in list(self._cache):
+            if identity not in identities:
+                del self._cache[identity]
 
 
 class Collector(object):
     name = b"docker"
 
-    def __init__(self):
-        self._client = docker.client.Client(
-            # /var/run is normally a symlink and this breaks when bind-mounting
-            # /host
-            base_url="unix://host/run/docker.sock",
-            version="1.19"
-        )
+    def __init__(
+        self, client=None, projection=None, events=False,
+        reconcile_interval=DEFAULT_RECONCILE_INTERVAL, reactor=reactor,
+    ):
+        if client is None:
+            client = DockerClient(reactor)
+        if projection is None:
+            projection = _projection(DEFAULT_FIELDS)
+        self._client = client
+        self._events = events
+        self._reconcile_interval = reconcile_interval.total_seconds()
+        self._reactor = reactor
+
+        self._inspections = _InspectCache(projection)
+        self._version = None
+        self._daemon = None
+
+        # Container ID -> details, for the events mode.
+        self._index = {}
+        self._changed = set()
+        self._watching = False
+        self._last_reconcile = None
+
+    def _inspect(self, identity):
+        inspecting = self._client.inspect_container(identity, decode=False)
+        inspecting.addCallback(self._inspections.details, identity)
+        return inspecting
 
     def _get_container_details(self, container_ids):
-        for identity in container_ids:
-            try:
-                details = deepcopy(self._client.inspect_container(identity))
-                details[u"Config"]["Env"] = u"<elided>"
-                yield details
-            except:
-                write_traceback()
+        """
+        Inspect all of ``container_ids`` at once, as far as the client's
+        concurrency limit allows.
+
+        :return: A ``Deferred`` firing with a ``list`` of the details of the
+            containers which could be inspected, in the same order.
+        """
+        def inspect(identity):
+            inspecting = self._inspect(identity)
+            inspecting.addErrback(write_failure)
+            return inspecting
+
+        inspecting = gatherResults(list(
+            inspect(identity) for identity in container_ids
+        ))
+        inspecting.addCallback(
+            lambda details: list(d for d in details if d is not None)
+        )
+        return inspecting
 
+    def _list(self):
+        listing = self._client.containers(all=True)
+
+        def inspect(all_containers):
+            identities = list(container[u"Id"] for container in all_containers)
+            self._inspections.retain(identities)
+            return self._get_container_details(identities)
+        listing.addCallback(inspect)
+        return listing
+
+    def _get_version(self):
+        """
+        :return: A ``Deferred`` firing with the daemon's version information,
+            which is only asked for again if the daemon may have restarted
+            since the last time.
+        """
+        daemon = _daemon_identity(self._client.socket)
+        if daemon is None or daemon != self._daemon:
+            self._version = None
+        if self._version is not None:
+            return succeed(self._version)
+        versioning = self._client.version()
+
+        def got_version(version):
+            self._version = version
+            self._daemon = daemon
+            return version
+        versioning.addCallback(got_version)
+        return versioning
 
     def collect(self):
-        all_containers = self._client.containers(all=True)
-        all_container_details = self._get_container_details(
-            container[u"Id"] for container in all_containers
+        if self._events:
+            collecting = self._collect_incrementally()
+        else:
+            collecting = self._list()
+        collecting = gatherResults(
+            [collecting, self._get_version()], consumeErrors=True,
         )
-        return succeed(dict(
-            docker_info=list(all_container_details),
-            docker_version=self._client.version(),
-        ))
+
+        def collected((docker_info, docker_version)):
+            self._inspections.record_sizes(docker_info)
+            return dict(
+                docker_info=docker_info,
+                docker_version=docker_version,
+            )
+        collecting.addCallback(collected)
+        return collecting
+
+    def _collect_incrementally(self):
+        if not self._watching:
+            # Start watching before listing so nothing that happens in
+            # between is missed.
+            self._watch()
+            updating = self._reconcile()
+        elif (
+            self._reactor.seconds() - self._last_reconcile >=
+            self._reconcile_interval
+        ):
+            updating = self._reconcile()
+        else:
+            updating = self._refresh()
+        # The same order as the full listing: newest first.
+        updating.addCallback(
+            lambda ignored: sorted(
+                self._index.values(),
+                key=lambda details: (details[u"Created"], details[u"Id"]),
+                reverse=True,
+            )
+        )
+        return updating
+
+    def _reconcile(self):
+        self._changed.clear()
+        self._last_reconcile = self._reactor.seconds()
+        listing = self._list()
+
+        def reconciled(docker_info):
+            self._index = dict(
+                (details[u"Id"], details) for details in docker_info
+            )
+        listing.addCallback(reconciled)
+        return listing
+
+    def _refresh(self):
+        changed, self._changed = self._changed, set()
+
+        def refresh(identity):
+            inspecting = self._inspect(identity)
+
+            def inspected(details):
+                self._index[details[u"Id"]] = details
+
+            def gone(reason):
+                reason.trap(NotFound)
+                self._index.pop(identity, None)
+                self._inspections.forget(identity)
+
+            def failed(reason):
+                write_failure(reason)
+                # Try again next time.
+                self._changed.add(identity)
+            inspecting.addCallbacks(inspected, gone)
+            inspecting.addErrback(failed)
+            return inspecting
+
+        return gatherResults(list(refresh(identity) for identity in changed))
+
+    def _watch(self):
+        self._watching = True
+        watching = self._client.events(
+            self._received_event, since=self._reactor.seconds(),
+        )
+        watching.addErrback(write_failure)
+        watching.addCallback(lambda ignored: self._stopped_watching())
+
+    def _received_event(self, event):
+        identity = _event_container(event)
+        if identity is not None:
+            self._changed.add(identity)
+            self._inspections.forget(identity)
+
+    def _stopped_watching(self):
+        # Maybe the daemon restarted.  Start watching again and do a full
+        # reconciliation on the next tick.
+        Message.new(system="docker-agent:events:stopped").write()
+        self._watching = False
+        self._version = None
@@ -0,0 +1,143 @@
+# A stand-in for Firehose, for running the agents locally.
+#
+# Reports are accepted at /v1/firehose/<collector> and envelopes at
+# /v1/firehose/envelope, with or without a Content-Encoding.  Envelopes are
+# split back into one document per collector in exactly the format that
+# collector would have posted on its own.  Every document is written to
+# stdout as a line of JSON and, if CATALOG_STUB_UPSTREAM is set (for example
+# to https://firehose.example.com:443), posted on to
+# <upstream>/v1/firehose/<collector>.
+
+from os import environ
+import json
+import sys
+import zlib
+
+import treq
+
+from eliot import Message, to_file, write_failure
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import react
+from twisted.python.log import startLogging
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.http import BAD_REQUEST, NOT_FOUND
+
+from ._envelope import ENVELOPE_NAME
+
+DEFAULT_PORT = 8080
+
+
+def main():
+    to_file(sys.stderr)
+    startLogging(sys.stderr)
+    return react(
+        _serve, [
+            int(environ.get("CATALOG_STUB_PORT", str(DEFAULT_PORT))),
+            environ.get("CATALOG_STUB_UPSTREAM"),
+        ],
+    )
+
+
+def _serve(reactor, port, upstream):
+    received = _Printer(sys.stdout)
+    if upstream is not None:
+        received = _Forwarder(received, upstream)
+    reactor.listenTCP(port, Site(FirehoseResource(received)))
+    return Deferred()
+
+
+def _decode(request):
+    body = request.content.read()
+    encoding = request.getHeader(b"content-encoding")
+    if encoding == b"gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == b"deflate":
+        return zlib.decompress(body)
+    return body
+
+
+def split_envelope(document):
+    """
+    Turn an envelope back into the documents its collectors would have sent
+    on their own.
+
+    :return: A ``list`` of two-tuples of collector name and document.
+    """
+    common = dict(
+        (key, value)
+        for (key, value) in document.items()
+        if key != ENVELOPE_NAME
+    )
+    documents = []
+    for entry in document[ENVELOPE_NAME]:
+        entry = dict(entry)
+        collector = entry.pop(u"collector")
+        entry.pop(u"sequence")
+        split = dict(common)
+        split.update(entry)
+        documents.append((collector, split))
+    return documents
+
+
+class FirehoseResource(Resource):
+    """
+    Accept reports and envelopes and pass every per-collector document to
+    ``received``.
+    """
+    isLeaf = True
+
+    def __init__(self, received):
+        Resource.__init__(self)
+        self._received = received
+
+    def render_POST(self, request):
+        segments = request.postpath
+        if len(segments) != 3 or segments[:2] != [b"v1", b"firehose"]:
+            request.setResponseCode(NOT_FOUND)
+            return b""
+        name = segments[2].decode("ascii")
+        try:
+            document = json.loads(_decode(request))
+            if name == ENVELOPE_NAME:
+                documents = split_envelope(document)
+            else:
+                documents = [(name, document)]
+        except (ValueError, KeyError, TypeError, zlib.error):
+            request.setResponseCode(BAD_REQUEST)
+            return b""
+        for (collector, document) in documents:
+            self._received(collector, document)
+        return b""
+
+
+class _Printer(object):
+    def __init__(self, output):
+        self._output = output
+
+    def __call__(self, collector, document):
+        self._output.write(
+            json.dumps(dict(collector=collector, document=document)) + "\n"
+        )
+        self._output.flush()
+
+
+class _Forwarder(object):
+    def __init__(self, received, upstream):
+        self._received = received
+        self._upstream = upstream
+
+    def __call__(self, collector, document):
+        self._received(collector, document)
+        location = u"{}/v1/firehose/{}".format(self._upstream, collector)
+        posting = treq.post(
+            location.encode("ascii"), json.dumps(document), timeout=30,
+        )
+        posting.addCallback(treq.content)
+        posting.addCallback(
+            lambda ignored: Message.new(
+                system="firehose-stub:forwarded", collector=collector,
+            ).write()
+        )
+        posting.addErrback(write_failure)
@@ -1,23 +1,105 @@
 # Report dataset state and configuration
 # Report nodes
 # Report control service version
+#
+# Only what changed since the last report is sent, with the complete state
+# sent every few minutes.
 
 # Note: Only run one instance of this collector.  It grabs cluster-wide
 # information and reports it.
 
+from datetime import timedelta
 from os import environ
 
 import yaml
 import treq
 
-from twisted.internet.defer import gatherResults
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, succeed
 from twisted.python.filepath import FilePath
 
-from .agentlib import get_client, agent_main
+from pyrsistent import PClass, field
+
+from .agentlib import (
+    CONTROL_SERVICE_POOL_SETTINGS, get_client, agent_main,
+)
+from ._httpclient import pool_settings_from_environment
+from ._metrics import counter, gauge
 from ._x509 import get_dns_subject_alt_name
 
 AGENT_YML = b"agent.yml"
 
+DEFAULT_RESYNC_INTERVAL = timedelta(minutes=5)
+
+# Each listing is polled every DEFAULT_MINIMUM_POLL_INTERVAL at first.  Once
+# it has been the same STABLE_POLLS times in a row its interval doubles with
+# every further unchanged poll, up to its maximum.  Any change brings it back
+# down to the minimum.
+DEFAULT_MINIMUM_POLL_INTERVAL = timedelta(seconds=5)
+STABLE_POLLS = 3
+
+# Report name -> (path, the field identifying each item, default maximum poll
+# interval)
+_LISTINGS = {
+    u"config": (
+        b"/configuration/datasets", u"dataset_id", timedelta(minutes=1),
+    ),
+    # Changes quickly while datasets move.
+    u"state": (b"/state/datasets", u"dataset_id", timedelta(seconds=30)),
+    # Rarely changes.
+    u"nodes": (b"/state/nodes", u"uuid", timedelta(minutes=5)),
+}
+
+_POLL_INTERVAL = gauge(
+    "catalog_agent_flocker_poll_interval_seconds",
+    "The current interval between polls of each control service listing.",
+)
+_POLLS = counter(
+    "catalog_agent_flocker_polls_total",
+    "Requests made to the control service, by listing.",
+)
+
+
+class PollSettings(PClass):
+    """
+    :ivar minimum_interval: The shortest time between two polls of a listing.
+    :ivar maximum_interval: The longest time between two polls of a listing.
+    """
+    minimum_interval = field(
+        type=timedelta, mandatory=True,
+        initial=DEFAULT_MINIMUM_POLL_INTERVAL,
+    )
+    maximum_interval = field(type=timedelta, mandatory=True)
+
+
+def poll_settings_from_environment(environ):
+    """
+    Read ``PollSettings`` for each listing from
+    ``CATALOG_FLOCKER_<LISTING>_MINIMUM_INTERVAL`` and
+    ``CATALOG_FLOCKER_<LISTING>_MAXIMUM_INTERVAL`` (in seconds), where
+    ``<LISTING>`` is ``CONFIG``, ``STATE`` or ``NODES``.
+
+    :return: A ``dict`` mapping listing names to ``PollSettings``.
+    """
+    all_settings = {}
+    for (name, (path, key, maximum_interval)) in _LISTINGS.items():
+        settings = PollSettings(maximum_interval=maximum_interval)
+        prefix = "CATALOG_FLOCKER_{}_".format(name.upper())
+        if prefix + "MINIMUM_INTERVAL" in environ:
+            settings = settings.set(
+                minimum_interval=timedelta(
+                    seconds=float(environ[prefix + "MINIMUM_INTERVAL"]),
+                ),
+            )
+        if prefix + "MAXIMUM_INTERVAL" in environ:
+            settings = settings.set(
+                maximum_interval=timedelta(
+                    seconds=float(environ[prefix + "MAXIMUM_INTERVAL"]),
+                ),
+            )
+        all_settings[name] = settings
+    return all_settings
+
 
 def main():
     collector = _collector_from_environment(environ)
@@ -45,34 +127,160 @@ def _collector_from_environment(environ):
             user_certificate_filename=environ.get(
                 b"FLOCKER_USER_CERT", "plugin.crt"
             ),
+            pool_settings=pool_settings_from_environment(
+                environ, "CATALOG_CONTROL_SERVICE",
+                CONTROL_SERVICE_POOL_SETTINGS,
+            ),
         ),
         base_url="https://{hostname}:4523/v1".format(hostname=target_hostname),
+        resync_interval=timedelta(
+            seconds=float(
+                environ.get(
+                    b"CATALOG_FLOCKER_RESYNC_INTERVAL",
+                    DEFAULT_RESYNC_INTERVAL.total_seconds(),
+                )
+            )
+        ),
+        poll_settings=poll_settings_from_environment(environ),
     )
 
 
+class _Index(object):
+    """
+    The items of one control service listing as of the last tick, keyed by
+    one of their fields.
+    """
+    def __init__(self, key):
+        self._key = key
+        self._items = {}
+
+    def update(self, items):
+        """
+        Replace the indexed items with ``items``.
+
+        :return: A ``dict`` describing how ``items`` differ from what was
+            indexed before: lists of the ``added`` and ``changed`` items and
+            of the keys of the ``removed`` ones.
+        """
+        previous, self._items = self._items, {}
+        added = []
+        changed = []
+        for item in items:
+            key = item[self._key]
+            self._items[key] = item
+            old = previous.pop(key, None)
+            if old is None:
+                added.append(item)
+            elif old != item:
+                changed.append(item)
+        return dict(added=added, changed=changed, removed=sorted(previous))
+
+
+class _Poll(object):
+    """
+    When to poll one listing next.
+    """
+    def __init__(self, settings):
+        self._minimum = settings.minimum_interval.total_seconds()
+        self._maximum = settings.maximum_interval.total_seconds()
+        self.interval = self._minimum
+        self.due = 0
+        self._stable = 0
+
+    def polled(self, now, changed):
+        if changed:
+            self._stable = 0
+            self.interval = self._minimum
+        else:
+            self._stable += 1
+            if self._stable >= STABLE_POLLS:
+                self.interval = min(self._maximum, self.interval * 2)
+        self.due = now + self.interval
+
+
 class _Collector(object):
+    """
+    Report the control service's dataset configuration, dataset state and
+    nodes.
+
+    Every ``resync_interval`` the complete listings are reported under
+    ``config``, ``state`` and ``nodes``.  In between only what was added,
+    changed or removed since the last report is, under ``config_changes``,
+    ``state_changes`` and ``nodes_changes``.  If a report isn't acknowledged
+    the next one is complete again.
+
+    Between complete reports each listing is only polled when it is due
+    according to its own adaptive interval, so a tick may poll some, all or
+    none of them.
+    """
     name = b"flocker"
 
-    def __init__(self, flocker_client, base_url):
+    def __init__(
+        self, flocker_client, base_url,
+        resync_interval=DEFAULT_RESYNC_INTERVAL, poll_settings=None,
+        clock=reactor,
+    ):
+        if poll_settings is None:
+            poll_settings = poll_settings_from_environment({})
         self._client = flocker_client
         self._base_url = base_url
+        self._resync_interval = resync_interval.total_seconds()
+        self._clock = clock
+        self._indexes = dict(
+            (name, _Index(key)) for (name, (path, key, _)) in _LISTINGS.items()
+        )
+        self._polls = dict(
+            (name, _Poll(settings))
+            for (name, settings) in poll_settings.items()
+        )
+        self._last_resync = None
+        self._unacknowledged = False
 
-    def collect(self):
-        d1 = self._client.get(self._base_url + "/configuration/datasets")
-        d1.addCallback(treq.json_content)
-
-        d2 = self._client.get(self._base_url + "/state/datasets")
-        d2.addCallback(treq.json_content)
-
-        d3 = self._client.get(self._base_url + "/state/nodes")
-        d3.addCallback(treq.json_content)
-
-        ds = [d1, d2, d3]
+    def _get(self, name):
+        _POLLS.inc(listing=name)
+        d = self._client.get(self._base_url + _LISTINGS[name][0])
+        d.addCallback(treq.json_content)
+        return d
 
-        d = gatherResults(ds)
+    def collect(self):
+        now = self._clock.seconds()
+        resync = (
+            self._unacknowledged or self._last_resync is None or
+            now - self._last_resync >= self._resync_interval
+        )
+        names = sorted(
+            name for name in _LISTINGS
+            if resync or self._polls[name].due <= now
+        )
+        if not names:
+            return succeed({})
+        d = gatherResults(list(self._get(name) for name in names))
         d.addCallback(
-            lambda (config, state, nodes): dict(
-                config=config, state=state, nodes=nodes,
-            )
+            lambda listings: self._indexed(zip(names, listings), resync)
         )
         return d
+
+    def _indexed(self, listings, resync):
+        now = self._clock.seconds()
+        changes = {}
+        for (name, items) in listings:
+            change = self._indexes[name].update(items)
+            changes[name] = change
+            poll = self._polls[name]
+            poll.polled(now, any(change.values()))
+            _POLL_INTERVAL.set(poll.interval, listing=name)
+
+        if resync:
+            self._last_resync = now
+            result = dict(listings)
+        else:
+            result = dict(
+                (name + u"_changes", change)
+                for (name, change) in changes.items()
+                if any(change.values())
+            )
+        self._unacknowledged = bool(result)
+        return result
+
+    def acknowledge(self, result):
+        self._unacknowledged = False
@@ -0,0 +1,65 @@
+# Run any subset of the collectors in one process.
+#
+# CATALOG_COLLECTORS is a comma separated list of collector names: flocker,
+# docker, log and node.  The collectors share one reactor, one connection pool
+# to Firehose and one scheduler.  A collector which fails is logged and tried
+# again later without disturbing the others.
+
+from os import environ
+
+from eliot import Message, write_traceback
+
+from . import docker_agent, flocker_agent, log_agent, node_agent
+from .agentlib import agents_main
+
+DEFAULT_COLLECTORS = b"docker,log,node"
+
+_COLLECTOR_FACTORIES = {
+    flocker_agent._Collector.name: flocker_agent._collector_from_environment,
+    docker_agent.Collector.name: docker_agent._collector_from_environment,
+    log_agent._Collector.name: log_agent._collector_from_environment,
+    node_agent._Collector.name: node_agent._collector_from_environment,
+}
+
+
+class NoCollectors(Exception):
+    """
+    None of the requested collectors could be created.
+    """
+
+
+def main():
+    return agents_main(_collectors_from_environment(environ), isolate=True)
+
+
+def _collectors_from_environment(environ):
+    names = list(
+        name.strip()
+        for name
+        in environ.get(b"CATALOG_COLLECTORS", DEFAULT_COLLECTORS).split(b",")
+        if name.strip()
+    )
+    for name in names:
+        if name not in _COLLECTOR_FACTORIES:
+            raise ValueError(
+                "Unknown collector {!r}, expected some of {}".format(
+                    name, b",".join(sorted(_COLLECTOR_FACTORIES)),
+                )
+            )
+
+    collectors = []
+    for name in names:
+        try:
+            collector = _COLLECTOR_FACTORIES[name](environ)
+        except:
+            # Don't let one collector that can't run here stop the rest.
+            write_traceback()
+            Message.new(
+                system="host-agent:collector-unavailable", collector=name,
+            ).write()
+        else:
+            collectors.append(collector)
+
+    if not collectors:
+        raise NoCollectors(names)
+    return collectors
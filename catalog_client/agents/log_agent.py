@@ -5,22 +5,66 @@
 #
 # Requires / from the host bind-mounted at /host to dig around the various
 # places logs can be found on those platforms.
+#
+# How far each log source has been reported is checkpointed so a restarted
+# agent carries on from there instead of from the end of the logs.
+
+from collections import deque
+from os import environ
 
+from twisted.internet import reactor
 from twisted.internet.defer import DeferredList
 
 from eliot import Message, write_traceback
 
 from .agentlib import agent_main
+from ._checkpoint import CheckpointStore, checkpoint_settings_from_environment
+from ._dockerclient import (
+    DockerClient, docker_client_settings_from_environment,
+)
 from ._dockerlogs import _DockerCollector
 from ._filelogs import _SyslogCollector
 from ._journallogs import _JournaldCollector
+from ._logbuffer import (
+    LogBufferSettings, LogFlushSettings, log_buffer_settings_from_environment,
+    log_flush_settings_from_environment,
+)
+from ._logfilter import LogFilter, log_filter_settings_from_environment
+from ._loglib import (
+    DEFAULT_CATCH_UP_RATE, _MultiStreamRecorder, record_upload_latency,
+)
+from ._logthrottle import LogThrottle, log_throttle_settings_from_environment
 
 
 def main():
-    collector = _Collector()
+    collector = _collector_from_environment(environ)
     return agent_main(collector)
 
 
+def _collector_from_environment(environ):
+    checkpoints = CheckpointStore.from_settings(
+        checkpoint_settings_from_environment(environ), reactor,
+    )
+    # Don't lose the last few seconds' checkpoints when stopped gracefully.
+    reactor.addSystemEventTrigger(b"before", b"shutdown", checkpoints.write)
+    return _Collector(
+        journald_follow=environ.get(b"CATALOG_JOURNALD_FOLLOW", b"1") == b"1",
+        checkpoints=checkpoints,
+        catch_up_rate=int(
+            environ.get(b"CATALOG_LOG_CATCH_UP_RATE", DEFAULT_CATCH_UP_RATE)
+        ),
+        docker_client=DockerClient(
+            reactor, docker_client_settings_from_environment(environ),
+        ),
+        log_filter=LogFilter(log_filter_settings_from_environment(environ)),
+        log_throttle=LogThrottle(
+            reactor, log_throttle_settings_from_environment(environ),
+        ),
+        buffer_settings=log_buffer_settings_from_environment(environ),
+        flush_settings=log_flush_settings_from_environment(environ),
+    )
+
+
 class NoApplicableDetector(Exception):
     """
     No collector detected an execution environment to which it is suited.
@@ -30,17 +74,81 @@ class NoApplicableDetector(Exception):
 class _Collector(object):
     name = b"log"
 
-    _COLLECTORS = [
-        # Order matters.
-        _SyslogCollector(),
-        _JournaldCollector(),
-
-        # XXX This one is broken.  It hangs after a while.  Make uft CoreOS
-        # configure Docker to send container logs to journald.
-        _DockerCollector(),
-    ]
+    # Each result is a batch of log lines which is never collected again so
+    # results are spooled to disk until Firehose acknowledges them.
+    durable = True
 
     _collector = None
+    _wake_up = None
+
+    def __init__(
+        self, journald_follow=True, checkpoints=None,
+        catch_up_rate=DEFAULT_CATCH_UP_RATE, docker_client=None,
+        log_filter=None, log_throttle=None,
+        buffer_settings=LogBufferSettings(),
+        flush_settings=LogFlushSettings(), reactor=reactor,
+    ):
+        """
+        :param bool journald_follow: Follow the journal with one long-lived
+            ``journalctl`` instead of running it for each unit on every
+            collection.
+        :param CheckpointStore checkpoints: Where to remember how far the
+            logs have been reported, or ``None`` to always start from the end
+            of them.
+        :param catch_up_rate: The most bytes per second to read from each
+            log while catching up from a checkpoint.
+        :param DockerClient docker_client: The client for the daemon running
+            Flocker's containers, if Flocker runs in containers.
+        :param LogFilter log_filter: What to parse and filter every log line
+            with before it is kept for reporting.  By default everything is
+            kept.
+        :param LogThrottle log_throttle: What to collapse repeated lines and
+            limit the rate of each unit's lines with, if anything.
+        :param LogBufferSettings buffer_settings: How many lines to hold for
+            each unit between collections.
+        :param LogFlushSettings flush_settings: When to ask to be collected
+            early and how much to report at once.
+        """
+        self._checkpoints = checkpoints
+        self._reactor = reactor
+        # (checkpoint, written) for each result reported but not yet known
+        # to be delivered, oldest first.
+        self._undelivered = deque()
+
+        self._recorders = {}
+
+        def recorder(collector_type):
+            recorder = self._recorders[collector_type] = _MultiStreamRecorder(
+                log_filter, log_throttle, buffer_settings, flush_settings,
+                self._flush,
+            )
+            return recorder
+
+        def checkpoint(collector_type):
+            if checkpoints is None:
+                return None
+            return checkpoints.get(collector_type.checkpoint_name)
+
+        self._COLLECTORS = [
+            # Order matters.
+            _SyslogCollector(
+                checkpoint=checkpoint(_SyslogCollector),
+                catch_up_rate=catch_up_rate,
+                recorder=recorder(_SyslogCollector),
+            ),
+            _JournaldCollector(
+                follow=journald_follow,
+                checkpoint=checkpoint(_JournaldCollector),
+                catch_up_rate=catch_up_rate,
+                recorder=recorder(_JournaldCollector),
+            ),
+            _DockerCollector(
+                docker_client=docker_client,
+                checkpoint=checkpoint(_DockerCollector),
+                catch_up_rate=catch_up_rate,
+                recorder=recorder(_DockerCollector),
+            ),
+        ]
 
     def _filter_detection(self, detection_results):
         applicable = []
@@ -98,4 +206,52 @@ class _Collector(object):
             d.addCallback(lambda ignored: self.collect())
             return d
 
-        return self._collector.collect()
+        collecting = self._collector.collect()
+
+        def collected(result):
+            recorder = self._recorders[type(self._collector)]
+            if recorder.size:
+                # Some lines didn't fit in this result so it doesn't have
+                # everything up to here.
+                checkpoint = None
+            else:
+                checkpoint = self._collector.checkpoint()
+            if result:
+                self._undelivered.append((checkpoint, recorder.written))
+            elif checkpoint is not None:
+                # Nothing to send.  The position is safe once everything
+                # before it is.
+                if self._undelivered:
+                    self._undelivered[-1] = (
+                        checkpoint, self._undelivered[-1][1],
+                    )
+                else:
+                    self._checkpoint(checkpoint)
+            return result
+        collecting.addCallback(collected)
+        return collecting
+
+    def set_wake_up(self, wake_up):
+        self._wake_up = wake_up
+
+    def _flush(self):
+        if self._wake_up is not None:
+            self._wake_up()
+
+    def delivered(self, uploaded):
+        """
+        The oldest result not yet delivered has been dealt with.
+
+        :param bool uploaded: Whether Firehose acknowledged it.  If so
+            checkpoint the positions it was collected up to.  If not it was
+            lost and a later result's checkpoint will cover it.
+        """
+        checkpoint, written = self._undelivered.popleft()
+        if uploaded:
+            record_upload_latency(written, self._reactor.seconds())
+            if checkpoint is not None:
+                self._checkpoint(checkpoint)
+
+    def _checkpoint(self, checkpoint):
+        if self._checkpoints is not None:
+            self._checkpoints.set(self._collector.checkpoint_name, checkpoint)
@@ -1,23 +1,232 @@
 # Collect Flocker version
+# Collect static facts about the node: kernel, operating system, hostname,
+# CPUs and memory.
+#
+# Finding out the Flocker version means starting a Python interpreter in the
+# host's filesystem.  It is only done again when the flocker-diagnostics
+# binary or the package database changes, or after a long while just in case.
 
-from os import environ
+from datetime import timedelta
+from os import environ, readlink
+import posixpath
 
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
 from twisted.internet.utils import getProcessOutput
+from twisted.python.filepath import FilePath
 
 from .agentlib import agent_main
 
+HOST = FilePath(b"/host")
+# The container shares the host's kernel, so its /proc describes the host.
+PROC = FilePath(b"/proc")
+
+# Where flocker-diagnostics may be installed on the host.
+DIAGNOSTICS_PATHS = (
+    b"/usr/bin/flocker-diagnostics",
+    b"/usr/local/bin/flocker-diagnostics",
+    b"/opt/flocker/bin/flocker-diagnostics",
+)
+# Package databases on the host which change whenever a package is
+# installed, upgraded or removed.
+PACKAGE_DATABASES = (
+    b"/var/lib/dpkg/status",
+    b"/var/lib/rpm/Packages",
+    b"/var/lib/rpm/rpmdb.sqlite",
+)
+
+DEFAULT_RECHECK_INTERVAL = timedelta(hours=1)
+
+# Don't follow symlinks around in circles forever.
+_MAXIMUM_SYMLINKS = 16
+
 
 def main():
-    return agent_main(_Collector())
+    return agent_main(_collector_from_environment(environ))
+
+
+def _collector_from_environment(environ):
+    return _Collector(
+        recheck_interval=timedelta(
+            seconds=float(
+                environ.get(
+                    b"CATALOG_NODE_RECHECK_INTERVAL",
+                    DEFAULT_RECHECK_INTERVAL.total_seconds(),
+                )
+            )
+        ),
+    )
+
+
+def _host_path(host, path):
+    """
+    Find ``path`` in the host's filesystem, resolving symlinks the way the
+    host would.
+
+    :param bytes path: An absolute path on the host.
+
+    :return: The resolved ``FilePath`` or ``None`` if there's nothing there.
+    """
+    path = posixpath.normpath(path)
+    for _ in range(_MAXIMUM_SYMLINKS):
+        target = FilePath(host.path + path)
+        if not target.islink():
+            if target.exists():
+                return target
+            return None
+        destination = readlink(target.path)
+        path = posixpath.normpath(
+            posixpath.join(posixpath.dirname(path), destination)
+        )
+    return None
+
+
+def _identity(path):
+    """
+    :return: Something which changes when the file at ``path`` is replaced or
+        modified.
+    """
+    path.restat()
+    return (path.getInodeNumber(), path.getModificationTime(), path.getsize())
+
+
+def _read_key_values(path, separator):
+    """
+    Read a file of ``key<separator>value`` lines, like ``/etc/os-release`` or
+    ``/proc/meminfo``.
+    """
+    values = {}
+    for line in path.getContent().splitlines():
+        key, found, value = line.partition(separator)
+        if found:
+            values[key.strip()] = value.strip()
+    return values
+
+
+def _os_release(host):
+    path = _host_path(host, b"/etc/os-release")
+    if path is None:
+        return None
+    values = _read_key_values(path, b"=")
+    return dict(
+        (key.lower(), values[key].strip(b"\"'").decode("utf-8"))
+        for key in (b"ID", b"VERSION_ID", b"PRETTY_NAME")
+        if key in values
+    )
+
+
+def _hostname(host):
+    path = _host_path(host, b"/etc/hostname")
+    if path is None:
+        return None
+    return path.getContent().strip().decode("utf-8")
+
+
+def _memory_bytes(proc):
+    # Like "MemTotal:        2048256 kB"
+    total = _read_key_values(proc.child(b"meminfo"), b":")[b"MemTotal"]
+    amount, unit = total.split()
+    return int(amount) * {b"kB": 1024}[unit]
+
+
+def _cpus(proc):
+    return sum(
+        1 for line in proc.child(b"cpuinfo").getContent().splitlines()
+        if line.split(b":")[0].strip() == b"processor"
+    )
+
+
+def _static_facts(host, proc):
+    """
+    :return: A ``dict`` of facts about the node which hardly ever change.
+    """
+    return dict(
+        kernel=proc.descendant(
+            [b"sys", b"kernel", b"osrelease"]
+        ).getContent().strip().decode("utf-8"),
+        os=_os_release(host),
+        hostname=_hostname(host),
+        cpus=_cpus(proc),
+        memory_bytes=_memory_bytes(proc),
+    )
 
 
 class _Collector(object):
+    """
+    Report the node's Flocker version and static facts.
+
+    They are only looked up again when something which would change them
+    changed, or every ``recheck_interval`` in case that was missed.
+    """
     name = b"node"
 
+    def __init__(
+        self, recheck_interval=DEFAULT_RECHECK_INTERVAL, host=HOST, proc=PROC,
+        reactor=reactor,
+    ):
+        self._recheck_interval = recheck_interval.total_seconds()
+        self._host = host
+        self._proc = proc
+        self._reactor = reactor
+        self._fingerprint = None
+        self._checked = None
+        self._result = None
+
+    def _diagnostics(self):
+        for path in DIAGNOSTICS_PATHS:
+            found = _host_path(self._host, path)
+            if found is not None:
+                return path, found
+        return None, None
+
+    def _current_fingerprint(self):
+        """
+        :return: The identities of the flocker-diagnostics binary and of the
+            package databases, or ``None`` if they can't be told right now.
+        """
+        fingerprint = []
+        try:
+            for path in (self._diagnostics()[1],) + tuple(
+                _host_path(self._host, database)
+                for database in PACKAGE_DATABASES
+            ):
+                if path is None:
+                    fingerprint.append(None)
+                else:
+                    fingerprint.append(_identity(path))
+        except OSError:
+            # Something was replaced as it was looked at, by a package
+            # upgrade perhaps.  Take it as changed.
+            return None
+        return tuple(fingerprint)
+
     def collect(self):
-        return getProcessOutput(
-            b"chroot", [b"/host", b"flocker-diagnostics", b"--version"],
-            env=environ,
-        ).addCallback(
-            lambda version: version.strip()
+        now = self._reactor.seconds()
+        fingerprint = self._current_fingerprint()
+        if (
+            self._result is not None and
+            fingerprint is not None and
+            fingerprint == self._fingerprint and
+            now - self._checked < self._recheck_interval
+        ):
+            return succeed(self._result)
+
+        diagnostics = self._diagnostics()[0]
+        if diagnostics is None:
+            # Maybe it's somewhere else on the host's PATH.
+            diagnostics = b"flocker-diagnostics"
+        versioning = getProcessOutput(
+            b"chroot", [self._host.path, diagnostics, b"--version"],
+            env=environ, reactor=self._reactor,
         )
+        versioning.addCallback(lambda version: version.strip())
+
+        def checked(version):
+            result = _static_facts(self._host, self._proc)
+            result["flocker_version"] = version
+            self._result = result
+            self._fingerprint = fingerprint
+            self._checked = now
+            return result
+        versioning.addCallback(checked)
+        return versioning
@@ -0,0 +1,177 @@
+"""
+Tests for ``agents.agentlib``.
+"""
+
+import json
+
+from OpenSSL.crypto import FILETYPE_PEM
+
+from pyrsistent import pmap
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, succeed
+from twisted.internet.ssl import Certificate
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+
+from .. import _httpclient
+from .._httpclient import Delivery, _pool
+from ..agentlib import HTTPReporter, get_client
+from .test_envelope import _Reactor
+from .test_httpclient import _MutualTLSServer, _get_body, _self_signed
+
+
+def _certificates(path, cluster, user):
+    """
+    Write the files a Flocker node has for talking to the control service.
+
+    :param cluster: The ``Certificate`` of the cluster.
+    :param user: The ``PrivateCertificate`` to present.
+    """
+    path.makedirs()
+    path.child(b"cluster.crt").setContent(cluster.dumpPEM())
+    path.child(b"plugin.crt").setContent(user.dumpPEM())
+    path.child(b"plugin.key").setContent(user.privateKey.dump(FILETYPE_PEM))
+    path.child(b"agent.yml").setContent(
+        b"control-service:\n  hostname: control-service\n",
+    )
+
+
+class GetClientConfigurationTests(SynchronousTestCase):
+    """
+    Tests for how ``get_client`` finds what it needs.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        user = _self_signed(b"plugin")
+        _certificates(self.path, Certificate(user.original), user)
+
+    def test_agent_yml(self):
+        """
+        Without a hostname the control service's is read from ``agent.yml``.
+        """
+        get_client(certificates_path=self.path)
+        self.path.child(b"agent.yml").remove()
+        self.assertRaises(Exception, get_client, certificates_path=self.path)
+
+    def test_missing_certificate(self):
+        """
+        Without all of the certificate files there's no client.
+        """
+        self.path.child(b"plugin.key").remove()
+        self.assertRaises(
+            Exception, get_client, certificates_path=self.path,
+            target_hostname=b"control-service",
+        )
+
+
+class GetClientTests(TestCase):
+    """
+    Tests for ``get_client`` against a real TLS server.
+    """
+    def setUp(self):
+        cluster = _self_signed(b"control-service")
+        user = _self_signed(b"plugin")
+        self.server = _MutualTLSServer(
+            self, cluster, Certificate(user.original),
+        )
+        path = FilePath(self.mktemp())
+        _certificates(path, Certificate(cluster.original), user)
+        pools = []
+
+        def pool(reactor, settings, name):
+            pools.append(_pool(reactor, settings, name))
+            return pools[-1]
+        self.patch(_httpclient, "_pool", pool)
+        self.client = get_client(reactor=reactor, certificates_path=path)
+        [self.pool] = pools
+        self.addCleanup(
+            lambda: gatherResults([
+                self.pool.closeCachedConnections(),
+                self.server.connections.closed(),
+            ])
+        )
+
+    def test_authenticated(self):
+        """
+        The client presents the node's certificate and accepts a control
+        service with a certificate from the cluster, on one connection for
+        many requests.
+        """
+        getting = _get_body(self.client, self.server.url())
+        getting.addCallback(
+            lambda body: _get_body(
+                self.client, self.server.url(),
+            ).addCallback(lambda again: [body, again]),
+        )
+
+        def got(bodies):
+            self.assertEqual(
+                ([b"plugin", b"plugin"], 1),
+                (bodies, len(self.server.connections.protocols)),
+            )
+        getting.addCallback(got)
+        return getting
+
+
+class _Response(object):
+    code = 200
+
+
+class _Client(object):
+    def __init__(self):
+        self.posted = []
+
+    def post(self, url, data, headers, timeout):
+        self.posted.append((url, data))
+        return succeed(
+            Delivery(response=_Response(), body=b"", sent_bytes=len(data)),
+        )
+
+
+class HTTPReporterTests(SynchronousTestCase):
+    """
+    Tests for ``HTTPReporter``.
+    """
+    def setUp(self):
+        self.client = _Client()
+        self.reporter = HTTPReporter(
+            common={u"secret": u"s"}, location=u"https://firehose/v1/node",
+            client=self.client, reactor=_Reactor(),
+        )
+
+    def test_send(self):
+        """
+        The fields are posted with the common fields.
+        """
+        self.successResultOf(self.reporter.send(pmap({u"result": [1]})))
+        [(url, body)] = self.client.posted
+        self.assertEqual(
+            (b"https://firehose/v1/node", {u"secret": u"s", u"result": [1]}),
+            (url, json.loads(body)),
+        )
+
+    def test_serialized(self):
+        """
+        Fields which are already serialized are put in the body as they are.
+        """
+        self.successResultOf(
+            self.reporter.send(
+                pmap({u"a": 1}), serialized=pmap({u"b": b"[2, 3]"}),
+            )
+        )
+        [(_, body)] = self.client.posted
+        self.assertEqual(
+            {u"secret": u"s", u"a": 1, u"b": [2, 3]}, json.loads(body),
+        )
+
+    def test_only_serialized(self):
+        """
+        Already serialized fields can be all there is to the body.
+        """
+        self.reporter = self.reporter.set(common=pmap())
+        self.successResultOf(
+            self.reporter.send(pmap(), serialized=pmap({u"b": b"2"})),
+        )
+        [(_, body)] = self.client.posted
+        self.assertEqual({u"b": 2}, json.loads(body))
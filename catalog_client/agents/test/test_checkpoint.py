@@ -0,0 +1,116 @@
+"""
+Tests for ``agents._checkpoint``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._checkpoint import (
+    DEFAULT_CHECKPOINT_PATH, CheckpointSettings, CheckpointStore,
+    checkpoint_settings_from_environment,
+)
+
+
+class CheckpointSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``checkpoint_settings_from_environment``.
+    """
+    def test_defaults(self):
+        """
+        Without any of the variables the default path is used.
+        """
+        self.assertEqual(
+            FilePath(DEFAULT_CHECKPOINT_PATH),
+            checkpoint_settings_from_environment({}).path,
+        )
+
+    def test_variables(self):
+        """
+        Each variable overrides one setting.
+        """
+        self.assertEqual(
+            CheckpointSettings(
+                path=FilePath(b"/checkpoints"), write_interval=1,
+            ),
+            checkpoint_settings_from_environment({
+                "CATALOG_CHECKPOINT_PATH": b"/checkpoints",
+                "CATALOG_CHECKPOINT_WRITE_INTERVAL": "1",
+            }),
+        )
+
+
+class CheckpointStoreTests(SynchronousTestCase):
+    """
+    Tests for ``CheckpointStore``.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp()).child(b"checkpoints")
+        self.clock = Clock()
+        self.store = self.open()
+
+    def open(self):
+        return CheckpointStore(self.path, 5, self.clock)
+
+    def test_get(self):
+        """
+        ``get`` gives the last position set, or ``None``.
+        """
+        self.store.set(u"a", 1)
+        self.store.set(u"a", {u"offset": 2})
+        self.assertEqual(
+            ({u"offset": 2}, None),
+            (self.store.get(u"a"), self.store.get(u"b")),
+        )
+
+    def test_written_later(self):
+        """
+        Positions set are written out together once the write interval has
+        passed, and read back when the store is opened again.
+        """
+        self.store.set(u"a", 1)
+        self.clock.advance(4)
+        self.store.set(u"b", u"cursor")
+        self.assertEqual(None, self.open().get(u"a"))
+        self.clock.advance(1)
+        reopened = self.open()
+        self.assertEqual(
+            (1, u"cursor"), (reopened.get(u"a"), reopened.get(u"b")),
+        )
+
+    def test_unchanged(self):
+        """
+        Setting a position to what it already is doesn't cause a write.
+        """
+        self.store.set(u"a", 1)
+        self.clock.advance(5)
+        self.store.set(u"a", 1)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_write(self):
+        """
+        ``write`` writes straight away and cancels the pending write.
+        """
+        self.store.set(u"a", 1)
+        self.store.write()
+        self.assertEqual(
+            (1, []), (self.open().get(u"a"), self.clock.getDelayedCalls()),
+        )
+
+    def test_corrupt(self):
+        """
+        A file which can't be read is ignored.
+        """
+        self.path.parent().makedirs()
+        self.path.setContent(b"{")
+        self.assertEqual(None, self.open().get(u"a"))
+
+    def test_write_failed(self):
+        """
+        A failure to write is logged rather than raised, and the positions
+        are kept to write later.
+        """
+        self.path.parent().setContent(b"")
+        self.store.set(u"a", 1)
+        self.clock.advance(5)
+        self.assertEqual(1, self.store.get(u"a"))
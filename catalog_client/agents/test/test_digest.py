@@ -0,0 +1,135 @@
+"""
+Tests for ``agents._digest``.
+"""
+
+from pyrsistent import freeze
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._digest import Digests, child_digests, digest
+from .._patch import diff
+
+
+class DigestTests(SynchronousTestCase):
+    """
+    Tests for ``digest``.
+    """
+    def test_key_order(self):
+        """
+        Dicts with the same items have the same digest whatever their order.
+        """
+        self.assertEqual(
+            digest({u"a": 1, u"b": [2]}).digest,
+            digest(dict([(u"b", [2]), (u"a", 1)])).digest,
+        )
+
+    def test_bytes(self):
+        """
+        ``bytes`` and ``unicode`` strings which encode to the same JSON have
+        the same digest.
+        """
+        self.assertEqual(
+            digest({b"a": [b"b"]}).digest, digest({u"a": [u"b"]}).digest,
+        )
+
+    def test_frozen(self):
+        """
+        Frozen values have the same digest as thawed ones.
+        """
+        value = {u"a": [1, {u"b": 2}]}
+        self.assertEqual(digest(value).digest, digest(freeze(value)).digest)
+
+    def test_different(self):
+        """
+        Values which differ anywhere have different digests.
+        """
+        self.assertNotEqual(
+            digest({u"a": [1, {u"b": 2}]}).digest,
+            digest({u"a": [1, {u"b": 3}]}).digest,
+        )
+
+    def test_list_dict(self):
+        """
+        A list and a dict with the same items don't have the same digest.
+        """
+        self.assertNotEqual(
+            digest([u"a"]).digest, digest({0: u"a"}).digest,
+        )
+
+    def test_children(self):
+        """
+        There are digests for the dicts and lists in a value, and not for
+        its other children.
+        """
+        digests = digest({u"a": [1, {u"b": 2}], u"c": 3})
+        self.assertEqual(
+            (
+                [u"a"],
+                [1],
+                digest({u"b": 2}).digest,
+                None,
+            ),
+            (
+                digests.children.keys(),
+                digests.children[u"a"].children.keys(),
+                child_digests(child_digests(digests, u"a"), 1).digest,
+                child_digests(digests, u"c").digest,
+            ),
+        )
+
+
+class DiffWithDigestsTests(SynchronousTestCase):
+    """
+    Tests for ``agents._patch.diff`` given ``Digests``.
+    """
+    def test_same_digest_skipped(self):
+        """
+        Branches with the same digest aren't compared.
+        """
+        old = {u"a": {u"b": 1}, u"c": 1}
+        new = {u"a": {u"b": 2}, u"c": 2}
+        same = Digests(b"same", {})
+        self.assertEqual(
+            [dict(op=u"replace", path=u"/c", value=2)],
+            diff(
+                old, new,
+                Digests(b"old", {u"a": same}),
+                Digests(b"new", {u"a": same}),
+            ),
+        )
+
+    def test_digests(self):
+        """
+        With the real digests only the branches which changed are in the
+        patch.
+        """
+        old = {u"a": [{u"b": 1}, {u"b": 2}], u"c": {u"d": 1}}
+        new = {u"a": [{u"b": 1}, {u"b": 3}], u"c": {u"d": 1}}
+        self.assertEqual(
+            [dict(op=u"replace", path=u"/a/1/b", value=3)],
+            diff(old, new, digest(old), digest(new)),
+        )
+
+    def test_bytes_and_unicode(self):
+        """
+        A ``bytes`` string isn't replaced by the same ``unicode`` string.
+        """
+        self.assertEqual([], diff({u"a": b"b"}, {u"a": u"b"}))
+
+    def test_int_and_long(self):
+        """
+        An ``int`` isn't replaced by the same ``long``.
+        """
+        self.assertEqual([], diff([1], [1L]))
+
+    def test_different_json(self):
+        """
+        Values which are equal in Python but not in JSON are replaced.
+        """
+        self.assertEqual(
+            [
+                dict(op=u"replace", path=u"/0", value=1.0),
+                dict(op=u"replace", path=u"/1", value=True),
+            ],
+            diff([1, 1], [1.0, True]),
+        )
@@ -0,0 +1,245 @@
+"""
+Tests for ``agents.docker_agent``.
+"""
+
+from datetime import timedelta
+import json
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._dockerclient import DockerError, NotFound
+from .._metrics import REGISTRY
+from ..docker_agent import Collector, _InspectCache
+
+
+class _Projection(object):
+    """
+    A projection which keeps everything and counts how often it is used.
+    """
+    projected = 0
+
+    def project(self, value):
+        self.projected += 1
+        return value
+
+
+class InspectCacheTests(SynchronousTestCase):
+    """
+    Tests for ``_InspectCache``.
+    """
+    def setUp(self):
+        self.projection = _Projection()
+        self.cache = _InspectCache(self.projection)
+
+    def test_same_body(self):
+        """
+        The same inspect document gives the same details without being
+        decoded or projected again.
+        """
+        body = json.dumps({u"Id": u"a", u"State": {u"Running": True}})
+        details = self.cache.details(body, u"a")
+        self.assertIs(details, self.cache.details(body, u"a"))
+        self.assertEqual(1, self.projection.projected)
+
+    def test_changed_body(self):
+        """
+        A changed inspect document is decoded and projected again.
+        """
+        self.cache.details(json.dumps({u"Id": u"a", u"n": 1}), u"a")
+        details = self.cache.details(json.dumps({u"Id": u"a", u"n": 2}), u"a")
+        self.assertEqual(
+            ({u"Id": u"a", u"n": 2}, 2),
+            (details, self.projection.projected),
+        )
+
+    def test_forget(self):
+        """
+        A forgotten container's document is projected again.
+        """
+        body = json.dumps({u"Id": u"a"})
+        self.cache.details(body, u"a")
+        self.cache.forget(u"a")
+        self.cache.details(body, u"a")
+        self.assertEqual(2, self.projection.projected)
+
+    def test_retain(self):
+        """
+        ``retain`` forgets every other container.
+        """
+        bodies = dict(
+            (identity, json.dumps({u"Id": identity}))
+            for identity in (u"a", u"b")
+        )
+        for identity, body in bodies.items():
+            self.cache.details(body, identity)
+        self.cache.retain([u"a"])
+        for identity, body in bodies.items():
+            self.cache.details(body, identity)
+        self.assertEqual(3, self.projection.projected)
+
+    def test_record_sizes(self):
+        """
+        ``record_sizes`` sets the gauges to the sizes of the documents and
+        details of the containers reported.
+        """
+        body = json.dumps({u"Id": u"a"}) + b"   "
+        details = self.cache.details(body, u"a")
+        self.cache.record_sizes([details])
+        self.assertEqual(
+            {u"stage=raw": len(body), u"stage=projected": len(body) - 3},
+            REGISTRY.snapshot()["catalog_agent_docker_payload_bytes"],
+        )
+
+
+def _container(identity, created, **fields):
+    details = dict(Id=identity, Created=created)
+    details.update(fields)
+    return details
+
+
+class _DockerClient(object):
+    """
+    A ``DockerClient`` for a daemon with the containers in ``containers``.
+
+    :ivar watches: ``(received, since, ended)`` for each time the events
+        stream was followed.  Firing ``ended`` ends that stream.
+    """
+    def __init__(self, socket):
+        self.socket = socket
+        self.containers_by_id = {}
+        self.broken = set()
+        self.inspected = []
+        self.watches = []
+
+    def add(self, *containers):
+        for container in containers:
+            self.containers_by_id[container[u"Id"]] = container
+
+    def containers(self, all=False):
+        return succeed(
+            list({u"Id": identity} for identity in self.containers_by_id)
+        )
+
+    def inspect_container(self, identity, decode=True):
+        self.inspected.append(identity)
+        if identity in self.broken:
+            return fail(DockerError(500, b"broken"))
+        container = self.containers_by_id.get(identity)
+        if container is None:
+            return fail(NotFound(404, b"no such container"))
+        return succeed(json.dumps(container))
+
+    def version(self):
+        return succeed({u"Version": u"1.10"})
+
+    def events(self, received, since=None):
+        ended = Deferred()
+        self.watches.append((received, since, ended))
+        return ended
+
+    def event(self, identity, action):
+        received = self.watches[-1][0]
+        received({u"Type": u"container", u"Action": action, u"id": identity})
+
+
+class EventsCollectorTests(SynchronousTestCase):
+    """
+    Tests for ``Collector`` following the Docker events stream.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.client = _DockerClient(FilePath(self.mktemp()))
+        self.client.add(_container(u"a", 1), _container(u"b", 2))
+        self.collector = Collector(
+            client=self.client, projection=_Projection(), events=True,
+            reconcile_interval=timedelta(seconds=60), reactor=self.clock,
+        )
+
+    def collect(self):
+        """
+        :return: The IDs of the containers collected and of those inspected
+            to collect them.
+        """
+        del self.client.inspected[:]
+        result = self.successResultOf(self.collector.collect())
+        return (
+            list(details[u"Id"] for details in result[u"docker_info"]),
+            sorted(self.client.inspected),
+        )
+
+    def test_first(self):
+        """
+        The first collection starts following events from now and then lists
+        and inspects every container, newest first.
+        """
+        self.clock.advance(100)
+        self.assertEqual(([u"b", u"a"], [u"a", u"b"]), self.collect())
+        self.assertEqual([100], list(w[1] for w in self.client.watches))
+
+    def test_changed(self):
+        """
+        After that only containers with lifecycle events since the last
+        collection are inspected again.
+        """
+        self.collect()
+        self.client.add(_container(u"a", 1, State=u"stopped"))
+        self.client.event(u"a", u"die")
+        self.client.event(u"b", u"exec_start: sh")
+        self.client.add(_container(u"c", 3))
+        self.client.event(u"c", u"create")
+        self.assertEqual(([u"c", u"b", u"a"], [u"a", u"c"]), self.collect())
+
+    def test_destroy(self):
+        """
+        A destroyed container is no longer reported.
+        """
+        self.collect()
+        del self.client.containers_by_id[u"a"]
+        self.client.event(u"a", u"destroy")
+        self.assertEqual(([u"b"], [u"a"]), self.collect())
+
+    def test_inspect_failed(self):
+        """
+        A container which couldn't be inspected is inspected again on the
+        next collection.
+        """
+        self.collect()
+        self.client.broken.add(u"a")
+        self.client.event(u"a", u"start")
+        self.collect()
+        self.flushLoggedErrors(DockerError)
+        self.client.broken.clear()
+        self.assertEqual(([u"b", u"a"], [u"a"]), self.collect())
+
+    def test_reconcile(self):
+        """
+        Every reconcile interval every container is listed and inspected
+        again, catching changes whose events were missed.
+        """
+        self.collect()
+        self.client.add(_container(u"c", 3))
+        self.clock.advance(30)
+        self.assertEqual(([u"b", u"a"], []), self.collect())
+        self.clock.advance(30)
+        self.assertEqual(
+            ([u"c", u"b", u"a"], [u"a", u"b", u"c"]), self.collect(),
+        )
+
+    def test_stream_ended(self):
+        """
+        If the events stream ends it is followed again on the next
+        collection, from then on, and everything is listed again to catch up
+        on what happened while it wasn't followed.
+        """
+        self.collect()
+        self.clock.advance(10)
+        self.client.watches[0][2].callback(None)
+        self.client.add(_container(u"c", 3))
+        self.clock.advance(5)
+        self.assertEqual(
+            ([u"c", u"b", u"a"], [u"a", u"b", u"c"]), self.collect(),
+        )
+        self.assertEqual([0, 15], list(w[1] for w in self.client.watches))
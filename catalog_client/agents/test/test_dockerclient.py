@@ -0,0 +1,231 @@
+"""
+Tests for ``agents._dockerclient``.
+"""
+
+from datetime import timedelta
+import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from .._dockerclient import (
+    STDERR, STDOUT, DockerClient, DockerClientSettings, DockerError,
+    NotFound, _FRAME_HEADER, _FrameStream, _JSONStream, _with_timeout,
+    docker_client_settings_from_environment,
+)
+from .test_httpclient import _Connections
+
+
+def _frame(stream, payload):
+    return _FRAME_HEADER.pack(stream, len(payload)) + payload
+
+
+class DockerClientSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``docker_client_settings_from_environment``.
+    """
+    def test_variables(self):
+        """
+        Each variable overrides one setting.
+        """
+        self.assertEqual(
+            DockerClientSettings(
+                socket=b"/docker.sock", concurrency=2,
+                timeout=timedelta(seconds=2.5),
+            ),
+            docker_client_settings_from_environment({
+                "CATALOG_DOCKER_SOCKET": b"/docker.sock",
+                "CATALOG_DOCKER_CONCURRENCY": "2",
+                "CATALOG_DOCKER_TIMEOUT": "2.5",
+            }),
+        )
+
+
+class JSONStreamTests(SynchronousTestCase):
+    """
+    Tests for ``_JSONStream``.
+    """
+    def setUp(self):
+        self.received = []
+        self.stream = _JSONStream(self.received.append)
+
+    def test_concatenated(self):
+        """
+        Documents are passed on one by one, whether or not there is
+        whitespace between them.
+        """
+        self.stream.feed(b'{"a": 1}{"b": 2}\n {"c": 3}\n')
+        self.assertEqual(
+            [{u"a": 1}, {u"b": 2}, {u"c": 3}], self.received,
+        )
+
+    def test_split(self):
+        """
+        A document split between chunks is passed on once it is complete.
+        """
+        self.stream.feed(b'{"a": ')
+        self.assertEqual([], self.received)
+        self.stream.feed(b'1} {"b"')
+        self.stream.feed(b': 2}')
+        self.assertEqual([{u"a": 1}, {u"b": 2}], self.received)
+
+
+class FrameStreamTests(SynchronousTestCase):
+    """
+    Tests for ``_FrameStream``.
+    """
+    def setUp(self):
+        self.received = []
+
+    def test_frames(self):
+        """
+        Each chunk's complete frames are passed on together.
+        """
+        stream = _FrameStream(self.received.append)
+        stream.feed(_frame(STDOUT, b"out\n") + _frame(STDERR, b"err\n"))
+        self.assertEqual(
+            [[(STDOUT, b"out\n"), (STDERR, b"err\n")]], self.received,
+        )
+
+    def test_split(self):
+        """
+        A frame split between chunks, even within its header, is passed on
+        once it is complete.
+        """
+        data = _frame(STDOUT, b"one\n") + _frame(STDERR, b"two\n")
+        stream = _FrameStream(self.received.append)
+        for chunk in (data[:3], data[3:10], data[10:22], data[22:]):
+            stream.feed(chunk)
+        self.assertEqual(
+            [[(STDOUT, b"one\n")], [(STDERR, b"two\n")]], self.received,
+        )
+
+    def test_not_multiplexed(self):
+        """
+        Without multiplexing everything is passed on as it arrives, as
+        stdout.
+        """
+        stream = _FrameStream(self.received.append, multiplexed=False)
+        stream.feed(b"partial ")
+        self.assertEqual([[(STDOUT, b"partial ")]], self.received)
+
+
+class WithTimeoutTests(SynchronousTestCase):
+    """
+    Tests for ``_with_timeout``.
+    """
+    def test_in_time(self):
+        """
+        A result in time is passed on and the timeout is cancelled.
+        """
+        clock = Clock()
+        waiting = Deferred()
+        d = _with_timeout(clock, 5, waiting)
+        waiting.callback(1)
+        self.assertEqual((1, []), (self.successResultOf(d), clock.calls))
+
+    def test_timeout(self):
+        """
+        Without a result in time it fails with ``TimeoutError``.
+        """
+        clock = Clock()
+        d = _with_timeout(clock, 5, Deferred())
+        clock.advance(5)
+        self.failureResultOf(d, TimeoutError)
+
+
+class _Container(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.postpath == [b"json"]:
+            return json.dumps({u"Id": request.prepath[-1].decode("ascii")})
+        request.setResponseCode(500)
+        return b"broken"
+
+
+class _Containers(Resource):
+    def render_GET(self, request):
+        return json.dumps([{u"all": request.args[b"all"]}])
+
+    def getChild(self, name, request):
+        if name == b"json":
+            return self
+        if name == b"missing":
+            return Resource.getChild(self, name, request)
+        return _Container()
+
+
+class DockerClientTests(TestCase):
+    """
+    Tests for ``DockerClient`` against a server on a real unix socket.
+    """
+    def setUp(self):
+        version = Resource()
+        version.putChild(b"containers", _Containers())
+        root = Resource()
+        root.putChild(b"v1.19", version)
+        self.connections = _Connections(Site(root))
+        path = self.mktemp()
+        port = reactor.listenUNIX(path, self.connections)
+        self.addCleanup(port.stopListening)
+        self.client = DockerClient(
+            reactor, DockerClientSettings(socket=path),
+        )
+        self.addCleanup(self._close)
+
+    def _close(self):
+        return gatherResults([
+            self.client.pool.closeCachedConnections(),
+            self.connections.closed(),
+        ])
+
+    def test_containers(self):
+        """
+        ``containers`` fires with the decoded listing.
+        """
+        listing = self.client.containers(all=True)
+        listing.addCallback(self.assertEqual, [{u"all": [u"1"]}])
+        return listing
+
+    def test_inspect(self):
+        """
+        ``inspect_container`` fires with the container's details, decoded or
+        not.
+        """
+        inspecting = gatherResults([
+            self.client.inspect_container(b"abc"),
+            self.client.inspect_container(b"abc", decode=False),
+        ])
+        inspecting.addCallback(
+            self.assertEqual, [{u"Id": u"abc"}, b'{"Id": "abc"}'],
+        )
+        return inspecting
+
+    def test_not_found(self):
+        """
+        A request for something the daemon doesn't know about fails with
+        ``NotFound``.
+        """
+        return self.assertFailure(
+            self.client.inspect_container(b"missing"), NotFound,
+        )
+
+    def test_error(self):
+        """
+        Any other error fails with ``DockerError`` and the response.
+        """
+        failing = self.assertFailure(
+            self.client._get(b"/containers/abc/other"), DockerError,
+        )
+        failing.addCallback(
+            lambda error: self.assertEqual(
+                (500, b"broken"), (error.code, error.body),
+            )
+        )
+        return failing
@@ -0,0 +1,115 @@
+"""
+Tests for ``agents._dockerlogs``.
+"""
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._dockerclient import STDOUT
+from .._dockerlogs import REOPEN_DELAY, _DockerLogStream, _parse_timestamp
+
+FIRST = b"2015-11-02T00:00:00.123456789Z"
+SECOND = b"2015-11-02T00:00:00.12345679Z"
+
+
+class ParseTimestampTests(SynchronousTestCase):
+    """
+    Tests for ``_parse_timestamp``.
+    """
+    def test_nanoseconds(self):
+        """
+        The time is in whole nanoseconds since the epoch.
+        """
+        self.assertEqual(
+            (1446422400123456789, 1446422400123456790, 1446422400000000000),
+            (
+                _parse_timestamp(FIRST), _parse_timestamp(SECOND),
+                _parse_timestamp(b"2015-11-02T00:00:00Z"),
+            ),
+        )
+
+    def test_invalid(self):
+        """
+        Something which isn't a timestamp is rejected.
+        """
+        self.assertRaises(ValueError, _parse_timestamp, b"hello")
+
+
+class _DockerClient(object):
+    """
+    A Docker client for one container whose logs are always ``lines``.
+    """
+    def __init__(self, lines, running=True):
+        self.lines = lines
+        self.running = running
+        self.followed = []
+
+    def inspect_container(self, container):
+        return succeed(
+            {u"State": {u"Running": self.running}, u"Config": {}},
+        )
+
+    def logs(self, container, received, since, multiplexed, throttle):
+        self.followed.append(since)
+        received([(STDOUT, b"".join(self.lines))])
+        return succeed(None)
+
+
+class DockerLogStreamTests(SynchronousTestCase):
+    """
+    Tests for ``_DockerLogStream``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1446422400)
+        self.recorded = []
+
+    def stream(self, client, since):
+        return _DockerLogStream(
+            client, self.clock, b"container", self.recorded.extend,
+            since=since,
+        )
+
+    def test_since(self):
+        """
+        Lines up to and including ``since`` aren't recorded again, even when
+        they are less than a microsecond apart.
+        """
+        client = _DockerClient([FIRST + b" one\n", SECOND + b" two\n"])
+        stream = self.stream(client, _parse_timestamp(FIRST))
+        stream.run()
+        self.assertEqual(
+            ([1446422400], [b"two\n"], _parse_timestamp(SECOND)),
+            (client.followed, self.recorded, stream.since),
+        )
+
+    def test_stopped(self):
+        """
+        The logs of a stopped container are read once, for whatever it
+        logged before stopping which hadn't been read yet.
+        """
+        client = _DockerClient([FIRST + b" one\n"], running=False)
+        stream = self.stream(client, _parse_timestamp(FIRST) - 1)
+        stream.run()
+        self.clock.advance(REOPEN_DELAY)
+        stream.run()
+        self.assertEqual(
+            ([1446422400], [b"one\n"]), (client.followed, self.recorded),
+        )
+
+    def test_restarted(self):
+        """
+        A container which runs again and then stops is read again.
+        """
+        client = _DockerClient([FIRST + b" one\n"], running=False)
+        stream = self.stream(client, _parse_timestamp(FIRST) - 1)
+        stream.run()
+        client.running = True
+        client.lines.append(SECOND + b" two\n")
+        stream.run()
+        client.running = False
+        stream.run()
+        self.assertEqual(
+            (3, [b"one\n", b"two\n"]), (len(client.followed), self.recorded),
+        )
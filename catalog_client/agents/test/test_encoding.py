@@ -0,0 +1,99 @@
+"""
+Tests for ``agents._encoding``.
+"""
+
+import zlib
+from gzip import GzipFile
+from io import BytesIO
+
+from pyrsistent import InvariantException
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._encoding import (
+    DEFLATE, GZIP, IDENTITY, BodyEncoding, body_encoding_from_environment,
+)
+
+BODY = b"a report which compresses well " * 100
+
+
+class BodyEncodingTests(SynchronousTestCase):
+    """
+    Tests for ``BodyEncoding``.
+    """
+    def test_identity(self):
+        """
+        The ``identity`` encoding leaves the body alone and sends no
+        ``Content-Encoding``.
+        """
+        self.assertEqual(({}, BODY), BodyEncoding().encode(BODY))
+
+    def test_gzip(self):
+        """
+        The ``gzip`` encoding compresses the body in the gzip format.
+        """
+        headers, body = BodyEncoding(content_encoding=GZIP).encode(BODY)
+        self.assertEqual(
+            ({b"Content-Encoding": [GZIP]}, BODY),
+            (headers, GzipFile(fileobj=BytesIO(body)).read()),
+        )
+        self.assertLess(len(body), len(BODY))
+
+    def test_deflate(self):
+        """
+        The ``deflate`` encoding compresses the body in the zlib format.
+        """
+        headers, body = BodyEncoding(content_encoding=DEFLATE).encode(BODY)
+        self.assertEqual(
+            ({b"Content-Encoding": [DEFLATE]}, BODY),
+            (headers, zlib.decompress(body)),
+        )
+
+    def test_small(self):
+        """
+        A body smaller than ``minimum_size`` isn't compressed.
+        """
+        encoding = BodyEncoding(
+            content_encoding=GZIP, minimum_size=len(BODY) + 1,
+        )
+        self.assertEqual(({}, BODY), encoding.encode(BODY))
+
+    def test_unknown(self):
+        """
+        An unknown encoding is refused.
+        """
+        self.assertRaises(
+            InvariantException, BodyEncoding, content_encoding=b"brotli",
+        )
+
+    def test_level(self):
+        """
+        A level outside of zlib's is refused.
+        """
+        self.assertRaises(InvariantException, BodyEncoding, level=10)
+
+
+class BodyEncodingFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``body_encoding_from_environment``.
+    """
+    def test_defaults(self):
+        """
+        Without any of the variables bodies aren't compressed.
+        """
+        self.assertEqual(
+            IDENTITY, body_encoding_from_environment({}).content_encoding,
+        )
+
+    def test_variables(self):
+        """
+        Each variable overrides one setting.
+        """
+        self.assertEqual(
+            BodyEncoding(content_encoding=GZIP, level=9, minimum_size=10),
+            body_encoding_from_environment({
+                "CATALOG_FIREHOSE_CONTENT_ENCODING": "gzip",
+                "CATALOG_FIREHOSE_COMPRESSION_LEVEL": "9",
+                "CATALOG_FIREHOSE_COMPRESSION_MINIMUM_SIZE": "10",
+            }),
+        )
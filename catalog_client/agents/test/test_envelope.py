@@ -0,0 +1,203 @@
+"""
+Tests for ``agents._envelope`` and the envelope handling of
+``agents.firehose_stub``.
+"""
+
+from datetime import timedelta
+from io import BytesIO
+import json
+
+from pyrsistent import pmap
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from .._envelope import ENVELOPE_NAME, _Envelope
+from .._httpclient import Delivery
+from ..firehose_stub import FirehoseResource, split_envelope
+
+
+class _ThreadPool(object):
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        onResult(True, f(*args, **kwargs))
+
+
+class _Reactor(Clock):
+    """
+    A ``Clock`` whose thread pool runs everything straight away.
+    """
+    def getThreadPool(self):
+        return _ThreadPool()
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class _Reporter(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, fields, serialized=pmap()):
+        self.sent.append((fields, serialized, Deferred()))
+        return self.sent[-1][2]
+
+    def envelopes(self):
+        """
+        :return: The entries of each envelope sent.
+        """
+        return list(
+            json.loads(serialized[ENVELOPE_NAME])
+            for (_, serialized, _) in self.sent
+        )
+
+
+class EnvelopeTests(SynchronousTestCase):
+    """
+    Tests for ``_Envelope``.
+    """
+    def setUp(self):
+        self.reactor = _Reactor()
+        self.reporter = _Reporter()
+        self.envelope = _Envelope(
+            self.reactor, self.reporter, timedelta(seconds=1),
+        )
+
+    def test_window(self):
+        """
+        Reports made within the window of the first one are sent together
+        once the window has passed, each with its collector and that
+        collector's sequence number.
+        """
+        self.envelope.reporter_for(u"a").report(1)
+        self.envelope.reporter_for(u"b").report(2)
+        self.reactor.advance(0.5)
+        self.envelope.reporter_for(u"a").report(3)
+        self.assertEqual([], self.reporter.sent)
+        self.reactor.advance(0.5)
+        self.assertEqual(
+            [
+                [
+                    {u"collector": u"a", u"sequence": 1, u"result": 1},
+                    {u"collector": u"b", u"sequence": 1, u"result": 2},
+                    {u"collector": u"a", u"sequence": 2, u"result": 3},
+                ],
+            ],
+            self.reporter.envelopes(),
+        )
+
+    def test_next_window(self):
+        """
+        A report made after an envelope is sent goes in the next one.
+        """
+        self.envelope.reporter_for(u"a").report(1)
+        self.reactor.advance(1)
+        self.envelope.reporter_for(u"a").report(2)
+        self.reactor.advance(1)
+        self.assertEqual(
+            [[1], [2]],
+            list(
+                list(entry[u"result"] for entry in entries)
+                for entries in self.reporter.envelopes()
+            ),
+        )
+
+    def test_shares(self):
+        """
+        Each report's ``Delivery`` counts only its share of the bytes sent,
+        in proportion to its size.
+        """
+        large = self.envelope.reporter_for(u"large").report(u"x" * 1000)
+        small = self.envelope.reporter_for(u"small").report(u"")
+        self.reactor.advance(1)
+        delivery = Delivery(response=object(), body=b"", sent_bytes=500)
+        self.reporter.sent[0][2].callback(delivery)
+        large_share = self.successResultOf(large)
+        small_share = self.successResultOf(small)
+        self.assertEqual(
+            (delivery.response, delivery.response, 500),
+            (
+                large_share.response, small_share.response,
+                large_share.sent_bytes + small_share.sent_bytes,
+            ),
+        )
+        self.assertTrue(large_share.sent_bytes > 20 * small_share.sent_bytes)
+
+    def test_failed(self):
+        """
+        If the envelope can't be sent every report in it fails.
+        """
+        first = self.envelope.reporter_for(u"a").report(1)
+        second = self.envelope.reporter_for(u"b").report(2)
+        self.reactor.advance(1)
+        self.reporter.sent[0][2].errback(RuntimeError("Not sent"))
+        self.failureResultOf(first, RuntimeError)
+        self.failureResultOf(second, RuntimeError)
+
+
+ENVELOPE = {
+    u"secret": u"s",
+    ENVELOPE_NAME: [
+        {u"collector": u"a", u"sequence": 1, u"result": 1},
+        {u"collector": u"b", u"sequence": 4, u"result": 2},
+    ],
+}
+
+
+class SplitEnvelopeTests(SynchronousTestCase):
+    """
+    Tests for ``firehose_stub.split_envelope``.
+    """
+    def test_split(self):
+        """
+        Each entry becomes the document its collector would have sent.
+        """
+        self.assertEqual(
+            [
+                (u"a", {u"secret": u"s", u"result": 1}),
+                (u"b", {u"secret": u"s", u"result": 2}),
+            ],
+            split_envelope(ENVELOPE),
+        )
+
+
+class FirehoseResourceTests(SynchronousTestCase):
+    """
+    Tests for ``firehose_stub.FirehoseResource``.
+    """
+    def setUp(self):
+        self.received = []
+        self.resource = FirehoseResource(
+            lambda collector, document: self.received.append(
+                (collector, document)
+            )
+        )
+
+    def post(self, name, body):
+        request = DummyRequest([b"v1", b"firehose", name])
+        request.method = b"POST"
+        request.content = BytesIO(body)
+        self.resource.render(request)
+        return request
+
+    def test_envelope(self):
+        """
+        An envelope is split up.
+        """
+        self.post(ENVELOPE_NAME.encode("ascii"), json.dumps(ENVELOPE))
+        self.assertEqual(split_envelope(ENVELOPE), self.received)
+
+    def test_report(self):
+        """
+        A collector's own report is passed on as it is.
+        """
+        self.post(b"node", json.dumps({u"result": 1}))
+        self.assertEqual([(u"node", {u"result": 1})], self.received)
+
+    def test_bad_envelope(self):
+        """
+        An envelope which can't be split is a bad request.
+        """
+        request = self.post(b"envelope", json.dumps({u"secret": u"s"}))
+        self.assertEqual((400, []), (request.responseCode, self.received))
@@ -0,0 +1,204 @@
+"""
+Tests for ``agents._filelogs``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import _filelogs
+from .._filelogs import ROTATED_GRACE, _FileLogStream
+
+
+class _Watcher(object):
+    """
+    A watcher which makes streams poll.
+    """
+    def watch(self, path, changed):
+        return False
+
+
+def _append(path, data):
+    with path.open("ab") as log_file:
+        log_file.write(data)
+
+
+class FileLogStreamTests(SynchronousTestCase):
+    """
+    Tests for ``_FileLogStream``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        directory = FilePath(self.mktemp())
+        directory.makedirs()
+        self.path = directory.child(b"app.log")
+        self.path.setContent(b"old\n")
+        self.recorded = []
+        self.streams = []
+        self.addCleanup(self.close)
+
+    def close(self):
+        for stream in self.streams:
+            for open_log in stream._rotated + [stream._current]:
+                open_log.close()
+
+    def stream(self, **kwargs):
+        stream = _FileLogStream(
+            self.path, self.recorded.extend, reactor=self.clock,
+            watcher=_Watcher(), **kwargs
+        )
+        self.streams.append(stream)
+        return stream
+
+    def read(self, stream):
+        """
+        Read whatever ``stream`` has to read now.
+        """
+        stream._wake()
+        self.clock.advance(0)
+
+    def rotate(self, suffix=b".1"):
+        self.path.moveTo(self.path.siblingExtension(suffix))
+
+    def test_from_end(self):
+        """
+        Without a checkpoint only lines written after the stream started are
+        recorded.
+        """
+        stream = self.stream()
+        _append(self.path, b"a\nb\n")
+        self.read(stream)
+        self.assertEqual([b"a\n", b"b\n"], self.recorded)
+
+    def test_partial_line(self):
+        """
+        An incomplete last line is only recorded once it is complete.
+        """
+        stream = self.stream()
+        _append(self.path, b"a\nb")
+        self.read(stream)
+        self.assertEqual([b"a\n"], self.recorded)
+        _append(self.path, b"c\n")
+        self.read(stream)
+        self.assertEqual([b"a\n", b"bc\n"], self.recorded)
+
+    def test_rename_rotation(self):
+        """
+        A file renamed away is read to the end before its replacement.
+        """
+        stream = self.stream()
+        _append(self.path, b"a\n")
+        self.rotate()
+        self.path.setContent(b"b\n")
+        self.read(stream)
+        self.assertEqual([b"a\n", b"b\n"], self.recorded)
+
+    def test_rotated_grace(self):
+        """
+        A file renamed away is kept open for a while for its writer to
+        finish with it, and then its incomplete last line is recorded and it
+        is closed.
+        """
+        stream = self.stream()
+        self.rotate()
+        self.path.setContent(b"")
+        self.read(stream)
+        _append(self.path.siblingExtension(b".1"), b"late\nlast")
+        self.read(stream)
+        self.assertEqual(
+            ([b"late\n"], 1), (self.recorded, len(stream._rotated)),
+        )
+        self.clock.advance(ROTATED_GRACE)
+        self.read(stream)
+        self.assertEqual(
+            ([b"late\n", b"last\n"], []), (self.recorded, stream._rotated),
+        )
+
+    def test_copytruncate(self):
+        """
+        A file truncated in place is read again from the start.
+        """
+        stream = self.stream()
+        _append(self.path, b"a\nb\n")
+        self.read(stream)
+        self.path.setContent(b"c\n")
+        self.read(stream)
+        self.assertEqual([b"a\n", b"b\n", b"c\n"], self.recorded)
+
+    def test_resume(self):
+        """
+        A stream resuming from a checkpoint finds the files rotated since and
+        carries on from where it was in each of them.
+        """
+        stream = self.stream()
+        _append(self.path, b"a\nb")
+        self.read(stream)
+        checkpoint = stream.position()
+        _append(self.path, b"c\n")
+        self.rotate()
+        self.path.setContent(b"d\n")
+        self.read(self.stream(checkpoint=checkpoint))
+        self.assertEqual([b"a\n", b"bc\n", b"d\n"], self.recorded)
+
+    def test_resume_renamed_away(self):
+        """
+        A stream can resume while its file is renamed away and not replaced
+        yet, and reads the replacement once it is.
+        """
+        stream = self.stream()
+        _append(self.path, b"a\n")
+        self.read(stream)
+        checkpoint = stream.position()
+        _append(self.path, b"b\n")
+        self.rotate()
+        resumed = self.stream(checkpoint=checkpoint)
+        self.read(resumed)
+        self.path.setContent(b"c\n")
+        self.read(resumed)
+        self.assertEqual([b"a\n", b"b\n", b"c\n"], self.recorded)
+
+    def test_catch_up_budget(self):
+        """
+        Catching up, a stream reads no more than its budget at once and no
+        faster than the catch-up rate.
+        """
+        self.patch(_filelogs, "_READ_SIZE", 4)
+        checkpoint = self.stream().position()
+        _append(self.path, b"aaa\nbbb\nccc\n")
+        resumed = self.stream(
+            checkpoint=checkpoint, read_budget=4, catch_up_rate=4,
+        )
+        self.read(resumed)
+        self.assertEqual([b"aaa\n"], self.recorded)
+        self.clock.advance(1)
+        self.assertEqual([b"aaa\n", b"bbb\n"], self.recorded)
+        self.clock.pump([1, 1])
+        self.assertEqual([b"aaa\n", b"bbb\n", b"ccc\n"], self.recorded)
+
+    def test_long_catch_up(self):
+        """
+        Rotated files aren't closed before they have been read, however long
+        catching up takes.
+        """
+        self.patch(_filelogs, "_READ_SIZE", 4)
+        stream = self.stream()
+        _append(self.path, b"aaa\n" * 10)
+        self.rotate(b".2")
+        self.path.setContent(b"bbb\n")
+        self.read(stream)
+        checkpoint = stream.position()
+        _append(self.path, b"ccc\n")
+        self.rotate(b".1")
+        self.path.setContent(b"ddd\n")
+        del self.recorded[:]
+        # Go back to the start of the lines in the first rotated file, for
+        # ten seconds of catching up before the second is reached.
+        checkpoint[0][1] = len(b"old\n")
+        resumed = self.stream(
+            checkpoint=checkpoint, read_budget=4, catch_up_rate=4,
+        )
+        self.read(resumed)
+        self.clock.pump([1] * 20)
+        self.assertEqual(
+            [b"aaa\n"] * 10 + [b"ccc\n", b"ddd\n"], self.recorded,
+        )
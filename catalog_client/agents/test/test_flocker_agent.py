@@ -0,0 +1,260 @@
+"""
+Tests for ``agents.flocker_agent``.
+"""
+
+from datetime import timedelta
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import flocker_agent
+from .._scheduler import Scheduler, _AdaptiveInterval
+from ..flocker_agent import STABLE_POLLS, PollSettings, _Collector, _Index
+from .test_scheduler import SETTINGS, _delivery
+
+BASE_URL = b"https://control:4523/v1"
+
+
+class _Treq(object):
+    """
+    Stand in for ``treq`` with a client whose responses are already decoded.
+    """
+    @staticmethod
+    def json_content(response):
+        return succeed(response)
+
+
+class _Client(object):
+    """
+    A control service client with a listing of items at each path.
+    """
+    def __init__(self, clock):
+        self._clock = clock
+        self.listings = {
+            b"/configuration/datasets": [{u"dataset_id": u"d1", u"size": 1}],
+            b"/state/datasets": [{u"dataset_id": u"d1", u"primary": u"n1"}],
+            b"/state/nodes": [{u"uuid": u"n1", u"host": u"10.0.0.1"}],
+        }
+        self.requests = []
+
+    def get(self, url):
+        path = url[len(BASE_URL):]
+        self.requests.append((self._clock.seconds(), path))
+        return succeed(list(self.listings[path]))
+
+
+class IndexTests(SynchronousTestCase):
+    """
+    Tests for ``_Index``.
+    """
+    def test_update(self):
+        """
+        ``update`` describes what was added, changed and removed since the
+        last update.
+        """
+        index = _Index(u"id")
+        index.update([{u"id": 1, u"v": 1}, {u"id": 2, u"v": 1}])
+        self.assertEqual(
+            dict(
+                added=[{u"id": 3, u"v": 1}],
+                changed=[{u"id": 1, u"v": 2}],
+                removed=[2],
+            ),
+            index.update([{u"id": 1, u"v": 2}, {u"id": 3, u"v": 1}]),
+        )
+
+    def test_unchanged(self):
+        """
+        Updating with the same items describes no differences.
+        """
+        index = _Index(u"id")
+        index.update([{u"id": 1}])
+        self.assertEqual(
+            dict(added=[], changed=[], removed=[]), index.update([{u"id": 1}]),
+        )
+
+
+class CollectorTests(SynchronousTestCase):
+    """
+    Tests for ``_Collector``.
+    """
+    def setUp(self):
+        self.patch(flocker_agent, "treq", _Treq)
+        self.clock = Clock()
+        self.client = _Client(self.clock)
+
+    def collector(self, **kwargs):
+        return _Collector(
+            flocker_client=self.client, base_url=BASE_URL,
+            clock=self.clock, **kwargs
+        )
+
+    def test_first(self):
+        """
+        The first collection has the complete listings.
+        """
+        self.assertEqual(
+            {
+                u"config": self.client.listings[b"/configuration/datasets"],
+                u"state": self.client.listings[b"/state/datasets"],
+                u"nodes": self.client.listings[b"/state/nodes"],
+            },
+            self.successResultOf(self.collector().collect()),
+        )
+
+    def test_changes(self):
+        """
+        Once the complete listings are acknowledged only the changes to them
+        are collected.
+        """
+        collector = self.collector()
+        collector.acknowledge(self.successResultOf(collector.collect()))
+        moved = {u"dataset_id": u"d1", u"primary": u"n2"}
+        self.client.listings[b"/state/datasets"] = [moved]
+        self.clock.advance(5)
+        self.assertEqual(
+            {
+                u"state_changes": dict(
+                    added=[], changed=[moved], removed=[],
+                ),
+            },
+            self.successResultOf(collector.collect()),
+        )
+
+    def test_unacknowledged(self):
+        """
+        If a collection isn't acknowledged the next one has the complete
+        listings again.
+        """
+        collector = self.collector()
+        self.successResultOf(collector.collect())
+        self.clock.advance(5)
+        self.assertIn(u"config", self.successResultOf(collector.collect()))
+
+    def test_resync(self):
+        """
+        The complete listings are collected again every resync interval,
+        changed or not.
+        """
+        collector = self.collector(resync_interval=timedelta(seconds=60))
+        collector.acknowledge(self.successResultOf(collector.collect()))
+        self.clock.advance(30)
+        self.assertEqual({}, self.successResultOf(collector.collect()))
+        self.clock.advance(30)
+        self.assertEqual(
+            [u"config", u"nodes", u"state"],
+            sorted(self.successResultOf(collector.collect())),
+        )
+
+    def test_failed_report(self):
+        """
+        Changes in a report Firehose doesn't accept are sent again in the
+        next report.
+        """
+        self.patch(_AdaptiveInterval, "first_delay", lambda self: 0)
+        reported = []
+        codes = [200, 500, 200]
+
+        def report(result):
+            reported.append(result)
+            return succeed(_delivery(codes.pop(0)))
+
+        Scheduler(self.clock).add(self.collector(), report, SETTINGS)
+        self.clock.advance(0)
+        moved = {u"dataset_id": u"d1", u"primary": u"n2"}
+        self.client.listings[b"/state/datasets"] = [moved]
+        self.clock.advance(5)
+        self.clock.advance(5)
+        self.assertEqual(
+            (
+                [u"config", u"nodes", u"state"],
+                [u"state_changes"],
+                [u"config", u"nodes", u"state"],
+                [moved],
+            ),
+            (
+                sorted(reported[0]), sorted(reported[1]),
+                sorted(reported[2]), reported[2][u"state"],
+            ),
+        )
+
+
+class PollTests(SynchronousTestCase):
+    """
+    Tests for how often ``_Collector`` polls each listing.
+    """
+    def setUp(self):
+        self.patch(flocker_agent, "treq", _Treq)
+        self.clock = Clock()
+        self.client = _Client(self.clock)
+        settings = PollSettings(
+            minimum_interval=timedelta(seconds=5),
+            maximum_interval=timedelta(seconds=30),
+        )
+        self.collector = _Collector(
+            flocker_client=self.client, base_url=BASE_URL,
+            resync_interval=timedelta(hours=1),
+            poll_settings=dict(
+                (name, settings) for name in (u"config", u"state", u"nodes")
+            ),
+            clock=self.clock,
+        )
+
+    def run_until(self, end, change_at=()):
+        """
+        Collect every second, acknowledging each result, until ``end``.
+
+        :param change_at: The times at which to change the nodes listing.
+        """
+        while self.clock.seconds() <= end:
+            if self.clock.seconds() in change_at:
+                self.client.listings[b"/state/nodes"] = [
+                    {u"uuid": u"n1", u"host": unicode(self.clock.seconds())},
+                ]
+            self.collector.acknowledge(
+                self.successResultOf(self.collector.collect()),
+            )
+            self.clock.advance(1)
+
+    def polls(self, path=b"/state/nodes"):
+        return list(
+            when for (when, polled) in self.client.requests if polled == path
+        )
+
+    def test_stable(self):
+        """
+        A listing is polled at the minimum interval until it has been the
+        same ``STABLE_POLLS`` times, and then the interval doubles with each
+        unchanged poll.
+        """
+        self.assertEqual(3, STABLE_POLLS)
+        self.run_until(25)
+        self.assertEqual([0, 5, 10, 15, 25], self.polls())
+
+    def test_maximum(self):
+        """
+        The interval is never longer than the maximum.
+        """
+        self.run_until(120)
+        self.assertEqual([0, 5, 10, 15, 25, 45, 75, 105], self.polls())
+
+    def test_changed(self):
+        """
+        A change brings the interval back down to the minimum.
+        """
+        self.run_until(60, change_at=(30,))
+        self.assertEqual([0, 5, 10, 15, 25, 45, 50, 55, 60], self.polls())
+
+    def test_each_listing(self):
+        """
+        Each listing has its own interval.
+        """
+        self.run_until(45, change_at=(20, 40))
+        self.assertEqual(
+            (
+                [0, 5, 10, 15, 25, 45],
+                [0, 5, 10, 15, 25, 30, 35, 40, 45],
+            ),
+            (self.polls(b"/state/datasets"), self.polls()),
+        )
@@ -0,0 +1,62 @@
+"""
+Tests for ``agents.host_agent``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import host_agent
+from ..host_agent import NoCollectors, _collectors_from_environment
+
+
+def _broken(environ):
+    raise RuntimeError("Can't run here")
+
+
+class CollectorsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``_collectors_from_environment``.
+    """
+    def setUp(self):
+        self.patch(host_agent, "_COLLECTOR_FACTORIES", {
+            b"a": lambda environ: (b"a", environ),
+            b"b": lambda environ: (b"b", environ),
+            b"broken": _broken,
+        })
+
+    def test_named(self):
+        """
+        The collectors named in ``CATALOG_COLLECTORS`` are created from the
+        environment, in order.
+        """
+        environ = {b"CATALOG_COLLECTORS": b" b, a ,"}
+        self.assertEqual(
+            [(b"b", environ), (b"a", environ)],
+            _collectors_from_environment(environ),
+        )
+
+    def test_unknown(self):
+        """
+        An unknown collector name is an error.
+        """
+        self.assertRaises(
+            ValueError,
+            _collectors_from_environment, {b"CATALOG_COLLECTORS": b"a,c"},
+        )
+
+    def test_unavailable(self):
+        """
+        A collector which can't be created is left out.
+        """
+        environ = {b"CATALOG_COLLECTORS": b"broken,a"}
+        self.assertEqual(
+            [(b"a", environ)], _collectors_from_environment(environ),
+        )
+
+    def test_none_available(self):
+        """
+        If no collector can be created there is nothing to run.
+        """
+        self.assertRaises(
+            NoCollectors,
+            _collectors_from_environment, {b"CATALOG_COLLECTORS": b"broken"},
+        )
@@ -0,0 +1,343 @@
+"""
+Tests for ``agents._httpclient``.
+"""
+
+from OpenSSL import crypto
+
+from service_identity import VerificationError
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.ssl import Certificate, KeyPair, PrivateCertificate
+from twisted.protocols.policies import WrappingFactory
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+from twisted.web.client import Agent, ResponseNeverReceived, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.static import Data
+
+from .. import _httpclient
+from .._httpclient import (
+    DEFAULT_IDLE_TIMEOUT, PoolSettings, _HandshakeRate,
+    _ResumingPolicyForHTTPS, _pool, persistent_client,
+    pool_settings_from_environment,
+)
+from .._metrics import REGISTRY
+
+
+def _self_signed(hostname):
+    """
+    :return: A ``PrivateCertificate`` for ``hostname``, signed by itself.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    certificate = crypto.X509()
+    certificate.get_subject().CN = hostname
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_serial_number(1)
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(60 * 60)
+    certificate.set_pubkey(key)
+    certificate.add_extensions([
+        crypto.X509Extension(
+            b"subjectAltName", False, b"DNS:" + hostname,
+        ),
+    ])
+    certificate.sign(key, "sha256")
+    return PrivateCertificate.fromCertificateAndKeyPair(
+        Certificate(certificate), KeyPair(key),
+    )
+
+
+class _Connections(WrappingFactory):
+    """
+    Keep track of a server's connections so that a test can wait for them
+    all to close.
+    """
+    def __init__(self, wrapped):
+        WrappingFactory.__init__(self, wrapped)
+        self._closing = []
+
+    def unregisterProtocol(self, protocol):
+        WrappingFactory.unregisterProtocol(self, protocol)
+        if not self.protocols:
+            closing, self._closing = self._closing, []
+            for waiting in closing:
+                waiting.callback(None)
+
+    def closed(self):
+        """
+        :return: A ``Deferred`` which fires once there are no connections.
+        """
+        waiting = Deferred()
+        if self.protocols:
+            self._closing.append(waiting)
+        else:
+            waiting.callback(None)
+        return waiting
+
+
+class _Peer(Resource):
+    """
+    Respond with the common name of the client's certificate.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        peer = request.channel.transport.getPeerCertificate()
+        return peer.get_subject().CN.encode("utf-8")
+
+
+class _MutualTLSServer(object):
+    """
+    A real TLS server which only accepts clients presenting a certificate it
+    trusts.
+    """
+    def __init__(self, test, certificate, client_authority):
+        self.connections = _Connections(Site(_Peer()))
+        self.port = reactor.listenSSL(
+            0, self.connections, certificate.options(client_authority),
+            interface=b"127.0.0.1",
+        )
+        test.addCleanup(self.port.stopListening)
+
+    def url(self):
+        return b"https://127.0.0.1:%d/" % (self.port.getHost().port,)
+
+
+def _get_body(client, url):
+    getting = client.get(url)
+    getting.addCallback(readBody)
+    return getting
+
+
+class PoolSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``pool_settings_from_environment``.
+    """
+    def test_defaults(self):
+        """
+        Without any of the variables the defaults are used.
+        """
+        defaults = PoolSettings(max_connections=5)
+        self.assertEqual(
+            defaults, pool_settings_from_environment({}, "X", defaults),
+        )
+
+    def test_variables(self):
+        """
+        Each variable with the prefix overrides one setting.
+        """
+        self.assertEqual(
+            PoolSettings(
+                max_connections=3, max_idle_connections=4, idle_timeout=1.5,
+            ),
+            pool_settings_from_environment(
+                {
+                    "X_MAX_CONNECTIONS": "3",
+                    "X_MAX_IDLE_CONNECTIONS": "4",
+                    "X_IDLE_TIMEOUT": "1.5",
+                    "Y_IDLE_TIMEOUT": "2",
+                },
+                "X",
+            ),
+        )
+        self.assertEqual(
+            DEFAULT_IDLE_TIMEOUT,
+            pool_settings_from_environment({}, "X").idle_timeout,
+        )
+
+
+class HandshakeRateTests(SynchronousTestCase):
+    """
+    Tests for ``_HandshakeRate``.
+    """
+    def test_last_minute(self):
+        """
+        The gauge counts the handshakes in the last minute.
+        """
+        now = [1000.0]
+        rate = _HandshakeRate(u"handshake-rate-test", clock=lambda: now[0])
+        rate.handshake()
+        now[0] += 30
+        rate.handshake()
+        now[0] += 45
+        rate.update()
+        self.assertEqual(
+            1,
+            REGISTRY.snapshot()["catalog_agent_tls_handshakes_per_minute"][
+                u"pool=handshake-rate-test"
+            ],
+        )
+
+
+class ResumingPolicyForHTTPSTests(TestCase):
+    """
+    Tests for ``_ResumingPolicyForHTTPS`` against a real TLS server.
+    """
+    def setUp(self):
+        certificate = _self_signed(b"localhost")
+        resource = Data(b"hello", b"text/plain")
+        resource.isLeaf = True
+        self.connections = _Connections(Site(resource))
+        self.port = reactor.listenSSL(
+            0, self.connections, certificate.options(),
+            interface=b"127.0.0.1",
+        )
+        self.addCleanup(self.port.stopListening)
+        self.name = self.id().decode("ascii")
+        self.pool = _pool(reactor, PoolSettings(), self.name)
+        self.addCleanup(self._close)
+        self.agent = Agent(
+            reactor,
+            contextFactory=_ResumingPolicyForHTTPS(
+                self.name, trust_root=Certificate(certificate.original),
+            ),
+            pool=self.pool,
+        )
+
+    def _close(self):
+        return gatherResults([
+            self.pool.closeCachedConnections(), self.connections.closed(),
+        ])
+
+    def _get(self, hostname):
+        """
+        :return: A ``Deferred`` firing with the response code once the body
+            has been read and the connection is back in the pool.
+        """
+        getting = self.agent.request(
+            b"GET", b"https://%s:%d/" % (hostname, self.port.getHost().port),
+        )
+
+        def got(response):
+            reading = readBody(response)
+            reading.addCallback(lambda body: response.code)
+            return reading
+        getting.addCallback(got)
+        return getting
+
+    def _handshakes(self):
+        return REGISTRY.snapshot()["catalog_agent_tls_handshakes_total"]
+
+    def test_hostname(self):
+        """
+        A server with a certificate for the hostname asked for is accepted.
+        """
+        getting = self._get(b"localhost")
+        getting.addCallback(self.assertEqual, 200)
+        return getting
+
+    def test_wrong_hostname(self):
+        """
+        A server whose certificate isn't for the address asked for is
+        rejected.
+        """
+        getting = self._get(b"127.0.0.1")
+        failing = self.assertFailure(getting, ResponseNeverReceived)
+
+        def failed(error):
+            self.assertTrue(error.reasons[0].check(VerificationError))
+        failing.addCallback(failed)
+        return failing
+
+    def test_resumption(self):
+        """
+        A new connection to a server already connected to offers the
+        previous TLS session.
+        """
+        getting = self._get(b"localhost")
+        getting.addCallback(lambda ignored: self._close())
+        getting.addCallback(lambda ignored: self._get(b"localhost"))
+
+        def got(ignored):
+            handshakes = self._handshakes()
+            self.assertEqual(
+                (1, 1),
+                (
+                    handshakes[u"offered=False,pool=" + self.name],
+                    handshakes[u"offered=True,pool=" + self.name],
+                ),
+            )
+        getting.addCallback(got)
+        return getting
+
+
+class PersistentClientTests(TestCase):
+    """
+    Tests for ``persistent_client`` against a real TLS server.
+    """
+    def setUp(self):
+        server = _self_signed(b"control-service")
+        self.client_certificate = _self_signed(b"plugin")
+        self.server = _MutualTLSServer(
+            self, server, Certificate(self.client_certificate.original),
+        )
+        self.name = self.id().decode("ascii")
+        pools = []
+
+        def pool(reactor, settings, name):
+            pools.append(_pool(reactor, settings, name))
+            return pools[-1]
+        self.patch(_httpclient, "_pool", pool)
+        self.client = persistent_client(
+            reactor,
+            self.client_certificate.options(
+                Certificate(server.original),
+            ).getContext(),
+            PoolSettings(),
+            self.name,
+        )
+        [self.pool] = pools
+        self.addCleanup(self._close)
+
+    def _close(self):
+        return gatherResults([
+            self.pool.closeCachedConnections(),
+            self.server.connections.closed(),
+        ])
+
+    def _counted(self, metric):
+        counts = REGISTRY.snapshot()[metric]
+        return dict(
+            (key.replace(u"pool=" + self.name, u"").strip(u","), count)
+            for (key, count) in counts.items()
+            if u"pool=" + self.name in key
+        )
+
+    def test_context(self):
+        """
+        The context given is used for the connection, whatever the server's
+        certificate says its name is.
+        """
+        getting = _get_body(self.client, self.server.url())
+        getting.addCallback(self.assertEqual, b"plugin")
+        return getting
+
+    def test_persistent(self):
+        """
+        A connection is reused for the next request, and a new connection
+        offers the session of the previous one.
+        """
+        getting = _get_body(self.client, self.server.url())
+        getting.addCallback(
+            lambda ignored: _get_body(self.client, self.server.url()),
+        )
+        getting.addCallback(lambda ignored: self._close())
+        getting.addCallback(
+            lambda ignored: _get_body(self.client, self.server.url()),
+        )
+
+        def got(ignored):
+            self.assertEqual(
+                (
+                    {u"state=new": 2, u"state=reused": 1},
+                    {u"offered=False": 1, u"offered=True": 1},
+                ),
+                (
+                    self._counted("catalog_agent_http_connections_total"),
+                    self._counted("catalog_agent_tls_handshakes_total"),
+                ),
+            )
+        getting.addCallback(got)
+        return getting
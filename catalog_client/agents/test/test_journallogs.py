@@ -0,0 +1,243 @@
+"""
+Tests for ``agents._journallogs``.
+"""
+
+import json
+
+from twisted.internet.defer import succeed
+from twisted.internet.error import ProcessDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import _journallogs
+from .._journallogs import _JournalProtocol, _JournaldCollector, _record_unit
+from .._loglib import _CatchUp
+
+
+def _record(message, unit=u"flocker-control.service", cursor=u"c", **fields):
+    record = dict(MESSAGE=message, _SYSTEMD_UNIT=unit, __CURSOR=cursor)
+    record.update(fields)
+    return record
+
+
+def _output(*records):
+    return b"".join(json.dumps(record) + b"\n" for record in records)
+
+
+class _Transport(object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class _Reactor(Clock):
+    """
+    A ``Clock`` which remembers the processes it was asked to start.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env=None):
+        protocol.transport = _Transport()
+        self.spawned.append((protocol, args))
+
+
+class RecordUnitTests(SynchronousTestCase):
+    """
+    Tests for ``_record_unit``.
+    """
+    def test_units(self):
+        """
+        A record is about the first unit named in any of the unit fields,
+        without its suffix, if it is one of the units looked for.
+        """
+        units = [b"flocker-control", b"flocker-dataset-agent"]
+        self.assertEqual(
+            [b"flocker-control", b"flocker-dataset-agent", None],
+            list(
+                _record_unit(record, units) for record in [
+                    {u"_SYSTEMD_UNIT": u"flocker-control.service"},
+                    {
+                        u"_SYSTEMD_UNIT": u"init.scope",
+                        u"UNIT": u"flocker-dataset-agent.service",
+                    },
+                    {u"_SYSTEMD_UNIT": u"sshd.service"},
+                ]
+            ),
+        )
+
+
+class JournalProtocolTests(SynchronousTestCase):
+    """
+    Tests for ``_JournalProtocol``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.received = []
+
+    def protocol(self, catch_up=None):
+        protocol = _JournalProtocol(
+            self.received.append, self.clock, catch_up,
+        )
+        protocol.transport = _Transport()
+        return protocol
+
+    def test_split(self):
+        """
+        Records are passed on once their line is complete, however the output
+        is split up.
+        """
+        protocol = self.protocol()
+        data = _output(_record(u"a"), _record(u"b"))
+        protocol.outReceived(data[:10])
+        protocol.outReceived(data[10:-5])
+        protocol.outReceived(data[-5:])
+        self.assertEqual(
+            [[u"a"], [u"b"]],
+            list(
+                list(record[u"MESSAGE"] for record in records)
+                for records in self.received
+            ),
+        )
+
+    def test_bad_record(self):
+        """
+        A line which isn't JSON is skipped.
+        """
+        protocol = self.protocol()
+        protocol.outReceived(b"{\n" + _output(_record(u"a")))
+        self.assertEqual(
+            [u"a"], list(record[u"MESSAGE"] for record in self.received[0]),
+        )
+
+    def test_catch_up(self):
+        """
+        Catching up, reading is paused for long enough to stay within the
+        rate, counting each byte read once.
+        """
+        protocol = self.protocol(_CatchUp(self.clock, 10))
+        # Half a record, which is kept until the rest of it arrives.
+        protocol.outReceived(b"x" * 10)
+        self.assertTrue(protocol.transport.paused)
+        self.clock.advance(1)
+        self.assertFalse(protocol.transport.paused)
+        protocol.outReceived(b"x" * 10)
+        self.assertTrue(protocol.transport.paused)
+        self.clock.advance(1)
+        self.assertFalse(protocol.transport.paused)
+
+
+class JournaldCollectorTests(SynchronousTestCase):
+    """
+    Tests for ``_JournaldCollector`` following the journal.
+    """
+    def setUp(self):
+        self.reactor = _Reactor()
+
+    def collector(self, **kwargs):
+        return _JournaldCollector(reactor=self.reactor, **kwargs)
+
+    def test_routing(self):
+        """
+        Records are recorded for the unit they are about, and records about
+        other units are skipped.
+        """
+        collector = self.collector()
+        collector.collect()
+        [(protocol, _)] = self.reactor.spawned
+        protocol.outReceived(_output(
+            _record(u"a", unit=u"flocker-control.service"),
+            _record(u"b", unit=u"sshd.service"),
+            _record(u"c", unit=u"flocker-dataset-agent.service"),
+        ))
+        self.assertEqual(
+            {b"flocker-control": [b"a"], b"flocker-dataset-agent": [b"c"]},
+            self.successResultOf(collector.collect()),
+        )
+
+    def test_checkpoint(self):
+        """
+        The checkpoint is the cursor of the last record read, about any
+        unit, and following starts after it.
+        """
+        collector = self.collector()
+        collector.collect()
+        [(protocol, _)] = self.reactor.spawned
+        protocol.outReceived(_output(
+            _record(u"a", cursor=u"one"),
+            _record(u"b", unit=u"sshd.service", cursor=u"two"),
+        ))
+        self.collector(checkpoint=collector.checkpoint()).collect()
+        [_, (_, args)] = self.reactor.spawned
+        self.assertEqual(
+            (u"two", [b"--after-cursor", b"two"]),
+            (collector.checkpoint(), args[-2:]),
+        )
+
+    def test_restart(self):
+        """
+        If ``journalctl`` exits it is started again on the next collection,
+        after the last record read.
+        """
+        collector = self.collector()
+        collector.collect()
+        [(protocol, _)] = self.reactor.spawned
+        protocol.outReceived(_output(_record(u"a", cursor=u"one")))
+        collector.collect()
+        self.assertEqual(1, len(self.reactor.spawned))
+        protocol.processEnded(Failure(ProcessDone(0)))
+        collector.collect()
+        [_, (_, args)] = self.reactor.spawned
+        self.assertEqual([b"--after-cursor", b"one"], args[-2:])
+
+
+class JournaldCollectorNotFollowingTests(SynchronousTestCase):
+    """
+    Tests for ``_JournaldCollector`` running ``journalctl`` for each unit.
+    """
+    def setUp(self):
+        self.commands = []
+        self.patch(_journallogs, "getProcessOutput", self.journalctl)
+
+    def journalctl(self, executable, args, env):
+        self.commands.append(args)
+        unit = args[args.index(b"--unit") + 1]
+        return succeed(b"line\n-- cursor: " + unit + b"-cursor\n")
+
+    def test_checkpoint(self):
+        """
+        The checkpoint is each unit's cursor, and a collector resuming from
+        it reads each unit from there.
+        """
+        collector = _JournaldCollector(follow=False)
+        self.successResultOf(collector.collect())
+        checkpoint = collector.checkpoint()
+        del self.commands[:]
+        resumed = _JournaldCollector(follow=False, checkpoint=checkpoint)
+        self.successResultOf(resumed.collect())
+        self.assertEqual(
+            (
+                dict(
+                    (unit, unit + u"-cursor")
+                    for unit in (
+                        u"flocker-container-agent", u"flocker-dataset-agent",
+                        u"flocker-control",
+                    )
+                ),
+                [b"--after-cursor"] * 3,
+            ),
+            (checkpoint, list(args[-2] for args in self.commands)),
+        )
+
+    def test_other_mode(self):
+        """
+        A checkpoint written while following is ignored.
+        """
+        collector = _JournaldCollector(follow=False, checkpoint=u"c")
+        self.assertIs(None, collector.checkpoint())
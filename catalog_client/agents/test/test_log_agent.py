@@ -0,0 +1,132 @@
+"""
+Tests for ``agents.log_agent``.
+"""
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logbuffer import LogFlushSettings
+from .._loglib import _MultiStreamRecorder
+from .._metrics import REGISTRY
+from ..log_agent import _Collector
+
+
+class _Checkpoints(object):
+    def __init__(self):
+        self.positions = {}
+
+    def get(self, name):
+        return self.positions.get(name)
+
+    def set(self, name, position):
+        self.positions[name] = position
+
+
+class _Source(object):
+    """
+    A log collector whose lines are recorded by the test and which is at
+    ``position`` in its logs.
+    """
+    checkpoint_name = u"source"
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.position = 0
+
+    def collect(self):
+        return succeed(self.recorder.consume())
+
+    def checkpoint(self):
+        return self.position
+
+
+def _latency_count():
+    latency = REGISTRY.snapshot().get(
+        "catalog_agent_log_upload_latency_seconds", {},
+    )
+    return latency.get(u"", {}).get("count", 0)
+
+
+class CollectorTests(SynchronousTestCase):
+    """
+    Tests for ``_Collector``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.checkpoints = _Checkpoints()
+        self.collector = _Collector(
+            checkpoints=self.checkpoints, reactor=self.clock,
+        )
+        recorder = _MultiStreamRecorder(reactor=self.clock)
+        self.source = _Source(recorder)
+        self.collector._recorders[_Source] = recorder
+        self.collector._collector = self.source
+
+    def record(self, *lines):
+        self.source.recorder.recorder(u"unit")(list(lines))
+        self.source.position += len(lines)
+
+    def test_delivered(self):
+        """
+        The position a result was collected up to is checkpointed once it is
+        delivered, and the latency of its lines observed.
+        """
+        self.record(b"a\n", b"b\n")
+        self.collector.collect()
+        self.assertEqual({}, self.checkpoints.positions)
+        before = _latency_count()
+        self.collector.delivered(True)
+        self.assertEqual(
+            ({u"source": 2}, 2),
+            (self.checkpoints.positions, _latency_count() - before),
+        )
+
+    def test_not_delivered(self):
+        """
+        The position of a result which wasn't delivered isn't checkpointed,
+        but a later result's is.
+        """
+        self.record(b"a\n")
+        self.collector.collect()
+        self.record(b"b\n")
+        self.collector.collect()
+        self.collector.delivered(False)
+        self.assertEqual({}, self.checkpoints.positions)
+        self.collector.delivered(True)
+        self.assertEqual({u"source": 2}, self.checkpoints.positions)
+
+    def test_nothing_to_send(self):
+        """
+        With nothing to send the position is checkpointed straight away.
+        """
+        self.source.position = 5
+        self.collector.collect()
+        self.assertEqual({u"source": 5}, self.checkpoints.positions)
+
+    def test_nothing_to_send_after_undelivered(self):
+        """
+        With nothing to send while an earlier result isn't yet delivered the
+        position is checkpointed once that result is.
+        """
+        self.record(b"a\n")
+        self.collector.collect()
+        self.source.position = 5
+        self.collector.collect()
+        self.assertEqual({}, self.checkpoints.positions)
+        self.collector.delivered(True)
+        self.assertEqual({u"source": 5}, self.checkpoints.positions)
+
+    def test_not_everything_collected(self):
+        """
+        A result which doesn't have all of the lines recorded so far doesn't
+        checkpoint anything.
+        """
+        recorder = _MultiStreamRecorder(
+            flush_settings=LogFlushSettings(batch_bytes=2), reactor=self.clock,
+        )
+        self.collector._recorders[_Source] = self.source.recorder = recorder
+        self.record(b"a\n", b"b\n")
+        self.collector.collect()
+        self.collector.delivered(True)
+        self.assertEqual({}, self.checkpoints.positions)
@@ -0,0 +1,169 @@
+"""
+Tests for ``agents._logbuffer``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logbuffer import (
+    DROP_NEWEST, DROP_OLDEST, LogBufferSettings, LogFlushSettings, _Chunk,
+    _StreamBuffer, log_buffer_settings_from_environment,
+    log_flush_settings_from_environment,
+)
+from .._logfilter import ERROR, WARNING
+
+
+class SettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``log_buffer_settings_from_environment`` and
+    ``log_flush_settings_from_environment``.
+    """
+    def test_buffer(self):
+        """
+        Each variable overrides one buffer setting.
+        """
+        self.assertEqual(
+            LogBufferSettings(max_bytes=100, max_lines=10, drop=DROP_NEWEST),
+            log_buffer_settings_from_environment({
+                "CATALOG_LOG_BUFFER_BYTES": "100",
+                "CATALOG_LOG_BUFFER_LINES": "10",
+                "CATALOG_LOG_BUFFER_DROP": b"newest",
+            }),
+        )
+
+    def test_flush(self):
+        """
+        Each variable overrides one flush setting.
+        """
+        self.assertEqual(
+            LogFlushSettings(
+                flush_bytes=100, flush_levels=(WARNING, ERROR),
+                batch_bytes=1000,
+            ),
+            log_flush_settings_from_environment({
+                "CATALOG_LOG_FLUSH_BYTES": "100",
+                "CATALOG_LOG_FLUSH_LEVELS": "warning,error",
+                "CATALOG_LOG_BATCH_BYTES": "1000",
+            }),
+        )
+
+
+class ChunkTests(SynchronousTestCase):
+    """
+    Tests for ``_Chunk``.
+    """
+    def setUp(self):
+        self.chunk = _Chunk([b"aa\n", b"b\n", b"cccc\n"], 1.5)
+
+    def test_take(self):
+        """
+        As many lines as fit are taken from the front.
+        """
+        self.assertEqual(
+            ([b"aa\n", b"b\n"], 5, 1),
+            (self.chunk.take(6), self.chunk.size(), self.chunk.count()),
+        )
+
+    def test_take_one(self):
+        """
+        At least one line is taken, even if it doesn't fit.
+        """
+        self.assertEqual([b"aa\n"], self.chunk.take(0))
+
+    def test_drop(self):
+        """
+        Dropped lines are gone along with the memory they used, and the rest
+        can still be taken.
+        """
+        self.chunk.take(3)
+        self.chunk.drop(2)
+        self.assertEqual(
+            (b"cccc\n", 1, [b"cccc\n"]),
+            (self.chunk.data, self.chunk.count(), self.chunk.take(100)),
+        )
+
+
+def _buffer(max_bytes=100, max_lines=100, drop=DROP_OLDEST):
+    return _StreamBuffer(
+        u"unit",
+        LogBufferSettings(max_bytes=max_bytes, max_lines=max_lines, drop=drop),
+    )
+
+
+class StreamBufferTests(SynchronousTestCase):
+    """
+    Tests for ``_StreamBuffer``.
+    """
+    def test_take(self):
+        """
+        Lines are taken oldest first, across chunks, with when each chunk's
+        lines were logged.
+        """
+        buffer = _buffer()
+        buffer.append([b"a\n", b"b\n"], 1)
+        buffer.append([b"c\n"], 2)
+        self.assertEqual(
+            (([b"a\n", b"b\n", b"c\n"], [(1, 2), (2, 1)]), 0, 0),
+            (buffer.take(100), buffer.size, buffer.count),
+        )
+
+    def test_take_some(self):
+        """
+        Lines which don't fit are left for next time.
+        """
+        buffer = _buffer()
+        buffer.append([b"a\n", b"b\n"], 1)
+        buffer.append([b"c\n"], 2)
+        self.assertEqual(
+            (([b"a\n"], [(1, 1)]), ([b"b\n", b"c\n"], [(1, 1), (2, 1)])),
+            (buffer.take(2), buffer.take(100)),
+        )
+
+    def test_drop_oldest_lines(self):
+        """
+        Over the line limit the oldest lines are thrown away, and a marker
+        says how many.
+        """
+        buffer = _buffer(max_lines=2)
+        buffer.append([b"a\n", b"b\n"], 1)
+        buffer.append([b"c\n"], 2)
+        self.assertEqual(
+            (
+                [b"b\n", b"c\n"],
+                [{u"overflowed": 1, u"overflowed_bytes": 2}],
+                [],
+            ),
+            (buffer.take(100)[0], buffer.markers(), buffer.markers()),
+        )
+
+    def test_drop_oldest_bytes(self):
+        """
+        Over the byte limit just enough of the oldest lines are thrown away,
+        whole chunks at a time where they can be.
+        """
+        buffer = _buffer(max_bytes=7)
+        buffer.append([b"a\n"], 1)
+        buffer.append([b"bb\n", b"c\n"], 2)
+        buffer.append([b"dd\n"], 3)
+        self.assertEqual(
+            (
+                (5, 2),
+                [{u"overflowed": 2, u"overflowed_bytes": 5}],
+                ([b"c\n", b"dd\n"], [(2, 1), (3, 1)]),
+            ),
+            ((buffer.size, buffer.count), buffer.markers(), buffer.take(100)),
+        )
+
+    def test_drop_newest(self):
+        """
+        Dropping the newest lines, those which don't fit are thrown away.
+        """
+        buffer = _buffer(max_bytes=6, drop=DROP_NEWEST)
+        buffer.append([b"a\n", b"b\n"], 1)
+        buffer.append([b"c\n", b"d\n"], 2)
+        self.assertEqual(
+            (
+                [b"a\n", b"b\n", b"c\n"],
+                [{u"overflowed": 1, u"overflowed_bytes": 2}],
+            ),
+            (buffer.take(100)[0], buffer.markers()),
+        )
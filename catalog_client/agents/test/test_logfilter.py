@@ -0,0 +1,156 @@
+"""
+Tests for ``agents._logfilter``.
+"""
+
+import json
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logfilter import (
+    DEBUG, ERROR, INFO, WARNING, LogFilter, LogFilterSettings,
+    log_filter_settings_from_environment, parse,
+)
+
+
+def _eliot(**fields):
+    return json.dumps(fields) + b"\n"
+
+
+class ParseTests(SynchronousTestCase):
+    """
+    Tests for ``parse``.
+    """
+    def test_eliot_action(self):
+        """
+        An Eliot action's fields are pulled out of it.
+        """
+        line = _eliot(
+            timestamp=1.5, task_uuid=u"t", action_type=u"a:b",
+            action_status=u"started",
+        )
+        record = parse(line)
+        self.assertEqual(
+            (line, 1.5, u"t", u"a:b", u"started", INFO),
+            (
+                record.line, record.timestamp, record.task_uuid,
+                record.type, record.status, record.level,
+            ),
+        )
+
+    def test_eliot_message(self):
+        """
+        An Eliot message's type is its message type.
+        """
+        self.assertEqual(u"m", parse(_eliot(message_type=u"m")).type)
+
+    def test_eliot_errors(self):
+        """
+        Failed actions, tracebacks and Twisted errors are errors.
+        """
+        self.assertEqual(
+            [ERROR, ERROR, ERROR],
+            list(
+                parse(line).level for line in [
+                    _eliot(action_type=u"a", action_status=u"failed"),
+                    _eliot(message_type=u"eliot:traceback"),
+                    _eliot(message_type=u"twisted:log", error=True),
+                ]
+            ),
+        )
+
+    def test_bad_timestamp(self):
+        """
+        A timestamp which isn't a number is ignored.
+        """
+        self.assertEqual(None, parse(_eliot(timestamp=u"now")).timestamp)
+
+    def test_plain(self):
+        """
+        The level of a line which isn't JSON is guessed from its text.
+        """
+        self.assertEqual(
+            [ERROR, WARNING, DEBUG, INFO, INFO],
+            list(
+                parse(line).level for line in [
+                    b"2015-11-02 ERROR: broken\n",
+                    b"[warn] careful\n",
+                    b"trace: details\n",
+                    b"{not json\n",
+                    b"no errors here\n",
+                ]
+            ),
+        )
+
+
+class LogFilterSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``log_filter_settings_from_environment``.
+    """
+    def test_lists(self):
+        """
+        Each variable is a comma separated list.
+        """
+        self.assertEqual(
+            LogFilterSettings(
+                drop_types=(u"a*", u"b"), keep_levels=(),
+            ),
+            log_filter_settings_from_environment({
+                "CATALOG_LOG_DROP_TYPES": b"a*, b",
+                "CATALOG_LOG_KEEP_LEVELS": b"",
+            }),
+        )
+
+
+class LogFilterTests(SynchronousTestCase):
+    """
+    Tests for ``LogFilter``.
+    """
+    def kept(self, settings, lines):
+        return list(
+            record.line
+            for record in LogFilter(settings).records(u"unit", lines)
+        )
+
+    def test_default(self):
+        """
+        By default the convergence loop's chatter and debug lines are
+        dropped unless something went wrong.
+        """
+        converged = _eliot(action_type=u"flocker:agent:converge")
+        failed = _eliot(
+            action_type=u"flocker:agent:converge", action_status=u"failed",
+        )
+        other = _eliot(message_type=u"flocker:other")
+        plain = b"hello\n"
+        debug = b"DEBUG details\n"
+        self.assertEqual(
+            [failed, other, plain],
+            self.kept(
+                LogFilterSettings(), [converged, failed, other, plain, debug],
+            ),
+        )
+
+    def test_keep_types(self):
+        """
+        A keep rule for a type overrides drop rules.
+        """
+        converged = _eliot(action_type=u"flocker:agent:converge")
+        settings = LogFilterSettings(keep_types=(u"*converge",))
+        self.assertEqual([converged], self.kept(settings, [converged]))
+
+    def test_keep_everything(self):
+        """
+        ``keep_everything`` drops nothing.
+        """
+        lines = [
+            _eliot(action_type=u"flocker:agent:converge"), b"DEBUG hello\n",
+        ]
+        self.assertEqual(
+            lines,
+            list(
+                record.line
+                for record in LogFilter.keep_everything().records(
+                    u"unit", lines,
+                )
+            ),
+        )
@@ -0,0 +1,133 @@
+"""
+Tests for ``agents._loglib``.
+"""
+
+import json
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logbuffer import LogFlushSettings
+from .._logfilter import ERROR
+from .._loglib import _CatchUp, _MultiStreamRecorder
+
+
+class CatchUpTests(SynchronousTestCase):
+    """
+    Tests for ``_CatchUp``.
+    """
+    def test_rate(self):
+        """
+        Reading is delayed for as long as it takes to stay within the rate on
+        average.
+        """
+        clock = Clock()
+        catch_up = _CatchUp(clock, 100)
+        self.assertEqual(2, catch_up.delay(200))
+        clock.advance(2)
+        self.assertEqual(0, catch_up.delay(0))
+        clock.advance(3)
+        self.assertEqual(0, catch_up.delay(100))
+
+    def test_finished(self):
+        """
+        Once caught up reading isn't delayed.
+        """
+        catch_up = _CatchUp(Clock(), 100)
+        catch_up.finish()
+        self.assertEqual(0, catch_up.delay(1000))
+
+
+class MultiStreamRecorderTests(SynchronousTestCase):
+    """
+    Tests for ``_MultiStreamRecorder``.
+    """
+    def test_invalid_utf8(self):
+        """
+        Lines which aren't valid UTF-8 are recorded with the invalid bytes
+        replaced, so that they can be reported.
+        """
+        recorder = _MultiStreamRecorder(reactor=Clock())
+        recorder.recorder(u"unit")([b"caf\xe9\n", b"ok\n"])
+        result = recorder.consume()
+        json.dumps(result)
+        self.assertEqual(
+            {u"unit": [b"caf\xef\xbf\xbd\n", b"ok\n"]}, result,
+        )
+
+    def recorder(self, **flush_settings):
+        self.flushes = []
+        return _MultiStreamRecorder(
+            flush_settings=LogFlushSettings(**flush_settings),
+            flush=lambda: self.flushes.append(None), reactor=Clock(),
+        )
+
+    def test_flush_bytes(self):
+        """
+        A flush is asked for once enough bytes are waiting, and only once
+        until the lines are collected.
+        """
+        recorder = self.recorder(flush_bytes=4)
+        recorder.recorder(u"unit")([b"a\n"])
+        self.assertEqual([], self.flushes)
+        recorder.recorder(u"other")([b"b\n"])
+        recorder.recorder(u"other")([b"c\n"])
+        self.assertEqual(1, len(self.flushes))
+        recorder.consume()
+        recorder.recorder(u"unit")([b"d\n", b"e\n"])
+        self.assertEqual(2, len(self.flushes))
+
+    def test_flush_levels(self):
+        """
+        A flush is asked for as soon as a line at one of the flush levels
+        arrives.
+        """
+        recorder = self.recorder(flush_levels=(ERROR,))
+        recorder.recorder(u"unit")([b"WARNING: a\n"])
+        self.assertEqual([], self.flushes)
+        recorder.recorder(u"unit")([b"ERROR: b\n"])
+        self.assertEqual(1, len(self.flushes))
+
+    def test_batch_bytes(self):
+        """
+        One collection takes at most a batch's worth of lines, a fair share
+        from each stream, and asks for a flush to take the rest.
+        """
+        recorder = self.recorder(batch_bytes=4)
+        recorder.recorder(u"busy")([b"a\n", b"b\n", b"c\n"])
+        recorder.recorder(u"quiet")([b"d\n"])
+        self.assertEqual(
+            ({u"busy": [b"a\n"], u"quiet": [b"d\n"]}, 1),
+            (recorder.consume(), len(self.flushes)),
+        )
+        self.assertEqual(
+            ({u"busy": [b"b\n", b"c\n"]}, 0),
+            (recorder.consume(), recorder.size),
+        )
+
+    def test_batch_leftover(self):
+        """
+        What one stream leaves of its share of a batch goes to the others.
+        """
+        recorder = self.recorder(batch_bytes=6)
+        recorder.recorder(u"busy")([b"a\n", b"b\n", b"c\n"])
+        recorder.recorder(u"other")([b"d\n"])
+        self.assertEqual(
+            {u"busy": [b"a\n", b"b\n"], u"other": [b"d\n"]},
+            recorder.consume(),
+        )
+
+    def test_written(self):
+        """
+        After each collection ``written`` says when the lines collected were
+        logged: when they say, or else when they were recorded.
+        """
+        clock = Clock()
+        recorder = _MultiStreamRecorder(reactor=clock)
+        clock.advance(10)
+        recorder.recorder(u"unit")([b"a\n", b"b\n"])
+        recorder.recorder(u"unit")([
+            json.dumps({u"timestamp": 5.0, u"message_type": u"m"}) + b"\n",
+        ])
+        recorder.consume()
+        self.assertEqual([(10, 2), (5.0, 1)], recorder.written)
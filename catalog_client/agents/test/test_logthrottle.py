@@ -0,0 +1,220 @@
+"""
+Tests for ``agents._logthrottle``.
+"""
+
+import json
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logfilter import parse
+from .._logthrottle import (
+    LogThrottle, LogThrottleSettings, log_throttle_settings_from_environment,
+)
+
+
+def _records(*lines):
+    return list(parse(line) for line in lines)
+
+
+def _lines(records):
+    return list(record.line for record in records)
+
+
+class LogThrottleSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``log_throttle_settings_from_environment``.
+    """
+    def test_defaults(self):
+        """
+        Without any of the variables the defaults are used.
+        """
+        self.assertEqual(
+            LogThrottleSettings(), log_throttle_settings_from_environment({}),
+        )
+
+    def test_variables(self):
+        """
+        Each variable overrides one setting.
+        """
+        self.assertEqual(
+            LogThrottleSettings(repeat_window=2.5, rate=10.0, burst=20),
+            log_throttle_settings_from_environment({
+                "CATALOG_LOG_REPEAT_WINDOW": "2.5",
+                "CATALOG_LOG_RATE": "10",
+                "CATALOG_LOG_BURST": "20",
+            }),
+        )
+
+
+class RepeatTests(SynchronousTestCase):
+    """
+    Tests for the collapsing of repeated messages by ``LogThrottle``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.throttle = LogThrottle(
+            self.clock, LogThrottleSettings(repeat_window=10, rate=0),
+        )
+
+    def test_collapsed(self):
+        """
+        Plain lines differing only in their digits are copies.  Only the
+        first is kept, and the others are reported as one marker.
+        """
+        self.clock.advance(5)
+        kept = self.throttle.records(
+            u"unit", _records(b"failed 1\n", b"failed 22\n", b"other\n"),
+        )
+        self.clock.advance(1)
+        self.throttle.records(u"unit", _records(b"failed 333\n"))
+        self.assertEqual(
+            (
+                [b"failed 1\n", b"other\n"],
+                {
+                    u"unit": [{
+                        u"line": b"failed 1\n", u"repeated": 2,
+                        u"first": 5, u"last": 6,
+                    }],
+                },
+            ),
+            (_lines(kept), self.throttle.markers()),
+        )
+
+    def test_eliot(self):
+        """
+        Eliot messages differing only in their timestamp, task and level are
+        copies, and the marker has their own timestamps.
+        """
+        def message(timestamp, task_uuid):
+            return json.dumps({
+                u"timestamp": timestamp, u"task_uuid": task_uuid,
+                u"task_level": [1], u"message_type": u"a:b", u"n": 1,
+            }) + b"\n"
+        first = message(1.5, u"one")
+        kept = self.throttle.records(
+            u"unit", _records(first, message(2.5, u"two")),
+        )
+        self.assertEqual(
+            (
+                [first],
+                {
+                    u"unit": [{
+                        u"line": first, u"repeated": 1,
+                        u"first": 2.5, u"last": 2.5,
+                    }],
+                },
+            ),
+            (_lines(kept), self.throttle.markers()),
+        )
+
+    def test_markers_once(self):
+        """
+        Markers are reported once.
+        """
+        self.throttle.records(u"unit", _records(b"a\n", b"a\n"))
+        self.throttle.markers()
+        self.assertEqual({}, self.throttle.markers())
+
+    def test_units(self):
+        """
+        Copies are only looked for among the lines of the same unit.
+        """
+        self.assertEqual(
+            ([b"a\n"], [b"a\n"]),
+            (
+                _lines(self.throttle.records(u"one", _records(b"a\n"))),
+                _lines(self.throttle.records(u"two", _records(b"a\n"))),
+            ),
+        )
+
+    def test_window_over(self):
+        """
+        A copy seen after the window is over and the earlier copies have
+        been reported is kept.
+        """
+        self.throttle.records(u"unit", _records(b"a\n", b"a\n"))
+        self.throttle.markers()
+        self.clock.advance(10)
+        self.assertEqual(
+            [b"a\n"],
+            _lines(self.throttle.records(u"unit", _records(b"a\n"))),
+        )
+
+    def test_window_over_unreported(self):
+        """
+        Copies go on being counted after the window is over until the
+        earlier ones have been reported.
+        """
+        self.throttle.records(u"unit", _records(b"a\n", b"a\n"))
+        self.clock.advance(10)
+        kept = self.throttle.records(u"unit", _records(b"a\n"))
+        self.assertEqual(
+            ([], 2),
+            (_lines(kept), self.throttle.markers()[u"unit"][0][u"repeated"]),
+        )
+
+    def test_no_window(self):
+        """
+        With no repeat window every copy is kept.
+        """
+        throttle = LogThrottle(
+            self.clock, LogThrottleSettings(repeat_window=0, rate=0),
+        )
+        self.assertEqual(
+            ([b"a\n", b"a\n"], {}),
+            (
+                _lines(throttle.records(u"unit", _records(b"a\n", b"a\n"))),
+                throttle.markers(),
+            ),
+        )
+
+
+class RateTests(SynchronousTestCase):
+    """
+    Tests for the rate limit of ``LogThrottle``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.throttle = LogThrottle(
+            self.clock,
+            LogThrottleSettings(repeat_window=0, rate=1, burst=2),
+        )
+
+    def test_burst(self):
+        """
+        Lines beyond the burst are dropped and reported as a marker.
+        """
+        self.clock.advance(3)
+        kept = self.throttle.records(
+            u"unit", _records(b"a\n", b"b\n", b"c\n", b"d\n"),
+        )
+        self.assertEqual(
+            (
+                [b"a\n", b"b\n"],
+                {u"unit": [{u"dropped": 2, u"first": 3, u"last": 3}]},
+            ),
+            (_lines(kept), self.throttle.markers()),
+        )
+
+    def test_refill(self):
+        """
+        The lines allowed build up again at the rate.
+        """
+        self.throttle.records(u"unit", _records(b"a\n", b"b\n"))
+        self.clock.advance(1)
+        kept = self.throttle.records(u"unit", _records(b"c\n", b"d\n"))
+        self.assertEqual(
+            ([b"c\n"], 1),
+            (_lines(kept), self.throttle.markers()[u"unit"][0][u"dropped"]),
+        )
+
+    def test_units(self):
+        """
+        Each unit has its own limit.
+        """
+        self.throttle.records(u"one", _records(b"a\n", b"b\n"))
+        self.assertEqual(
+            [b"a\n", b"b\n"],
+            _lines(self.throttle.records(u"two", _records(b"a\n", b"b\n"))),
+        )
@@ -0,0 +1,90 @@
+"""
+Tests for ``agents._metrics``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._metrics import _Registry
+
+
+class RegistryTests(SynchronousTestCase):
+    """
+    Tests for ``_Registry``.
+    """
+    def setUp(self):
+        self.registry = _Registry()
+
+    def test_same_metric(self):
+        """
+        Registering a name again as the same kind of metric returns the
+        metric already registered.
+        """
+        first = self.registry.counter("c", "A counter.")
+        self.assertIs(first, self.registry.counter("c", "A counter."))
+
+    def test_different_kind(self):
+        """
+        Registering a name again as a different kind of metric is an error.
+        """
+        self.registry.counter("c", "A counter.")
+        self.assertRaises(ValueError, self.registry.gauge, "c", "A gauge.")
+
+    def test_snapshot(self):
+        """
+        ``snapshot`` gives each metric's values by their labels.
+        """
+        counter = self.registry.counter("c", "A counter.")
+        counter.inc(pool=u"a")
+        counter.inc(2, pool=u"a")
+        counter.inc(pool=u"b")
+        gauge = self.registry.gauge("g", "A gauge.")
+        gauge.set(5)
+        gauge.set(7)
+        histogram = self.registry.histogram("h", "A histogram.", [1, 2])
+        histogram.observe(0.5)
+        histogram.observe(3, count=2)
+        self.assertEqual(
+            {
+                "c": {u"pool=a": 3, u"pool=b": 1},
+                "g": {u"": 7},
+                "h": {u"": dict(count=3, sum=6.5)},
+            },
+            self.registry.snapshot(),
+        )
+
+    def test_exposition(self):
+        """
+        ``exposition`` renders every metric in the Prometheus text format,
+        with cumulative histogram buckets and escaped label values.
+        """
+        self.registry.counter("c", "A\ncounter.").inc(name=u'a"b')
+        self.registry.histogram("h", "A histogram.", [1, 2]).observe(1.5)
+        self.assertEqual(
+            b"# HELP c A\\ncounter.\n"
+            b"# TYPE c counter\n"
+            b'c{name="a\\"b"} 1\n'
+            b"# HELP h A histogram.\n"
+            b"# TYPE h histogram\n"
+            b'h_bucket{le="1"} 0\n'
+            b'h_bucket{le="2"} 1\n'
+            b'h_bucket{le="+Inf"} 1\n'
+            b"h_sum 1.5\n"
+            b"h_count 1\n",
+            self.registry.exposition(),
+        )
+
+    def test_gauge_function(self):
+        """
+        A gauge given a function takes whatever it returns each time it is
+        read.
+        """
+        value = [1]
+        gauge = self.registry.gauge("g", "A gauge.")
+        gauge.set(5, pool=u"a")
+        gauge.set_function(lambda: value[0], pool=u"a")
+        first = self.registry.snapshot()
+        value[0] = 2
+        self.assertEqual(
+            ({"g": {u"pool=a": 1}}, b"g{pool=\"a\"} 2\n"),
+            (first, self.registry.exposition().splitlines(True)[-1]),
+        )
@@ -0,0 +1,176 @@
+"""
+Tests for ``agents._metricsserver``.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from .._metrics import REGISTRY, _Registry
+from .._metricsserver import (
+    MetricsSettings, _MetricsResource, _ReactorSampler, defer_to_thread_pool,
+    metrics_settings_from_environment, serve_metrics,
+)
+from .test_spool import _WaitingReactor
+
+
+class MetricsSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``metrics_settings_from_environment``.
+    """
+    def test_defaults(self):
+        """
+        Without a port metrics aren't served, and an empty port is the same
+        as none.
+        """
+        self.assertEqual(
+            (MetricsSettings(), MetricsSettings()),
+            (
+                metrics_settings_from_environment({}),
+                metrics_settings_from_environment({
+                    "CATALOG_METRICS_PORT": "",
+                }),
+            ),
+        )
+
+    def test_variables(self):
+        """
+        Each variable overrides one setting.
+        """
+        self.assertEqual(
+            MetricsSettings(port=9100, interface=u"0.0.0.0"),
+            metrics_settings_from_environment({
+                "CATALOG_METRICS_PORT": "9100",
+                "CATALOG_METRICS_INTERFACE": b"0.0.0.0",
+            }),
+        )
+
+
+class MetricsResourceTests(SynchronousTestCase):
+    """
+    Tests for ``_MetricsResource``.
+    """
+    def test_exposition(self):
+        """
+        The registry is rendered in the Prometheus text format.
+        """
+        registry = _Registry()
+        registry.counter("c", "A counter.").inc(pool=u"a")
+        request = DummyRequest([b""])
+        body = _MetricsResource(registry).render(request)
+        self.assertEqual(
+            (
+                registry.exposition(),
+                [b"text/plain; version=0.0.4; charset=utf-8"],
+            ),
+            (
+                body,
+                request.responseHeaders.getRawHeaders(b"Content-Type"),
+            ),
+        )
+
+
+class _ThreadPool(object):
+    working = [object(), object()]
+    max = 10
+
+
+class _Reactor(Clock):
+    def getThreadPool(self):
+        return _ThreadPool()
+
+
+class ReactorSamplerTests(SynchronousTestCase):
+    """
+    Tests for ``_ReactorSampler``.
+    """
+    def setUp(self):
+        self.reactor = _Reactor()
+        self.sampler = _ReactorSampler(self.reactor, interval=1.0)
+
+    def lag(self):
+        """
+        :return: The count and sum of the reactor lag observed so far.
+        """
+        lag = REGISTRY.snapshot()["catalog_agent_reactor_lag_seconds"].get(
+            u"", dict(count=0, sum=0),
+        )
+        return (lag["count"], lag["sum"])
+
+    def test_sample(self):
+        """
+        Each sample records how late it ran and how busy the thread pool is.
+        """
+        (count, total) = self.lag()
+        self.sampler.start()
+        self.reactor.advance(1.5)
+        snapshot = REGISTRY.snapshot()
+        self.assertEqual(
+            ((count + 1, total + 0.5), 2, 10),
+            (
+                self.lag(),
+                snapshot["catalog_agent_threadpool_busy_threads"][u""],
+                snapshot["catalog_agent_threadpool_max_threads"][u""],
+            ),
+        )
+
+    def test_repeats(self):
+        """
+        Samples are taken every interval until the sampler is stopped.
+        """
+        self.sampler.start()
+        self.reactor.advance(1)
+        self.assertEqual(1, len(self.reactor.getDelayedCalls()))
+        self.sampler.stop()
+        self.assertEqual([], self.reactor.getDelayedCalls())
+
+
+def _queued():
+    return REGISTRY.snapshot().get(
+        "catalog_agent_threadpool_queued_tasks", {},
+    ).get(u"", 0)
+
+
+class DeferToThreadPoolTests(SynchronousTestCase):
+    """
+    Tests for ``defer_to_thread_pool``.
+    """
+    def test_queued(self):
+        """
+        Calls are counted as queued until a thread starts on them, and their
+        results are delivered.
+        """
+        reactor = _WaitingReactor()
+        before = _queued()
+        calling = defer_to_thread_pool(reactor, lambda a, b: a + b, 1, b=2)
+        queued = _queued() - before
+        reactor.pool.run()
+        self.assertEqual(
+            (1, 0, 3),
+            (queued, _queued() - before, self.successResultOf(calling)),
+        )
+
+
+class ServeMetricsTests(TestCase):
+    """
+    Tests for ``serve_metrics``.
+    """
+    def test_no_port(self):
+        """
+        Without a port nothing is served.
+        """
+        serving = serve_metrics(reactor, MetricsSettings())
+        self.assertIs(None, self.successResultOf(serving))
+
+    def test_port(self):
+        """
+        With a port it listens there, on the interface configured.
+        """
+        listening = serve_metrics(reactor, MetricsSettings(port=0))
+
+        def listened(port):
+            self.addCleanup(port.stopListening)
+            self.assertEqual(u"127.0.0.1", port.getHost().host)
+        listening.addCallback(listened)
+        return listening
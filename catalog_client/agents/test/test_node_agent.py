@@ -0,0 +1,110 @@
+"""
+Tests for ``agents.node_agent``.
+"""
+
+from datetime import timedelta
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import node_agent
+from ..node_agent import _Collector
+
+
+def _make_file(root, path, content):
+    target = root.preauthChild(path.lstrip(b"/"))
+    target.parent().makedirs(ignoreExistingDirectory=True)
+    target.setContent(content)
+    return target
+
+
+class CollectorTests(SynchronousTestCase):
+    """
+    Tests for ``_Collector``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        root = FilePath(self.mktemp())
+        self.host = root.child(b"host")
+        self.proc = root.child(b"proc")
+        _make_file(self.host, b"/usr/bin/flocker-diagnostics", b"#!")
+        self.database = _make_file(
+            self.host, b"/var/lib/dpkg/status", b"Package: flocker\n",
+        )
+        _make_file(self.host, b"/etc/os-release", b"ID=ubuntu\n")
+        _make_file(self.host, b"/etc/hostname", b"node1\n")
+        _make_file(self.proc, b"/sys/kernel/osrelease", b"4.4.0\n")
+        _make_file(self.proc, b"/meminfo", b"MemTotal: 1 kB\n")
+        _make_file(self.proc, b"/cpuinfo", b"processor : 0\n")
+        self.versioned = []
+        self.patch(node_agent, "getProcessOutput", self.diagnostics)
+        self.collector = _Collector(
+            recheck_interval=timedelta(hours=1), host=self.host,
+            proc=self.proc, reactor=self.clock,
+        )
+
+    def diagnostics(self, executable, args, env, reactor):
+        self.versioned.append(args)
+        return succeed(b"1.15.0\n")
+
+    def test_facts(self):
+        """
+        The Flocker version is reported with the static facts.
+        """
+        self.assertEqual(
+            dict(
+                kernel=u"4.4.0", os=dict(id=u"ubuntu"), hostname=u"node1",
+                cpus=1, memory_bytes=1024, flocker_version=b"1.15.0",
+            ),
+            self.successResultOf(self.collector.collect()),
+        )
+
+    def test_unchanged(self):
+        """
+        While nothing changes the facts collected before are reported again
+        without running flocker-diagnostics.
+        """
+        first = self.successResultOf(self.collector.collect())
+        self.clock.advance(60)
+        self.assertEqual(
+            (first, 1),
+            (
+                self.successResultOf(self.collector.collect()),
+                len(self.versioned),
+            ),
+        )
+
+    def test_package_database_changed(self):
+        """
+        The facts are collected again once a package database changes.
+        """
+        self.successResultOf(self.collector.collect())
+        self.database.setContent(b"Package: flocker\nVersion: 1.15.1\n")
+        self.successResultOf(self.collector.collect())
+        self.assertEqual(2, len(self.versioned))
+
+    def test_recheck_interval(self):
+        """
+        The facts are collected again every recheck interval, changed or not.
+        """
+        self.successResultOf(self.collector.collect())
+        self.clock.advance(timedelta(hours=1).total_seconds())
+        self.successResultOf(self.collector.collect())
+        self.assertEqual(2, len(self.versioned))
+
+    def test_fingerprint_unreadable(self):
+        """
+        If the files which tell whether anything changed can't be looked at
+        the facts are collected again rather than failing, for as long as
+        they can't.
+        """
+        self.successResultOf(self.collector.collect())
+
+        def vanished(path):
+            raise OSError(2, "No such file or directory")
+        self.patch(node_agent, "_identity", vanished)
+        self.successResultOf(self.collector.collect())
+        self.successResultOf(self.collector.collect())
+        self.assertEqual(3, len(self.versioned))
@@ -0,0 +1,90 @@
+"""
+Tests for ``agents._patch``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._patch import diff
+
+
+class DiffTests(SynchronousTestCase):
+    """
+    Tests for ``diff``.
+    """
+    def test_equal(self):
+        """
+        Equal values need no operations.
+        """
+        self.assertEqual(
+            [],
+            diff(
+                {u"a": [1, {u"b": u"c"}], u"d": None},
+                {u"a": [1, {u"b": u"c"}], u"d": None},
+            ),
+        )
+
+    def test_dict(self):
+        """
+        Keys only in the old value are removed, keys only in the new value
+        are added and changed values are replaced.
+        """
+        self.assertEqual(
+            [
+                dict(op=u"remove", path=u"/gone"),
+                dict(op=u"replace", path=u"/changed", value=2),
+                dict(op=u"add", path=u"/new", value=3),
+            ],
+            sorted(
+                diff(
+                    {u"gone": 0, u"changed": 1, u"same": 4},
+                    {u"changed": 2, u"new": 3, u"same": 4},
+                ),
+                key=lambda operation: [u"remove", u"replace", u"add"].index(
+                    operation[u"op"]
+                ),
+            ),
+        )
+
+    def test_nested(self):
+        """
+        Paths to nested values are JSON Pointers with ``~`` and ``/`` in keys
+        escaped.
+        """
+        self.assertEqual(
+            [dict(op=u"replace", path=u"/a~1b/c~0d/0", value=2)],
+            diff({u"a/b": {u"c~d": [1]}}, {u"a/b": {u"c~d": [2]}}),
+        )
+
+    def test_list_longer(self):
+        """
+        Items appended to a list are added at its end.
+        """
+        self.assertEqual(
+            [
+                dict(op=u"add", path=u"/-", value=3),
+                dict(op=u"add", path=u"/-", value=4),
+            ],
+            diff([1, 2], [1, 2, 3, 4]),
+        )
+
+    def test_list_shorter(self):
+        """
+        Items missing from the end of a list are removed last first, so that
+        each index is still valid when it is removed.
+        """
+        self.assertEqual(
+            [
+                dict(op=u"remove", path=u"/3"),
+                dict(op=u"remove", path=u"/2"),
+            ],
+            diff([1, 2, 3, 4], [1, 2]),
+        )
+
+    def test_type_changed(self):
+        """
+        A value which changes type is replaced whole.
+        """
+        self.assertEqual(
+            [dict(op=u"replace", path=u"/a", value=[1])],
+            diff({u"a": {u"b": 1}}, {u"a": [1]}),
+        )
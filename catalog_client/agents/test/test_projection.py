@@ -0,0 +1,77 @@
+"""
+Tests for ``agents._projection``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._projection import ELIDED, Projection
+
+DETAILS = {
+    u"Id": u"abc",
+    u"Config": {u"Image": u"busybox", u"Env": [u"SECRET=1"], u"Tty": False},
+    u"Mounts": [
+        {u"Source": u"/a", u"Destination": u"/b", u"Mode": u"rw"},
+        {u"Source": u"/c", u"Destination": u"/d", u"Mode": u"ro"},
+    ],
+}
+
+
+class ProjectionTests(SynchronousTestCase):
+    """
+    Tests for ``Projection``.
+    """
+    def test_fields(self):
+        """
+        Only the listed paths are kept.
+        """
+        self.assertEqual(
+            {u"Id": u"abc", u"Config": {u"Image": u"busybox"}},
+            Projection([u"Id", u"Config.Image"]).project(DETAILS),
+        )
+
+    def test_missing(self):
+        """
+        Paths which aren't in the document are left out.
+        """
+        self.assertEqual(
+            {u"Id": u"abc"},
+            Projection([u"Id", u"State.Running"]).project(DETAILS),
+        )
+
+    def test_list(self):
+        """
+        A path through a list applies to each item in it.
+        """
+        self.assertEqual(
+            {u"Mounts": [{u"Source": u"/a"}, {u"Source": u"/c"}]},
+            Projection([u"Mounts.Source"]).project(DETAILS),
+        )
+
+    def test_everything(self):
+        """
+        ``*`` keeps every key at its level.
+        """
+        self.assertEqual(
+            {u"Config": DETAILS[u"Config"]},
+            Projection([u"Config.*"]).project(DETAILS),
+        )
+
+    def test_elided(self):
+        """
+        Elided paths are replaced with a placeholder, even under a path kept
+        whole.
+        """
+        config = dict(DETAILS[u"Config"], Env=ELIDED)
+        self.assertEqual(
+            {u"Id": u"abc", u"Config": config},
+            Projection([u"Id", u"Config"], [u"Config.Env"]).project(DETAILS),
+        )
+
+    def test_elided_not_kept(self):
+        """
+        An elided path which isn't kept isn't added.
+        """
+        self.assertEqual(
+            {u"Id": u"abc"},
+            Projection([u"Id"], [u"Config.Env"]).project(DETAILS),
+        )
@@ -0,0 +1,332 @@
+"""
+Tests for ``agents._scheduler``.
+"""
+
+from datetime import timedelta
+
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.http_headers import Headers
+
+from .._httpclient import Delivery
+from .._scheduler import (
+    MINIMUM_WAKE_UP_INTERVAL, TOO_MANY_REQUESTS, ScheduleSettings, Scheduler,
+    _AdaptiveInterval, schedule_settings_from_environment,
+)
+
+SETTINGS = ScheduleSettings(
+    minimum_interval=timedelta(seconds=5),
+    maximum_interval=timedelta(seconds=60),
+    jitter=0.0,
+    upload_rate=1000,
+)
+
+
+class _Response(object):
+    def __init__(self, code, headers=None):
+        self.code = code
+        self.headers = Headers(headers or {})
+
+
+def _delivery(code=200, sent_bytes=0, headers=None):
+    return Delivery(
+        response=_Response(code, headers), body=b"", sent_bytes=sent_bytes,
+    )
+
+
+def _interval(settings=SETTINGS, random=lambda: 0.5):
+    return _AdaptiveInterval(settings, random=random)
+
+
+class AdaptiveIntervalTests(SynchronousTestCase):
+    """
+    Tests for ``_AdaptiveInterval``.
+    """
+    def test_minimum(self):
+        """
+        With nothing to slow it down the interval is the minimum.
+        """
+        self.assertEqual(5, _interval().next_delay(0.1, _delivery(), 0))
+
+    def test_first_delay(self):
+        """
+        The first delay is a random part of the minimum interval.
+        """
+        self.assertEqual(
+            (0, 2.5, 5),
+            tuple(
+                _interval(random=lambda: r).first_delay()
+                for r in (0, 0.5, 1)
+            ),
+        )
+
+    def test_jitter(self):
+        """
+        Delays are lengthened or shortened by up to ``jitter``.
+        """
+        settings = SETTINGS.set(jitter=0.2)
+        self.assertEqual(
+            (4, 6),
+            tuple(
+                _interval(settings, lambda: r).next_delay(0, None, 0)
+                for r in (0, 1)
+            ),
+        )
+
+    def test_slow_collection(self):
+        """
+        A collector spends at most a tenth of its time collecting.
+        """
+        self.assertEqual(20, _interval().next_delay(2, None, 0))
+
+    def test_upload_rate(self):
+        """
+        Big uploads are spread out to stay within the upload rate.
+        """
+        self.assertEqual(
+            30, _interval().next_delay(0, _delivery(sent_bytes=30000), 0),
+        )
+
+    def test_maximum(self):
+        """
+        The interval is never longer than the maximum.
+        """
+        self.assertEqual(60, _interval().next_delay(100, None, 0))
+
+    def test_too_many_requests(self):
+        """
+        ``429 Too Many Requests`` doubles the interval.
+        """
+        interval = _interval()
+        self.assertEqual(
+            [10, 20],
+            list(
+                interval.next_delay(0, _delivery(TOO_MANY_REQUESTS), 0)
+                for _ in range(2)
+            ),
+        )
+
+    def test_retry_after_seconds(self):
+        """
+        ``Retry-After`` in seconds is waited for if it is longer.
+        """
+        self.assertEqual(
+            40,
+            _interval().next_delay(
+                0, _delivery(503, headers={b"Retry-After": [b"40"]}), 0,
+            ),
+        )
+
+    def test_retry_after_date(self):
+        """
+        ``Retry-After`` as a date is waited for if it is later.
+        """
+        self.assertEqual(
+            30,
+            _interval().next_delay(
+                0,
+                _delivery(
+                    503,
+                    headers={
+                        b"Retry-After": [b"Thu, 01 Jan 1970 00:01:00 GMT"],
+                    },
+                ),
+                30,
+            ),
+        )
+
+    def test_recovery(self):
+        """
+        Once the pressure is off the interval halves each time until it is
+        back to the minimum.
+        """
+        interval = _interval()
+        interval.next_delay(0, _delivery(sent_bytes=40000), 0)
+        self.assertEqual(
+            [20, 10, 5, 5],
+            list(interval.next_delay(0, None, 0) for _ in range(4)),
+        )
+
+    def test_failed(self):
+        """
+        A failed tick doubles the interval.
+        """
+        interval = _interval()
+        self.assertEqual(
+            ([10, 20], True),
+            (
+                [interval.failed_delay(), interval.failed_delay()],
+                interval.backing_off(),
+            ),
+        )
+
+
+class ScheduleSettingsFromEnvironmentTests(SynchronousTestCase):
+    """
+    Tests for ``schedule_settings_from_environment``.
+    """
+    def test_collector_defaults(self):
+        """
+        A collector can give its own intervals, which the environment
+        overrides.
+        """
+        class Collector(object):
+            name = b"example"
+            minimum_interval = timedelta(seconds=30)
+            maximum_interval = timedelta(seconds=300)
+
+        self.assertEqual(
+            ScheduleSettings(
+                minimum_interval=timedelta(seconds=30),
+                maximum_interval=timedelta(seconds=600),
+                jitter=0.5,
+                upload_rate=10,
+            ),
+            schedule_settings_from_environment(
+                {
+                    "CATALOG_EXAMPLE_MAXIMUM_INTERVAL": "600",
+                    "CATALOG_OTHER_MINIMUM_INTERVAL": "1",
+                    "CATALOG_SCHEDULE_JITTER": "0.5",
+                    "CATALOG_SCHEDULE_UPLOAD_RATE": "10",
+                },
+                Collector(),
+            ),
+        )
+
+
+class _Collector(object):
+    """
+    A collector which gives each of ``results`` in turn and remembers when
+    it was collected.
+    """
+    name = b"test"
+
+    def __init__(self, clock, results):
+        self._clock = clock
+        self._results = list(results)
+        self.collected = []
+        self.acknowledged = []
+        self.wake_up = None
+
+    def intervals(self):
+        return list(
+            later - earlier
+            for (earlier, later) in zip(self.collected, self.collected[1:])
+        )
+
+    def collect(self):
+        self.collected.append(self._clock.seconds())
+        result = self._results.pop(0)
+        if isinstance(result, Exception):
+            return fail(result)
+        return succeed(result)
+
+    def acknowledge(self, result):
+        self.acknowledged.append(result)
+
+    def set_wake_up(self, wake_up):
+        self.wake_up = wake_up
+
+
+class SchedulerTests(SynchronousTestCase):
+    """
+    Tests for ``Scheduler``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.reported = []
+        # Collect for the first time straight away.
+        self.patch(_AdaptiveInterval, "first_delay", lambda self: 0)
+
+    def run_for(self, seconds):
+        """
+        Run the clock second by second, so that the collector sees the time
+        each collection was scheduled for.
+        """
+        self.clock.pump([0] + [1] * seconds)
+
+    def report(self, result):
+        self.reported.append(result)
+        return succeed(self.codes.pop(0))
+
+    def test_collect_and_report(self):
+        """
+        Each collector is collected every interval and its results reported.
+        Accepted results are acknowledged.
+        """
+        collector = _Collector(self.clock, [1, 2])
+        self.codes = [_delivery(200), _delivery(500)]
+        Scheduler(self.clock).add(collector, self.report, SETTINGS)
+        self.run_for(5)
+        self.assertEqual(
+            ([5], [1, 2], [1]),
+            (collector.intervals(), self.reported, collector.acknowledged),
+        )
+
+    def test_not_isolated(self):
+        """
+        Without isolation a failed collection stops the collector and fails
+        the ``Deferred`` ``add`` returned.
+        """
+        collector = _Collector(self.clock, [RuntimeError("broken"), 2])
+        finished = Scheduler(self.clock).add(collector, self.report, SETTINGS)
+        self.run_for(60)
+        self.failureResultOf(finished, RuntimeError)
+        self.assertEqual(1, len(collector.collected))
+
+    def test_reschedule_failed(self):
+        """
+        If the next collection can't be scheduled that fails the ``Deferred``
+        ``add`` returned too.
+        """
+        def next_delay(self, collect_seconds, delivery, now):
+            raise RuntimeError("broken")
+        self.patch(_AdaptiveInterval, "next_delay", next_delay)
+        collector = _Collector(self.clock, [1])
+        self.codes = [_delivery(200)]
+        finished = Scheduler(self.clock).add(collector, self.report, SETTINGS)
+        self.run_for(1)
+        self.failureResultOf(finished, RuntimeError)
+
+    def test_isolated(self):
+        """
+        With isolation a failed collection is retried after backing off.
+        """
+        collector = _Collector(self.clock, [RuntimeError("broken"), 2])
+        self.codes = [_delivery(200)]
+        finished = Scheduler(self.clock, isolate=True).add(
+            collector, self.report, SETTINGS,
+        )
+        self.run_for(10)
+        self.flushLoggedErrors(RuntimeError)
+        self.assertEqual([10], collector.intervals())
+        self.assertEqual([2], self.reported)
+        self.assertNoResult(finished)
+
+    def test_wake_up(self):
+        """
+        A collector asking to be collected early is collected a short time
+        after it was last collected.
+        """
+        collector = _Collector(self.clock, [1, 2])
+        self.codes = [_delivery(200), _delivery(200)]
+        Scheduler(self.clock).add(collector, self.report, SETTINGS)
+        self.clock.advance(0)
+        collector.wake_up()
+        self.run_for(4)
+        self.assertEqual(
+            [MINIMUM_WAKE_UP_INTERVAL.total_seconds()], collector.intervals(),
+        )
+
+    def test_wake_up_backing_off(self):
+        """
+        Asking to be collected early is ignored while backing off.
+        """
+        collector = _Collector(self.clock, [1, 2])
+        self.codes = [_delivery(TOO_MANY_REQUESTS), _delivery(200)]
+        Scheduler(self.clock).add(collector, self.report, SETTINGS)
+        self.clock.advance(0)
+        collector.wake_up()
+        self.run_for(10)
+        self.assertEqual([10], collector.intervals())
@@ -0,0 +1,458 @@
+"""
+Tests for ``agents._spool``.
+"""
+
+from twisted.internet.defer import fail, succeed
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._httpclient import Delivery
+from .._metrics import REGISTRY
+from .._spool import Spool, _SEGMENT_SUFFIX
+from ..agentlib import _SpoolReporter
+from .test_envelope import _Reactor
+
+
+def _spool(path, clock, max_size=1024 * 1024, segment_size=1024):
+    return Spool(
+        path=path, max_size=max_size, segment_size=segment_size,
+        sync_interval=1.0, reactor=clock, name=b"test",
+    )
+
+
+def _drain(spool):
+    """
+    Acknowledge everything in ``spool``.
+
+    :return: A ``list`` of the results in it, oldest first.
+    """
+    results = []
+    while True:
+        record = spool.peek()
+        if record is None:
+            return results
+        results.append(record.result)
+        spool.acknowledge(record)
+
+
+class _WaitingThreadPool(object):
+    """
+    A thread pool which only runs what it is given when told to.
+    """
+    def __init__(self):
+        self.waiting = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.waiting.append(lambda: onResult(True, f(*args, **kwargs)))
+
+    def run(self):
+        waiting, self.waiting = self.waiting, []
+        for call in waiting:
+            call()
+
+
+class _WaitingReactor(_Reactor):
+    def __init__(self):
+        _Reactor.__init__(self)
+        self.pool = _WaitingThreadPool()
+
+    def getThreadPool(self):
+        return self.pool
+
+
+def _age():
+    return REGISTRY.snapshot()["catalog_agent_spool_oldest_age_seconds"][
+        u"spool=test"
+    ]
+
+
+class SpoolTests(SynchronousTestCase):
+    """
+    Tests for ``Spool``.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.clock = _Reactor()
+
+    def segments(self):
+        return sorted(
+            child for child in self.path.children()
+            if child.basename().endswith(_SEGMENT_SUFFIX)
+        )
+
+    def test_order(self):
+        """
+        Records are read back oldest first, each until it is acknowledged.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append({u"n": 1})
+        spool.append({u"n": 2})
+        self.assertEqual(
+            (2, spool.peek().result, spool.peek().result),
+            (spool.depth, {u"n": 1}, {u"n": 1}),
+        )
+        spool.acknowledge(spool.peek())
+        self.assertEqual(
+            (1, {u"n": 2}), (spool.depth, spool.peek().result),
+        )
+
+    def test_empty(self):
+        """
+        There is nothing to read from an empty spool.
+        """
+        self.assertIs(None, _spool(self.path, self.clock).peek())
+
+    def test_positions(self):
+        """
+        ``append`` returns the position its record is read back with, and
+        later records have greater positions.
+        """
+        spool = _spool(self.path, self.clock, segment_size=30)
+        positions = list(spool.append(n) for n in range(5))
+        records = []
+        while spool.peek() is not None:
+            records.append(spool.peek())
+            spool.acknowledge(records[-1])
+        self.assertEqual(
+            (positions, sorted(positions)),
+            (list((r.segment, r.end) for r in records), positions),
+        )
+
+    def test_timestamp(self):
+        """
+        Each record has the time it was appended.
+        """
+        spool = _spool(self.path, self.clock)
+        self.clock.advance(12.5)
+        spool.append(1)
+        self.assertEqual(12.5, spool.peek().timestamp)
+
+    def test_segments(self):
+        """
+        A new segment is started when the last one is full and segments are
+        removed once everything in them is acknowledged.
+        """
+        spool = _spool(self.path, self.clock, segment_size=30)
+        for n in range(4):
+            spool.append(n)
+        self.assertEqual(4, len(self.segments()))
+        self.assertEqual([0, 1, 2, 3], _drain(spool))
+        self.assertEqual(1, len(self.segments()))
+
+    def test_reopen(self):
+        """
+        A spool opened again has the records which weren't acknowledged.
+        """
+        spool = _spool(self.path, self.clock, segment_size=30)
+        for n in range(4):
+            spool.append(n)
+        spool.acknowledge(spool.peek())
+        spool.sync()
+        reopened = _spool(self.path, self.clock, segment_size=30)
+        self.assertEqual(
+            (3, [1, 2, 3]), (reopened.depth, _drain(reopened)),
+        )
+
+    def test_reopen_within_segment(self):
+        """
+        The cursor can be part way through a segment.
+        """
+        spool = _spool(self.path, self.clock)
+        for n in range(4):
+            spool.append(n)
+        spool.acknowledge(spool.peek())
+        spool.sync()
+        self.assertEqual([1, 2, 3], _drain(_spool(self.path, self.clock)))
+
+    def test_cursor_synced_later(self):
+        """
+        Acknowledgements are only written out after the sync interval, so a
+        spool reopened before then has the records again.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append(1)
+        spool.append(2)
+        self.clock.advance(1.0)
+        spool.acknowledge(spool.peek())
+        self.assertEqual([1, 2], _drain(_spool(self.path, _Reactor())))
+        self.clock.advance(1.0)
+        self.assertEqual([2], _drain(_spool(self.path, _Reactor())))
+
+    def test_synced_in_thread(self):
+        """
+        Files are synced in the thread pool, and ``sync`` fires once they
+        are.
+        """
+        reactor = _WaitingReactor()
+        spool = _spool(self.path, reactor)
+        spool.append(1)
+        spool.acknowledge(spool.peek())
+        syncing = spool.sync()
+        self.assertNoResult(syncing)
+        self.assertFalse(self.path.child(b"cursor").exists())
+        reactor.pool.run()
+        self.successResultOf(syncing)
+        self.assertTrue(self.path.child(b"cursor").exists())
+
+    def test_age(self):
+        """
+        The age of the oldest record not yet acknowledged is as of when the
+        metrics are read.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append(1)
+        self.clock.advance(10)
+        spool.append(2)
+        self.clock.advance(20)
+        first = _age()
+        spool.acknowledge(spool.peek())
+        second = _age()
+        spool.acknowledge(spool.peek())
+        self.assertEqual((30, 20, 0), (first, second, _age()))
+
+    def test_appended_after_reopen(self):
+        """
+        Records appended after opening a spool again come after the ones
+        already in it.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append(1)
+        spool.sync()
+        reopened = _spool(self.path, self.clock)
+        reopened.append(2)
+        self.assertEqual([1, 2], _drain(reopened))
+
+    def test_torn_record(self):
+        """
+        A record only partly written when the agent stopped is thrown away,
+        and the records before it are kept.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append(1)
+        spool.append(2)
+        spool.sync()
+        [segment] = self.segments()
+        segment.setContent(segment.getContent()[:-1])
+        reopened = _spool(self.path, self.clock)
+        reopened.append(3)
+        self.assertEqual([1, 3], _drain(reopened))
+
+    def test_corrupt_record(self):
+        """
+        A record which doesn't match its checksum is thrown away with
+        everything after it.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append(u"first")
+        spool.append(u"second")
+        spool.append(u"third")
+        spool.sync()
+        [segment] = self.segments()
+        content = segment.getContent()
+        segment.setContent(content.replace(b"second", b"SECOND"))
+        self.assertEqual([u"first"], _drain(_spool(self.path, self.clock)))
+
+    def test_corrupt_cursor(self):
+        """
+        A cursor which can't be read is ignored and everything is read again.
+        """
+        spool = _spool(self.path, self.clock)
+        spool.append(1)
+        spool.append(2)
+        spool.acknowledge(spool.peek())
+        spool.sync()
+        self.path.child(b"cursor").setContent(b"{")
+        self.assertEqual([1, 2], _drain(_spool(self.path, self.clock)))
+
+    def test_evict(self):
+        """
+        Once the spool is over its size the oldest segments are thrown away.
+        """
+        spool = _spool(self.path, self.clock, max_size=40, segment_size=30)
+        for n in range(5):
+            spool.append(n)
+        self.assertEqual(
+            (2, 2, [3, 4]), (len(self.segments()), spool.depth, _drain(spool)),
+        )
+
+    def test_evict_partly_read(self):
+        """
+        Evicting the segment being read moves reading on to the next one,
+        losing only the records in it which weren't acknowledged.
+        """
+        # Two records to a segment.
+        spool = _spool(self.path, self.clock, max_size=100, segment_size=50)
+        for n in range(4):
+            spool.append([n, n])
+        spool.acknowledge(spool.peek())
+        spool.append([4, 4])
+        self.assertEqual(
+            (3, [[2, 2], [3, 3], [4, 4]]), (spool.depth, _drain(spool)),
+        )
+
+    def test_evicted_cursor(self):
+        """
+        Eviction is remembered when the spool is opened again.
+        """
+        spool = _spool(self.path, self.clock, max_size=40, segment_size=30)
+        for n in range(5):
+            spool.append(n)
+        spool.sync()
+        reopened = _spool(self.path, self.clock, max_size=40, segment_size=30)
+        self.assertEqual([3, 4], _drain(reopened))
+
+    def test_stale_acknowledge(self):
+        """
+        Acknowledging a record which was evicted while it was being sent
+        changes nothing.
+        """
+        spool = _spool(self.path, self.clock, max_size=40, segment_size=30)
+        spool.append(0)
+        record = spool.peek()
+        for n in range(1, 5):
+            spool.append(n)
+        spool.acknowledge(record)
+        self.assertEqual([3, 4], _drain(spool))
+
+
+class _Response(object):
+    def __init__(self, code):
+        self.code = code
+
+
+class _Reporter(object):
+    """
+    A reporter which records what it is asked to report and answers with
+    the next of ``codes``.
+    """
+    def __init__(self, codes):
+        self.reported = []
+        self._codes = list(codes)
+
+    def report(self, result):
+        self.reported.append(result)
+        code = self._codes.pop(0)
+        if code is None:
+            return fail(RuntimeError("Not sent"))
+        return succeed(
+            Delivery(response=_Response(code), body=b"", sent_bytes=0)
+        )
+
+
+class SpoolReporterTests(SynchronousTestCase):
+    """
+    Tests for ``agentlib._SpoolReporter``.
+    """
+    def setUp(self):
+        self.spool = _spool(FilePath(self.mktemp()), _Reactor())
+
+    def test_acknowledged(self):
+        """
+        A result Firehose accepts is sent and removed from the spool.
+        """
+        reporter = _Reporter([200])
+        _SpoolReporter(self.spool, reporter, 5).report({u"a": 1})
+        self.assertEqual(
+            ([{u"a": 1}], 0), (reporter.reported, self.spool.depth),
+        )
+
+    def test_rejected(self):
+        """
+        A result Firehose rejects stays in the spool and is sent before newer
+        results on the next report.
+        """
+        reporter = _Reporter([503, 200, 200])
+        spooling = _SpoolReporter(self.spool, reporter, 5)
+        spooling.report(1)
+        self.assertEqual(1, self.spool.depth)
+        spooling.report(2)
+        self.assertEqual(
+            ([1, 1, 2], 0), (reporter.reported, self.spool.depth),
+        )
+
+    def test_failed(self):
+        """
+        A result which can't be sent at all stays in the spool, and the
+        report doesn't fail.
+        """
+        reporter = _Reporter([None])
+        reporting = _SpoolReporter(self.spool, reporter, 5).report(1)
+        self.assertEqual(
+            (None, 1),
+            (self.successResultOf(reporting), self.spool.depth),
+        )
+
+    def test_replay_batch(self):
+        """
+        No more than ``replay_batch`` results are sent per report.
+        """
+        self.spool.append(1)
+        self.spool.append(2)
+        reporter = _Reporter([200, 200])
+        _SpoolReporter(self.spool, reporter, 2).report(3)
+        self.assertEqual(
+            ([1, 2], 1), (reporter.reported, self.spool.depth),
+        )
+
+    def test_empty_result(self):
+        """
+        An empty result isn't spooled, but the spool is still replayed.
+        """
+        self.spool.append(1)
+        reporter = _Reporter([200])
+        _SpoolReporter(self.spool, reporter, 5).report({})
+        self.assertEqual(([1], 0), (reporter.reported, self.spool.depth))
+
+    def test_unencodable(self):
+        """
+        A result which can't be encoded is dropped instead of failing.
+        """
+        reporter = _Reporter([])
+        reporting = _SpoolReporter(self.spool, reporter, 5).report(
+            [object()],
+        )
+        self.assertEqual(
+            (None, 0), (self.successResultOf(reporting), self.spool.depth),
+        )
+
+    def test_delivered(self):
+        """
+        ``delivered`` is told, in order, whether each result reported was
+        acknowledged.
+        """
+        delivered = []
+        reporter = _Reporter([503, 200, 200])
+        spooling = _SpoolReporter(self.spool, reporter, 5, delivered.append)
+        spooling.report(1)
+        self.assertEqual([], delivered)
+        spooling.report(2)
+        self.assertEqual([True, True], delivered)
+
+    def test_delivered_evicted(self):
+        """
+        ``delivered`` is told a result evicted from the spool before it was
+        sent wasn't delivered.
+        """
+        spool = _spool(
+            FilePath(self.mktemp()), _Reactor(), max_size=40, segment_size=30,
+        )
+        delivered = []
+        spooling = _SpoolReporter(
+            spool, _Reporter([None] * 4 + [200]), 1, delivered.append,
+        )
+        for n in range(1, 6):
+            spooling.report(n)
+        self.assertEqual([False, False, False, True], delivered)
+
+    def test_delivered_unencodable(self):
+        """
+        ``delivered`` is told a result which couldn't be spooled wasn't
+        delivered.
+        """
+        delivered = []
+        spooling = _SpoolReporter(
+            self.spool, _Reporter([200]), 5, delivered.append,
+        )
+        spooling.report([object()])
+        spooling.report(1)
+        self.assertEqual([False, True], delivered)
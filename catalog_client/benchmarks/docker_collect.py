@@ -0,0 +1,174 @@
+# Measure how long the docker collector takes to collect from a host with many
+# containers and how long it holds up the reactor while doing so.
+#
+# A fake Docker daemon is served on a unix socket in a temporary directory.
+# It knows about --containers containers and answers each inspect after
+# --latency seconds, like a busy daemon would.  The collector is run against
+# it once for each --concurrency given.
+#
+#   PYTHONPATH=. python benchmarks/docker_collect.py --containers 500 \
+#       --latency 0.01 --concurrency 1 --concurrency 8 --concurrency 32
+
+from __future__ import print_function
+
+import json
+import sys
+from argparse import ArgumentParser
+from datetime import timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall, deferLater, react
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from agents._dockerclient import DockerClient, DockerClientSettings
+from agents.docker_agent import Collector
+from agents._metrics import REGISTRY
+
+
+def _container(index):
+    identity = u"{:064x}".format(index)
+    return {
+        u"Id": identity,
+        u"Created": u"2015-11-02T00:00:{:02d}.{:09d}Z".format(
+            index % 60, index,
+        ),
+        u"Name": u"/container-{}".format(index),
+        u"Config": {
+            u"Image": u"busybox",
+            u"Env": [u"SECRET={}".format(index)] * 10,
+            u"Labels": dict(
+                (u"label-{}".format(i), u"x" * 20) for i in range(10)
+            ),
+        },
+        u"State": {
+            u"Running": True,
+            u"StartedAt": u"2015-11-02T00:00:00Z",
+            u"FinishedAt": u"0001-01-01T00:00:00Z",
+        },
+        u"NetworkSettings": {
+            u"IPAddress": u"172.17.0.{}".format(index % 255),
+            u"SandboxKey": u"/var/run/docker/netns/{:012x}".format(index),
+        },
+        u"GraphDriver": {
+            u"Name": u"overlay",
+            u"Data": {
+                u"LowerDir": u"/var/lib/docker/overlay/{:064x}/root".format(
+                    index,
+                ),
+            },
+        },
+        u"Mounts": [{u"Source": u"/flocker/{}".format(index)}],
+    }
+
+
+class _FakeDocker(Resource):
+    isLeaf = True
+
+    def __init__(self, reactor, containers, latency):
+        Resource.__init__(self)
+        self._reactor = reactor
+        self._latency = latency
+        self._containers = dict(
+            (container[u"Id"], container) for container in containers
+        )
+        self._listing = json.dumps(list(
+            {u"Id": container[u"Id"]} for container in reversed(containers)
+        ))
+
+    def render_GET(self, request):
+        path = request.postpath[1:]
+        if path == [b"containers", b"json"]:
+            return self._listing
+        if path == [b"version"]:
+            return json.dumps({u"Version": u"1.9.1", u"ApiVersion": u"1.21"})
+        if path[:1] == [b"containers"] and path[2:] == [b"json"]:
+            if path[1] not in self._containers:
+                request.setResponseCode(404)
+                return b""
+
+            def respond():
+                request.write(json.dumps(self._containers[path[1]]))
+                request.finish()
+            self._reactor.callLater(self._latency, respond)
+            return NOT_DONE_YET
+        if path == [b"events"]:
+            # Never any events; just hold the stream open.
+            request.write(b"")
+            return NOT_DONE_YET
+        request.setResponseCode(404)
+        return b""
+
+
+@inlineCallbacks
+def _benchmark(reactor, arguments):
+    options = _parser().parse_args(arguments)
+    directory = mkdtemp()
+    socket = directory + b"/docker.sock"
+    port = reactor.listenUNIX(socket, Site(_FakeDocker(
+        reactor,
+        list(_container(i) for i in range(options.containers)),
+        options.latency,
+    )))
+
+    # The longest the reactor went without running a 10ms timer.
+    lag = [0.0, time()]
+
+    def tick():
+        now = time()
+        lag[0] = max(lag[0], now - lag[1] - 0.01)
+        lag[1] = now
+    lagging = LoopingCall(tick)
+    lagging.start(0.01)
+
+    try:
+        for concurrency in options.concurrency or [8]:
+            client = DockerClient(
+                reactor,
+                DockerClientSettings(
+                    socket=socket,
+                    concurrency=concurrency,
+                    timeout=timedelta(seconds=60),
+                ),
+            )
+            collector = Collector(
+                client=client, events=False, reactor=reactor,
+            )
+            timings = []
+            for _ in range(options.rounds):
+                lag[0] = 0.0
+                before = time()
+                result = yield collector.collect()
+                timings.append(time() - before)
+                assert len(result["docker_info"]) == options.containers
+            payload = REGISTRY.snapshot()["catalog_agent_docker_payload_bytes"]
+            print(
+                "concurrency={:<4} best={:.3f}s worst={:.3f}s "
+                "max-reactor-lag={:.3f}s raw={}B projected={}B".format(
+                    concurrency, min(timings), max(timings), lag[0],
+                    payload[u"stage=raw"], payload[u"stage=projected"],
+                )
+            )
+            yield client.pool.closeCachedConnections()
+    finally:
+        lagging.stop()
+        yield port.stopListening()
+        rmtree(directory)
+    # Let the last connections finish closing.
+    yield deferLater(reactor, 0.1, lambda: None)
+
+
+def _parser():
+    parser = ArgumentParser()
+    parser.add_argument("--containers", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, action="append")
+    return parser
+
+
+if __name__ == "__main__":
+    react(_benchmark, [sys.argv[1:]])
@@ -0,0 +1,137 @@
+# Measure how many lines per second the log file tailer keeps up with.
+#
+# A separate process writes Eliot-like lines to a file in a temporary
+# directory as fast as it can for --seconds, optionally rotating the file
+# every --rotate-every lines by renaming it away (--rotation rename) or by
+# copying and truncating it (--rotation copytruncate).  The tailer follows the
+# file and the number of lines it recorded, and how quickly, is reported.
+#
+#   PYTHONPATH=. python benchmarks/file_tail.py --seconds 5 \
+#       --rotation rename --rotate-every 200000
+
+from __future__ import print_function
+
+import sys
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import deferLater, react
+from twisted.python.filepath import FilePath
+
+from agents._filelogs import _DirectoryWatcher, _FileLogStream
+
+_WRITER = b"""
+import os, shutil, sys, time
+path, seconds, rotation, rotate_every = (
+    sys.argv[1], float(sys.argv[2]), sys.argv[3], int(sys.argv[4]))
+line = (
+    '{"timestamp": %.6f, "task_uuid": "2b1a8b3e-8b5f-4bde-b3c6-0c05b1d2fd1e", '
+    '"message_type": "flocker:benchmark", "task_level": [1], "n": %d}\\n')
+log = open(path, "a", 1024 * 1024)
+written = 0
+rotations = 0
+deadline = time.time() + seconds
+while time.time() < deadline:
+    for _ in range(1000):
+        log.write(line % (time.time(), written))
+        written += 1
+        if rotate_every and written % rotate_every == 0:
+            rotations += 1
+            log.flush()
+            if rotation == "rename":
+                os.rename(path, "%s.%d" % (path, rotations))
+                log.close()
+                log = open(path, "a", 1024 * 1024)
+            else:
+                shutil.copy(path, "%s.%d" % (path, rotations))
+                log.truncate(0)
+                log.seek(0)
+log.close()
+sys.stdout.write("%d\\n" % (written,))
+"""
+
+
+class _Writer(ProcessProtocol):
+    def __init__(self):
+        self.finished = Deferred()
+        self._output = b""
+
+    def outReceived(self, data):
+        self._output += data
+
+    def processEnded(self, reason):
+        self.finished.callback(int(self._output))
+
+
+@inlineCallbacks
+def _benchmark(reactor, arguments):
+    options = _parser().parse_args(arguments)
+    directory = FilePath(mkdtemp())
+    path = directory.child(b"flocker-dataset-agent.log")
+    path.touch()
+
+    received = [0]
+    first_last = [None, None]
+
+    def record_log(lines):
+        now = time()
+        if first_last[0] is None:
+            first_last[0] = now
+        first_last[1] = now
+        received[0] += len(lines)
+
+    stream = _FileLogStream(
+        path=path, record_log=record_log, reactor=reactor,
+        watcher=_DirectoryWatcher(reactor),
+    )
+    stream.run()
+
+    writer = _Writer()
+    reactor.spawnProcess(
+        writer, sys.executable,
+        [
+            sys.executable, b"-c", _WRITER, path.path,
+            str(options.seconds), options.rotation,
+            str(options.rotate_every),
+        ],
+        env=None,
+    )
+    started = time()
+    written = yield writer.finished
+    writing = time() - started
+
+    # Give the tailer a moment to catch up, even if it is polling.
+    previous = -1
+    while received[0] != previous:
+        previous = received[0]
+        yield deferLater(reactor, 1.5, lambda: None)
+
+    elapsed = first_last[1] - started
+    print(
+        "written={} ({:.0f} lines/s) received={} ({:.0f} lines/s) "
+        "lost={}".format(
+            written, written / writing,
+            received[0], received[0] / elapsed,
+            written - received[0],
+        )
+    )
+    stream.loop.stop()
+    rmtree(directory.path)
+
+
+def _parser():
+    parser = ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument(
+        "--rotation", choices=["rename", "copytruncate"], default="rename",
+    )
+    parser.add_argument("--rotate-every", type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    react(_benchmark, [sys.argv[1:]])
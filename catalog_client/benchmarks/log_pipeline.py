@@ -0,0 +1,115 @@
+# Measure what parsing, filtering and throttling log lines costs.
+#
+# Eliot-like lines are recorded --rate lines a second, in batches of --batch,
+# for --seconds: through the parsing and filtering stage alone, then with
+# repeated messages being collapsed too and then with each unit's rate limited
+# as well.  --repeated of the lines are copies of one error message, like a
+# unit stuck in a loop would log; the rest are all different.  The CPU time
+# each takes is reported as a share of one core at that rate.
+#
+#   PYTHONPATH=. python benchmarks/log_pipeline.py --rate 50000 --seconds 5
+
+from __future__ import print_function
+
+import json
+import random
+import sys
+from argparse import ArgumentParser
+from time import clock as cpu_time
+
+from twisted.internet.task import Clock
+
+from agents._logfilter import LogFilter
+from agents._loglib import _MultiStreamRecorder
+from agents._logthrottle import LogThrottle, LogThrottleSettings
+
+
+def _line(index, repeated):
+    if repeated:
+        message = {
+            u"message_type": u"flocker:node:agents:blockdevice:failed",
+            u"reason": u"Device /dev/xvdf is busy",
+        }
+    else:
+        message = {
+            u"action_type": u"flocker:node:agents:blockdevice:attach",
+            u"action_status": u"succeeded",
+            u"dataset_id": u"{:032x}".format(index),
+        }
+    message.update({
+        u"timestamp": 1446422400.0 + index / 50000.0,
+        u"task_uuid": u"{:032x}".format(index),
+        u"task_level": [1, index % 7],
+    })
+    return json.dumps(message) + b"\n"
+
+
+def _kept(recorder):
+    kept = 0
+    while True:
+        kept += sum(
+            1 for entry
+            in recorder.consume().get(b"flocker-dataset-agent", [])
+            if not isinstance(entry, dict)
+        )
+        # Take a batch at a time until nothing is left.
+        if not recorder.size:
+            return kept
+
+
+def _run(recorder, clock, lines, batch, rate):
+    record = recorder.recorder(b"flocker-dataset-agent")
+    kept = 0
+    started = cpu_time()
+    for start in range(0, len(lines), batch):
+        clock.advance(float(batch) / rate)
+        record(lines[start:start + batch])
+        if start % rate < batch:
+            # Collect once a second of lines.
+            kept += _kept(recorder)
+    kept += _kept(recorder)
+    return cpu_time() - started, kept
+
+
+def _benchmark(arguments):
+    options = _parser().parse_args(arguments)
+    randomness = random.Random(0)
+    count = int(options.rate * options.seconds)
+    lines = list(
+        _line(index, randomness.random() < options.repeated)
+        for index in range(count)
+    )
+
+    for (name, settings) in [
+        (u"filter", None),
+        (u"+collapse", LogThrottleSettings(rate=0)),
+        (u"+collapse+limit", LogThrottleSettings()),
+    ]:
+        clock = Clock()
+        throttle = None
+        if settings is not None:
+            throttle = LogThrottle(clock, settings)
+        recorder = _MultiStreamRecorder(LogFilter(), throttle)
+        elapsed, kept = _run(
+            recorder, clock, lines, options.batch, options.rate,
+        )
+        print(
+            "{:<16} {:.0f} lines/s  {:.1%} of a core at {} lines/s  "
+            "kept {} of {}".format(
+                name, count / elapsed, elapsed / options.seconds,
+                options.rate, kept, count,
+            )
+        )
+
+
+def _parser():
+    parser = ArgumentParser()
+    parser.add_argument("--rate", type=int, default=50000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--repeated", type=float, default=0.9)
+    return parser
+
+
+if __name__ == "__main__":
+    _benchmark(sys.argv[1:])
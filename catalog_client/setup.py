@@ -9,6 +9,10 @@ setup(
             "catalog-docker-agent = agents.docker_agent:main", # run on agent nodes
             "catalog-node-agent = agents.node_agent:main", # run on all nodes
             "catalog-log-agent = agents.log_agent:main", # run on all nodes
+            # run any of the above in one process
+            "catalog-agent = agents.host_agent:main",
+            # stand-in Firehose server for local testing
+            "catalog-firehose-stub = agents.firehose_stub:main",
         ],
     },
     version="0.1",
@@ -18,11 +22,11 @@ setup(
     url="https://github.com/ClusterHQ/volume-catalog",
     install_requires=[
         "PyYAML>=3",
-        "Twisted>=14",
+        "Twisted>=15",
         "treq>=14",
         "pyasn1>=0.1",
-        "docker-py>=1.5.0",
         "pyrsistent>=0.11.9",
         "eliot>=0.9.0",
+        "service_identity>=14.0.0",
     ],
 )
@@ -1,4 +1,29 @@
 #!/bin/sh
+if [ "$CATALOG_SINGLE_PROCESS" = "1" ]; then
+    # Run every collector this node needs in one container.
+    COLLECTORS="log,node"
+    if [ "$RUN_FLOCKER_AGENT_HERE" = "1" ]; then
+        COLLECTORS="$COLLECTORS,flocker"
+    fi
+    if [ "$TARGET" = "agent-node" ]; then
+        COLLECTORS="$COLLECTORS,docker"
+    fi
+    for name in dataset docker log node; do
+        sudo docker rm -f volume-hub-agent-$name || false
+    done
+    sudo docker rm -f volume-hub-agent || false
+    sudo docker pull clusterhq/catalog-agents-host
+    sudo -E docker run -d --restart=always \
+        -e CATALOG_FIREHOSE_SECRET="$TOKEN" \
+        -e CATALOG_FIREHOSE_HOSTNAME \
+        -e CATALOG_COLLECTORS="$COLLECTORS" \
+        -e FLOCKER_CONFIGURATION_PATH=/host/etc/flocker \
+        -v /:/host \
+        --name volume-hub-agent \
+        clusterhq/catalog-agents-host
+    exit 0
+fi
+
 if [ "$RUN_FLOCKER_AGENT_HERE" = "1" ]; then
     sudo docker rm -f volume-hub-agent-dataset || false
     sudo docker pull clusterhq/catalog-agents-dataset